@@ -1,121 +1,409 @@
 import os
-from langchain_groq import ChatGroq
+import re
+import asyncio
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
+from tools import registry, retrieval, prompt_builder, router, metrics
+from tools.response_cache import response_cache, ENABLED as RESPONSE_CACHE_ENABLED
+from tools.llm_gateway import gateway, LLMSaturated
 
 load_dotenv()
 
-# Global Resource Cache
-_vector_store = None
-_embeddings = None
+# Bounded pool for the CPU-bound part of a turn (query embedding + FAISS search)
+# when called from the async path, so the event loop only ever awaits I/O.
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "2"))
+_cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="rag")
 
-def get_vector_store():
-    global _vector_store, _embeddings
-    if _vector_store:
-        return _vector_store
+# agent_batch(): LLM calls in flight per batch. Batch questions may queue for
+# a rate-limit slot much longer than interactive ones before giving up.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_QUEUE_WAIT = float(os.getenv("BATCH_QUEUE_WAIT", "120"))
+
+# Words that usually mean the question only makes sense with the conversation
+# so far ("explain that again"); such turns never read or fill the answer cache.
+FOLLOW_UP_CUES = {"it", "this", "that", "they", "them", "these", "those", "above", "previous",
+                  "again", "more", "else", "elaborate", "continue"}
+
+OUT_OF_SCOPE_REPLY = "🚫 **Out of Scope**: I am strictly programmed to answer questions about **Operating Systems** only (e.g., Paging, Scheduling, Deadlocks). I cannot assist with Geography, General Knowledge, or other topics."
+GREETING_REPLY = "Hello! I'm OS Buddy. I can explain Processes, Threads, Scheduling, Deadlocks, Memory Management, and more. How can I help?"
+
+def depends_on_history(user_message, chat_history):
+    # chat_history already ends with the current user message
+    if not chat_history or len(chat_history) <= 1:
+        return False
+    words = re.findall(r"[a-z']+", user_message.lower())
+    return len(words) <= 3 or any(w in FOLLOW_UP_CUES for w in words)
+
+def route_turn(user_message, chat_history):
+    """Step 1 of prepare_turn(): the ready-made turn for a greeting or an off-topic
+    message, or None if the message goes on to retrieval and the LLM."""
+    # Router: OS question, greeting, or off-topic (greetings and off-topic
+    # requests are answered here without touching FAISS or the LLM)
+    with metrics.span("route"):
+        label, confidence, method = router.route(user_message)
+    if label == "greeting":
+        return {"reply": GREETING_REPLY, "mode": f"Router -> Greeting ({method}, {confidence:.2f})"}
+    # Follow-ups ("why is that?") only make sense with the conversation, so let the LLM judge them
+    if label == "off_topic" and not depends_on_history(user_message, chat_history):
+        return {"reply": OUT_OF_SCOPE_REPLY, "mode": f"Blocked by Topic Router ({method}, {confidence:.2f})"}
+    return None
+
+def prepare_turn(user_message, chat_history, memory=None, retrieved=None, corpora=None, routed=False):
+    """
+    Runs routing, retrieval and prompt construction for one user message.
+    Returns a dict with either a ready-made "reply" (guardrail / error) or the
+    "prompt" to send to the LLM, plus the "mode" shown as the thought process
+    and the page "citations" of the retrieved chunks.
+    Cacheable turns also carry "cache" (query vector + retrieved chunk ids).
+    `memory` is the session's rolling summary ({"summary", "summary_through"}).
+    `retrieved` is this message's (query_vector, results) from
+    retrieval.search_many(), when the caller searched in bulk.
+    `corpora` names the course indexes to search (default corpus if None).
+    `routed` skips the router when the caller already ran route_turn().
+    """
+    # 1. Router
+    if not routed:
+        turn = route_turn(user_message, chat_history)
+        if turn:
+            return turn
+
+    context_chunks = []
+    mode = "Direct LLM"
+    cache = None
+
+    # 2. Retrieval (RAG)
+    if retrieved is None:
+        print(f"Searching knowledge base for: {user_message}")
+    query_vector, results = retrieved or retrieval.search(user_message, k=3, corpora=corpora)
+    if results:
+        # Most relevant first, so budget trimming drops the least relevant text
+        context_chunks = [doc.page_content for _, doc, _ in results]
+        mode = "Router -> RAG (Textbook)"
+    if query_vector is not None and RESPONSE_CACHE_ENABLED:
+        if depends_on_history(user_message, chat_history):
+            response_cache.bypass()
+        else:
+            cache = {"vector": query_vector, "context_ids": [chunk_id for chunk_id, _, _ in results]}
+    
+    # 3. Construct Prompt (token-budgeted: context by relevance, then newest history)
+    memory = memory or {}
+    with metrics.span("prompt"):
+        budget = prompt_builder.split_budget(prompt_builder.count_tokens(render_prompt("", "", user_message)))
+        context_text, context_tokens = prompt_builder.fit_context(context_chunks, budget["context"])
+        history = prompt_builder.unsummarized(chat_history[:-1] if chat_history else [], memory.get("summary_through"))
+        history_text, _ = prompt_builder.fit_history(
+            history, memory.get("summary"), budget["available"] - context_tokens
+        )
+        system_prompt = render_prompt(context_text, history_text, user_message)
+
+    return {"prompt": system_prompt, "mode": mode, "cache": cache, "citations": retrieval.citations(results),
+            "prompt_tokens": prompt_builder.count_tokens(system_prompt)}
+
+def render_prompt(context_text, history_text, user_message):
+    return f"""You are OS Buddy, an expert Operating Systems Tutor based on the Silberschatz textbook.
+    
+    SCOPE:
+    You are a SPECIALIZED Operating Systems Tutor.
+    You MUST ONLY answer questions directly related to Operating Systems (Concepts, Algorithms, Kernels, Memory, Concurrency, etc.).
+    
+    STRICT REFUSAL POLICY:
+    If the user asks about ANYTHING else (including General Python, Web Development, Geography, Biology, Sports, Politics, or General Knowledge), you must politely but FIRMLY REFUSE.
+    
+    Refusal Template: "I am strictly programmed to help with Operating Systems only. I cannot answer questions about [topic]. Please ask me about topics like Paging, Scheduling, or Deadlocks."
+
+    CONTEXT FROM TEXTBOOK:
+    {context_text if context_text else "No specific textbook context found."}
+
+    INSTRUCTIONS:
+    1. If Context is present, USE IT. It contains the exact definitions and steps.
+    2. If the user asks for a diagram (or if the concept *needs* one, e.g., Scheduling, Lifecycle), generate Mermaid.js code.
+    3. Explain strictly but friendly.
+    
+    DIAGRAMMING RULES (CRITICAL):
+    - **FOR FLOWCHARTS (`graph TD`)**:
+        - Use `-->|Label|` for arrows.
+        - IDs must be alphanumeric.
+    - **FOR SEQUENCE DIAGRAMS (`sequenceDiagram`)**:
+        - Use `A->>B: Message` (Colon syntax).
+        - **NEVER** use `-->|Label|` in sequence diagrams.
+        - **NEVER** use `Note over A,B,C` (Max 2 participants like `Note over A,B`).
+    - **GENERAL**:
+        - Strings: ALWAYS double quotes.
+        - No `|>` at end of arrows.
     
-    index_path = os.path.join(os.path.dirname(__file__), "faiss_index")
-    if os.path.exists(index_path):
+    Conversation:
+    {history_text}
+    
+    User: {user_message}
+    """
+
+def cached_reply(turn):
+    """Returns (response, mode) from the semantic cache, or None."""
+    if not turn.get("cache"):
+        return None
+    hit = response_cache.get(turn["cache"]["vector"], turn["cache"]["context_ids"])
+    if hit is None:
+        return None
+    response, mode = hit
+    metrics.annotate(cached=True)
+    return response, f"{mode} (cached)"
+
+def remember_reply(turn, response):
+    """Called once per LLM reply: counts its tokens and fills the answer cache."""
+    metrics.record_tokens("prompt", turn["prompt_tokens"])
+    metrics.record_tokens("completion", prompt_builder.count_tokens(response))
+    if turn.get("cache"):
+        response_cache.put(turn["cache"]["vector"], turn["cache"]["context_ids"], response, turn["mode"])
+
+def get_llm():
+    return registry.get_llm()
+
+def summarize_history(previous_summary, messages):
+    """Folds older turns into the session's rolling summary using the small model."""
+    llm = registry.get_summary_llm()
+    if llm is None:
+        return previous_summary
+    transcript = "".join(prompt_builder.format_message(msg) for msg in messages)
+    prompt = f"""Update the running summary of a tutoring conversation about Operating Systems.
+    Keep it under 120 words. Keep the topics covered, what the student already understands or struggled with,
+    and any definitions or examples the tutor gave that later questions may refer to.
+
+    Current summary:
+    {previous_summary or "(none)"}
+
+    New turns:
+    {transcript}
+
+    Updated summary:"""
+    # Background work: wait as long as it takes rather than failing
+    return gateway.invoke(llm, prompt, prompt_builder.count_tokens(prompt), max_wait=float("inf")).content.strip()
+
+def agent(user_message, chat_history, memory=None, corpora=None):
+    """Answers one message. Returns (response, mode, citations)."""
+    llm = get_llm()
+    if llm is None:
+        return "Error: GROQ_API_KEY not found.", "System Error", []
+
+    try:
+        turn = prepare_turn(user_message, chat_history, memory, corpora=corpora)
+        if "reply" in turn:
+            return turn["reply"], turn["mode"], []
+
+        hit = cached_reply(turn)
+        if hit:
+            return hit + (turn["citations"],)
+
+        with metrics.span("llm"):
+            response = gateway.invoke(llm, turn["prompt"], turn["prompt_tokens"])
+        remember_reply(turn, response.content)
+        return response.content, turn["mode"], turn["citations"]
+
+    except LLMSaturated:
+        raise  # the app answers 503 + Retry-After
+    except Exception as e:
+        print(f"Agent Error: {e}")
+        metrics.record_error("agent")
+        return f"I encountered an error: {str(e)}", "System Crash", []
+
+def agent_stream(user_message, chat_history, memory=None, corpora=None):
+    """
+    Generator variant of agent(). Yields ("mode", text) once, then
+    ("citations", list) if the answer draws on the textbook, then
+    ("token", text) for every chunk ChatGroq produces. Errors are yielded
+    as a final token so the caller always gets a complete message.
+    """
+    llm = get_llm()
+    if llm is None:
+        yield "mode", "System Error"
+        yield "token", "Error: GROQ_API_KEY not found."
+        return
+
+    try:
+        turn = prepare_turn(user_message, chat_history, memory, corpora=corpora)
+    except Exception as e:
+        print(f"Agent Error: {e}")
+        metrics.record_error("agent")
+        yield "mode", "System Crash"
+        yield "token", f"I encountered an error: {str(e)}"
+        return
+
+    if "reply" in turn:
+        yield "mode", turn["mode"]
+        yield "token", turn["reply"]
+        return
+
+    hit = cached_reply(turn)
+    if hit:
+        yield "mode", hit[1]
+        if turn["citations"]:
+            yield "citations", turn["citations"]
+        yield "token", hit[0]
+        return
+
+    yield "mode", turn["mode"]
+    if turn["citations"]:
+        yield "citations", turn["citations"]
+    try:
+        parts = []
+        with metrics.span("llm"):
+            for chunk in gateway.stream(llm, turn["prompt"], turn["prompt_tokens"]):
+                if chunk.content:
+                    parts.append(chunk.content)
+                    yield "token", chunk.content
+        remember_reply(turn, "".join(parts))
+    except LLMSaturated:
+        raise
+    except Exception as e:
+        print(f"Agent Stream Error: {e}")
+        metrics.record_error("agent")
+        yield "token", f"\n\nI encountered an error: {str(e)}"
+
+def agent_batch(questions, concurrency=BATCH_CONCURRENCY, corpora=None):
+    """
+    Answers standalone questions (no chat history) in one pass. All questions
+    are embedded in one batch and routed; only the ones left for the LLM are
+    searched, with one FAISS call, repeated questions are answered once, and LLM
+    calls run `concurrency` at a time through the gateway, queueing up to
+    BATCH_QUEUE_WAIT for a rate-limit slot.
+    Yields (index, response, mode, citations) in completion order.
+    """
+    llm = get_llm()
+    if llm is None:
+        for index in range(len(questions)):
+            yield index, "Error: GROQ_API_KEY not found.", "System Error", []
+        return
+
+    indexes = {}  # normalized question -> positions in `questions`
+    for index, question in enumerate(questions):
+        indexes.setdefault(retrieval.normalize_query(question), []).append(index)
+    texts = [questions[positions[0]] for positions in indexes.values()]
+    # One embedding batch for all; the router and search_many() then hit the embedding cache
+    retrieval.embed_queries(texts)
+
+    def route(text):
         try:
-            print("Loading FAISS Index...")
-            _embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-            _vector_store = FAISS.load_local(index_path, _embeddings, allow_dangerous_deserialization=True)
-            print("FAISS Index Loaded.")
-            return _vector_store
+            return route_turn(text, [])
         except Exception as e:
-            print(f"Failed to load FAISS: {e}")
-            return None
-    return None
+            print(f"Agent Error: {e}")
+            metrics.record_error("agent")
+            return {"reply": f"I encountered an error: {str(e)}", "mode": "System Crash"}
+
+    # Greetings and off-topic questions are answered by the router: only the rest are searched
+    routed = [route(text) for text in texts]
+    todo = [text for text, turn in zip(texts, routed) if turn is None]
+    retrieved = dict(zip(todo, retrieval.search_many(todo, k=3, corpora=corpora)))
+
+    def answer(text, routed_turn):
+        try:
+            turn = routed_turn or prepare_turn(text, [], retrieved=retrieved[text], routed=True)
+            if "reply" in turn:
+                return turn["reply"], turn["mode"], []
+            hit = cached_reply(turn)
+            if hit:
+                return hit + (turn["citations"],)
+            with metrics.span("llm"):
+                response = gateway.invoke(llm, turn["prompt"], turn["prompt_tokens"], max_wait=BATCH_QUEUE_WAIT)
+            remember_reply(turn, response.content)
+            return response.content, turn["mode"], turn["citations"]
+        except LLMSaturated as e:
+            return f"Not answered: the tutor is at its rate limit. Retry in {e.retry_after:.0f}s.", "Rate limited", []
+        except Exception as e:
+            print(f"Agent Error: {e}")
+            metrics.record_error("agent")
+            return f"I encountered an error: {str(e)}", "System Crash", []
+
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+    try:
+        # Each call gets its own copy of the context so spans land in the request's trace
+        futures = {pool.submit(contextvars.copy_context().run, answer, text, turn): positions
+                   for text, turn, positions in zip(texts, routed, indexes.values())}
+        for future in as_completed(futures):
+            response, mode, citations = future.result()
+            for index in futures[future]:
+                yield index, response, mode, citations
+    finally:
+        # Client went away mid-batch: drop the questions not started yet
+        pool.shutdown(wait=False, cancel_futures=True)
 
-def agent(user_message, chat_history):
-    api_key = os.getenv("GROQ_API_KEY")
-    if not api_key:
-        return "Error: GROQ_API_KEY not found.", "System Error"
+async def agent_async(user_message, chat_history, memory=None, corpora=None):
+    """asyncio variant of agent(): retrieval runs on the CPU pool, the LLM call is awaited."""
+    llm = get_llm()
+    if llm is None:
+        return "Error: GROQ_API_KEY not found.", "System Error", []
 
     try:
-        llm = ChatGroq(model="llama-3.3-70b-versatile", temperature=0, groq_api_key=api_key)
-        
-        # 1. Router Logic (Strict)
-        # Check against technical keywords. If no match, treat as "General Chat" unless context implies OS.
-        technical_keywords = [
-            "process", "thread", "schedule", "deadlock", "memory", "paging", "kernel", "semaphore", "disk", 
-            "fcfs", "sjf", "round robin", "os", "operating system", "linux", "windows", "cpu", "cache", 
-            "virtual", "file system", "interrupt", "system call", "mutex", "hardware", "software", "code", 
-            "programming", "computer", "server", "client", "network", "boot", "algorithm", "concurrency",
-            "synchronization", "banker", "page", "frame", "segmentation", "io", "driver", "monitor"
-        ]
-        
-        is_technical = any(kw in user_message.lower() for kw in technical_keywords)
-        
-        # GUARDRAIL: Hard Block for non-technical queries that aren't greetings
-        if not is_technical:
-            greetings = ["hi", "hello", "hey", "greetings", "good morning", "start", "help", "who are you"]
-            is_greeting = any(g == user_message.lower().strip() or user_message.lower().startswith(g + " ") for g in greetings)
-            
-            if not is_greeting:
-                return "🚫 **Out of Scope**: I am strictly programmed to answer questions about **Operating Systems** only (e.g., Paging, Scheduling, Deadlocks). I cannot assist with Geography, General Knowledge, or other topics.", "Blocked by Keyword Guardrail"
-
-        context_text = ""
-        mode = "Direct LLM"
-
-        # 2. Retrieval (RAG)
-        if is_technical:
-            vector_store = get_vector_store()
-            if vector_store:
-                print(f"Searching knowledge base for: {user_message}")
-                docs = vector_store.similarity_search(user_message, k=3)
-                context_chunks = [doc.page_content for doc in docs]
-                context_text = "\n\n---\n\n".join(context_chunks)
-                mode = "Router -> RAG (Textbook)"
-        
-        # 3. Construct Prompt
-        history_text = ""
-        recent_history = chat_history[-6:] if chat_history else []
-        for msg in recent_history:
-            role = "User" if msg.get("role") == "user" else "Assistant"
-            history_text += f"{role}: {msg.get('content', '')}\n"
-
-        system_prompt = f"""You are OS Buddy, an expert Operating Systems Tutor based on the Silberschatz textbook.
-        
-        SCOPE:
-        You are a SPECIALIZED Operating Systems Tutor.
-        You MUST ONLY answer questions directly related to Operating Systems (Concepts, Algorithms, Kernels, Memory, Concurrency, etc.).
-        
-        STRICT REFUSAL POLICY:
-        If the user asks about ANYTHING else (including General Python, Web Development, Geography, Biology, Sports, Politics, or General Knowledge), you must politely but FIRMLY REFUSE.
-        
-        Refusal Template: "I am strictly programmed to help with Operating Systems only. I cannot answer questions about [topic]. Please ask me about topics like Paging, Scheduling, or Deadlocks."
-
-        CONTEXT FROM TEXTBOOK:
-        {context_text if context_text else "No specific textbook context found."}
-
-        INSTRUCTIONS:
-        1. If Context is present, USE IT. It contains the exact definitions and steps.
-        2. If the user asks for a diagram (or if the concept *needs* one, e.g., Scheduling, Lifecycle), generate Mermaid.js code.
-        3. Explain strictly but friendly.
-        
-        DIAGRAMMING RULES (CRITICAL):
-        - **FOR FLOWCHARTS (`graph TD`)**:
-            - Use `-->|Label|` for arrows.
-            - IDs must be alphanumeric.
-        - **FOR SEQUENCE DIAGRAMS (`sequenceDiagram`)**:
-            - Use `A->>B: Message` (Colon syntax).
-            - **NEVER** use `-->|Label|` in sequence diagrams.
-            - **NEVER** use `Note over A,B,C` (Max 2 participants like `Note over A,B`).
-        - **GENERAL**:
-            - Strings: ALWAYS double quotes.
-            - No `|>` at end of arrows.
-        
-        Conversation:
-        {history_text}
-        
-        User: {user_message}
-        """
-
-        response = llm.invoke(system_prompt)
-        return response.content, mode
+        loop = asyncio.get_running_loop()
+        # Run in a copy of this task's context so stage spans land in the request's trace
+        turn = await loop.run_in_executor(_cpu_pool, contextvars.copy_context().run,
+                                          partial(prepare_turn, corpora=corpora), user_message, chat_history, memory)
+        if "reply" in turn:
+            return turn["reply"], turn["mode"], []
+
+        hit = cached_reply(turn)
+        if hit:
+            return hit + (turn["citations"],)
+
+        with metrics.span("llm"):
+            response = await gateway.ainvoke(llm, turn["prompt"], turn["prompt_tokens"])
+        remember_reply(turn, response.content)
+        return response.content, turn["mode"], turn["citations"]
+
+    except LLMSaturated:
+        raise
+    except Exception as e:
+        print(f"Agent Error: {e}")
+        metrics.record_error("agent")
+        return f"I encountered an error: {str(e)}", "System Crash", []
+
+async def agent_stream_async(user_message, chat_history, memory=None, corpora=None):
+    """asyncio variant of agent_stream(); yields the same ("mode" | "citations" | "token", value) pairs."""
+    llm = get_llm()
+    if llm is None:
+        yield "mode", "System Error"
+        yield "token", "Error: GROQ_API_KEY not found."
+        return
 
+    try:
+        loop = asyncio.get_running_loop()
+        # Run in a copy of this task's context so stage spans land in the request's trace
+        turn = await loop.run_in_executor(_cpu_pool, contextvars.copy_context().run,
+                                          partial(prepare_turn, corpora=corpora), user_message, chat_history, memory)
     except Exception as e:
         print(f"Agent Error: {e}")
-        return f"I encountered an error: {str(e)}", "System Crash"
+        metrics.record_error("agent")
+        yield "mode", "System Crash"
+        yield "token", f"I encountered an error: {str(e)}"
+        return
+
+    if "reply" in turn:
+        yield "mode", turn["mode"]
+        yield "token", turn["reply"]
+        return
+
+    hit = cached_reply(turn)
+    if hit:
+        yield "mode", hit[1]
+        if turn["citations"]:
+            yield "citations", turn["citations"]
+        yield "token", hit[0]
+        return
+
+    yield "mode", turn["mode"]
+    if turn["citations"]:
+        yield "citations", turn["citations"]
+    try:
+        parts = []
+        with metrics.span("llm"):
+            async for chunk in gateway.astream(llm, turn["prompt"], turn["prompt_tokens"]):
+                if chunk.content:
+                    parts.append(chunk.content)
+                    yield "token", chunk.content
+        remember_reply(turn, "".join(parts))
+    except LLMSaturated:
+        raise
+    except Exception as e:
+        print(f"Agent Stream Error: {e}")
+        metrics.record_error("agent")
+        yield "token", f"\n\nI encountered an error: {str(e)}"
@@ -1,12 +1,18 @@
 import json
+import gzip
 import uuid
 import os
+import math
 import time
 from datetime import datetime, timezone
-from flask import Flask, render_template, request, jsonify
-from agent import agent
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from concurrent.futures import ThreadPoolExecutor
+from agent import agent, agent_stream, agent_batch, summarize_history
 from dotenv import load_dotenv
-from tools.db import MongoDBManager
+from tools.db import MongoDBManager, make_cursor
+from tools import registry, retrieval, prompt_builder, metrics
+from tools.response_cache import response_cache
+from tools.llm_gateway import gateway, LLMSaturated
 
 load_dotenv()
 
@@ -15,6 +21,37 @@ app = Flask(__name__)
 # --- Database ---
 db = MongoDBManager()
 
+SESSIONS_PAGE_SIZE = 50
+SESSIONS_MAX_PAGE_SIZE = 200
+MESSAGES_MAX_PAGE_SIZE = 200
+# Session JSON smaller than this is sent uncompressed
+GZIP_MIN_BYTES = 1024
+# Messages loaded for a chat turn (the prompt only uses the most recent ones)
+HISTORY_MESSAGES = 20
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "200"))
+BUSY_REPLY = "⏳ OS Buddy is answering a lot of questions right now. Please try again in a few seconds."
+
+# --- Metrics (sampled on each /metrics scrape) ---
+metrics.gauge("osbuddy_ready", "1 once the embedding model, index and LLM are loaded",
+              lambda: registry.is_ready())
+metrics.gauge("osbuddy_db_fallback", "1 while sessions are served from the local store",
+              lambda: db.status()["mode"] == "local")
+metrics.gauge("osbuddy_db_breaker_trips", "Times the Mongo circuit breaker has opened", lambda: db.status()["trips"])
+metrics.gauge("osbuddy_db_pending_writes", "Local writes waiting to be replayed to Mongo",
+              lambda: db.status()["pending_writes"])
+metrics.gauge("osbuddy_db_dead_writes", "Queued writes dropped from replay after repeated failures",
+              lambda: db.status()["dead_writes"])
+metrics.gauge("osbuddy_cache_hit_ratio", "Hit ratio per cache", lambda: {
+    "response": response_cache.stats()["hit_rate"],
+    "embedding": retrieval.embedding_cache.stats()["hit_rate"],
+    "search": retrieval.search_cache.stats()["hit_rate"],
+}, label="cache")
+metrics.gauge("osbuddy_cache_entries", "Entries per cache", lambda: {
+    "response": response_cache.stats()["entries"],
+    "embedding": retrieval.embedding_cache.stats()["entries"],
+    "search": retrieval.search_cache.stats()["entries"],
+}, label="cache")
+
 # --- Routes ---
 
 @app.route("/")
@@ -23,14 +60,65 @@ def home():
 
 @app.route("/healthz")
 def health_check():
-    return jsonify({"status": "ok", "message": "I am awake!"})
+    # Always 200 so keep-alive pings work during warm-up; ?ready=1 returns 503 until warm
+    status = registry.status()
+    payload = {"status": "ok", "message": "I am awake!", "ready": status["ready"], "registry": status,
+               "response_cache": response_cache.stats(), "query_cache": retrieval.stats(), "db": db.status(),
+               "llm_gateway": gateway.status()}
+    if request.args.get("ready") and not status["ready"]:
+        return jsonify(payload), 503
+    return jsonify(payload)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
+@app.route("/corpora")
+def corpora():
+    """Courses with a built index; pass one (or a list) as "corpus" to /chat or /sessions/new."""
+    return jsonify({"default": registry.DEFAULT_CORPUS, "corpora": registry.list_corpora()})
 
+def parse_corpora(value):
+    """Validates a request's "corpus" (a name or a list of names). Returns a list, or None if absent."""
+    if value in (None, "", []):
+        return None
+    names = [value] if isinstance(value, str) else value
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError("corpus must be a corpus name or a list of names")
+    available = registry.list_corpora()
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown corpus {', '.join(unknown)}; available: {', '.join(available) or 'none'}")
+    return names
+
+def cacheable_json(payload, headers=None):
+    """
+    JSON response for the session read routes: tagged with a weak ETag so
+    the browser revalidates with If-None-Match and gets a bodiless 304 when
+    nothing changed, and gzipped when the client accepts it.
+    """
+    response = jsonify(payload)
+    for name, value in (headers or {}).items():
+        response.headers[name] = value
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Accept-Encoding")
+    # Weak: the same tag covers the gzipped and plain bodies
+    response.add_etag(weak=True)
+    response.make_conditional(request)
+    if response.status_code == 200 and "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = response.get_data()
+        if len(body) >= GZIP_MIN_BYTES:
+            response.set_data(gzip.compress(body, compresslevel=6))
+            response.headers["Content-Encoding"] = "gzip"
+    return response
 
 @app.route("/sessions", methods=["GET"])
 def get_sessions():
+    """Newest-first page of sessions. The next page's cursor is in X-Next-Cursor."""
     user_id = request.headers.get("X-User-ID")
-    sessions = db.get_sessions(user_id)
+    limit = request.args.get("limit", SESSIONS_PAGE_SIZE, type=int) or SESSIONS_PAGE_SIZE
+    limit = min(max(limit, 1), SESSIONS_MAX_PAGE_SIZE)
+    sessions = db.get_sessions(user_id, limit=limit, cursor=request.args.get("cursor"))
     # Format for frontend
     formatted = []
     for s in sessions:
@@ -39,11 +127,16 @@ def get_sessions():
             "title": s.get("title", "New Chat"),
             "timestamp": s.get("timestamp", 0)
         })
-    return jsonify(formatted)
+    headers = {"X-Next-Cursor": make_cursor(sessions[-1])} if len(sessions) == limit else {}
+    return cacheable_json(formatted, headers)
 
 @app.route("/sessions/new", methods=["POST"])
 def new_session():
     user_id = request.headers.get("X-User-ID")
+    try:
+        corpora = parse_corpora((request.get_json(silent=True) or {}).get("corpus"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     # Create valid empty session
     session_id = str(uuid.uuid4())
     session_data = {
@@ -52,13 +145,26 @@ def new_session():
         "last_active": datetime.now(timezone.utc),
         "messages": []
     }
+    if corpora:
+        session_data["corpus"] = corpora
     db.save_session(session_id, session_data, user_id)
-    return jsonify({"id": session_id})
+    return jsonify({"id": session_id, "title": session_data["title"], "timestamp": session_data["timestamp"]})
 
 @app.route("/sessions/<session_id>", methods=["GET"])
 def get_session_chat(session_id):
-    session = db.get_session(session_id)
-    return jsonify(session)
+    """
+    ?limit=N returns the newest N messages; the index to pass as ?before= for
+    the next older page is in X-Next-Cursor (absent on the first page).
+    Without a limit the whole session is returned (?last=N: its last N messages).
+    """
+    limit = request.args.get("limit", type=int)
+    if limit:
+        session, start = db.get_messages_page(session_id, min(max(limit, 1), MESSAGES_MAX_PAGE_SIZE),
+                                              before=request.args.get("before", type=int))
+        return cacheable_json(session, {"X-Next-Cursor": str(start)} if start > 0 else None)
+    last = request.args.get("last", type=int)
+    session = db.get_session(session_id, last_n=None if last is None else max(last, 1))
+    return cacheable_json(session)
 
 @app.route("/sessions/<session_id>", methods=["DELETE"])
 def delete_session_route(session_id):
@@ -66,8 +172,84 @@ def delete_session_route(session_id):
     success = db.delete_session(session_id, user_id)
     return jsonify({"success": success})
 
+def new_turn(session_data, user_message, corpora=None):
+    """
+    Starts a turn on a loaded session document. No I/O.
+    Returns (chat_history, metadata, memory): the history the agent sees
+    (ending with the user's message), the session fields to update when
+    saving, and the session's rolling summary. metadata["corpus"] is the
+    corpora to search: `corpora` if the request named any (the session keeps
+    them), else the session's own.
+    """
+    metadata = {
+        "timestamp": time.time(),
+        "last_active": datetime.now(timezone.utc),
+    }
+    if corpora or session_data.get("corpus"):
+        metadata["corpus"] = corpora or session_data["corpus"]
+    # Title new chats after their first message
+    if not session_data.get("messages") or session_data.get("title") == "New Chat":
+        metadata["title"] = user_message[:30] + "..."
+
+    chat_history = list(session_data.get("messages", []))
+    chat_history.append({"role": "user", "content": user_message, "ts": time.time()})
+    memory = {"summary": session_data.get("summary"), "summary_through": session_data.get("summary_through")}
+    return chat_history, metadata, memory
+
+def session_entry(session_id, metadata):
+    """The session's sidebar entry after a turn; "title" is None unless this turn set it."""
+    return {"id": session_id, "title": metadata.get("title"), "timestamp": metadata["timestamp"]}
+
+def turn_messages(chat_history, response, citations=None):
+    """The user message (last in chat_history) and the AI reply (with its page citations), as stored."""
+    reply = {"role": "ai", "content": response, "ts": time.time()}
+    if citations:
+        reply["citations"] = citations
+    return [chat_history[-1], reply]
+
+# Rolling summaries are written off the request path
+_summary_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+
+def update_summary(session_id, memory, chat_history):
+    """Folds turns that no longer fit the prompt budget into the session's rolling summary."""
+    to_fold = prompt_builder.messages_to_summarize(chat_history, memory)
+    if not to_fold:
+        return
+    try:
+        summary = summarize_history(memory.get("summary"), to_fold)
+        through = max(msg.get("ts") or 0 for msg in to_fold)
+        # Never upserts: a chat deleted while this ran stays deleted
+        db.set_session_fields(session_id, {"summary": summary, "summary_through": through})
+    except Exception as e:
+        print(f"Summary update failed for {session_id}: {e}")
+
+def schedule_summary(session_id, memory, messages):
+    _summary_pool.submit(update_summary, session_id, memory, messages)
+
+def _start_turn(session_id, user_message, corpora=None):
+    """Loads the session and starts a turn. Returns (chat_history, metadata, memory)."""
+    with metrics.span("session_load"):
+        session_data = db.get_session(session_id, last_n=HISTORY_MESSAGES)
+    return new_turn(session_data, user_message, corpora)
+
+def busy_payload(error):
+    """Response body and Retry-After (whole seconds) for a saturated LLM gateway."""
+    retry_after = max(1, math.ceil(error.retry_after))
+    return {"response": BUSY_REPLY, "thoughts": "Rate limited", "retry_after": retry_after}, retry_after
+
+def _finish_turn(session_id, chat_history, metadata, memory, response, user_id, citations=None):
+    """Appends the user + AI messages to the session (delta write)."""
+    new_messages = turn_messages(chat_history, response, citations)
+    with metrics.span("save"):
+        db.append_messages(session_id, new_messages, metadata, user_id)
+    schedule_summary(session_id, memory, chat_history[:-1] + new_messages)
+
 @app.route("/chat", methods=["POST"])
 def chat():
+    with metrics.trace("/chat"):
+        return _chat()
+
+def _chat():
     import traceback
     try:
         data = request.json
@@ -76,56 +258,149 @@ def chat():
         
         if not user_message:
             return jsonify({"response": "Please enter a message.", "thoughts": "Empty input"})
+        try:
+            corpora = parse_corpora(data.get("corpus"))
+        except ValueError as e:
+            metrics.annotate(status="bad_request")
+            return jsonify({"error": str(e)}), 400
         
         # Generate Session ID if missing
         if not session_id:
             session_id = str(uuid.uuid4())
 
-        # Load Session from DB
-        session_data = db.get_session(session_id)
-        # Load Session from DB
-        session_data = db.get_session(session_id)
-        
-        # Ensure 'time' is available (imported globally or here)
-        # Using global import time is cleaner.
-        
-        if not session_data.get("messages"):
-            session_data = {
-                "title": user_message[:30] + "...",
-                "timestamp": time.time(),
-                "last_active": datetime.now(timezone.utc),
-                "messages": []
-            }
-        
-        session_data["timestamp"] = time.time()
-        session_data["last_active"] = datetime.now(timezone.utc)
-        
-        # Append User Msg
-        session_data["messages"].append({"role": "user", "content": user_message})
+        chat_history, metadata, memory = _start_turn(session_id, user_message, corpora)
         
         # Generate Response
-        response, thought_process = agent(user_message, chat_history=session_data["messages"])
-        
-        # Append AI Msg
-        session_data["messages"].append({"role": "ai", "content": response})
+        response, thought_process, citations = agent(user_message, chat_history=chat_history, memory=memory,
+                                                     corpora=metadata.get("corpus"))
+        metrics.annotate(session_id=session_id, mode=thought_process)
         
-        # Update Title if needed
-        if session_data.get("title") == "New Chat":
-             session_data["title"] = user_message[:30] + "..."
-
-        # Save to MongoDB
-        user_id = request.headers.get("X-User-ID")
-        db.save_session(session_id, session_data, user_id)
+        _finish_turn(session_id, chat_history, metadata, memory, response, request.headers.get("X-User-ID"),
+                     citations)
         
         return jsonify({
             "response": response, 
             "thoughts": thought_process,
-            "session_id": session_id
+            "citations": citations,
+            "session_id": session_id,
+            "session": session_entry(session_id, metadata)
         })
+    except LLMSaturated as e:
+        metrics.annotate(status="saturated")
+        payload, retry_after = busy_payload(e)
+        return jsonify(payload), 503, {"Retry-After": str(retry_after)}
     except Exception as e:
         print(f"CRITICAL ERROR in /chat: {e}")
         traceback.print_exc()
+        metrics.record_error("chat")
         return jsonify({"response": f"System Error: {str(e)}", "thoughts": "Backend Crash"})
 
+def _sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Server-Sent Events variant of /chat. Emits a "meta" event (session id and
+    thought process), a "citations" event when the answer draws on the
+    textbook ({"citations": [{"source", "section", "pages"}]}), one "token"
+    event per LLM chunk and a final "done" event (with the session's sidebar
+    entry) once the full message has been saved.
+    """
+    data = request.json or {}
+    user_message = data.get("message", "")
+    session_id = data.get("session_id") or str(uuid.uuid4())
+    user_id = request.headers.get("X-User-ID")
+
+    if not user_message:
+        return jsonify({"response": "Please enter a message.", "thoughts": "Empty input"})
+    try:
+        corpora = parse_corpora(data.get("corpus"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        import traceback
+        parts, citations = [], []
+        # Traced here, not in the view: the work happens while the response streams
+        with metrics.trace("/chat/stream"):
+            try:
+                chat_history, metadata, memory = _start_turn(session_id, user_message, corpora)
+                for kind, value in agent_stream(user_message, chat_history=chat_history, memory=memory,
+                                                corpora=metadata.get("corpus")):
+                    if kind == "mode":
+                        metrics.annotate(session_id=session_id, mode=value)
+                        yield _sse("meta", {"session_id": session_id, "thoughts": value})
+                    elif kind == "citations":
+                        citations = value
+                        yield _sse("citations", {"citations": value})
+                    else:
+                        parts.append(value)
+                        yield _sse("token", {"text": value})
+                _finish_turn(session_id, chat_history, metadata, memory, "".join(parts), user_id, citations)
+                yield _sse("done", {"session_id": session_id, "session": session_entry(session_id, metadata)})
+            except LLMSaturated as e:
+                # Headers are already sent, so the 503 travels as an error event
+                metrics.annotate(status="saturated")
+                yield _sse("error", busy_payload(e)[0])
+            except Exception as e:
+                print(f"CRITICAL ERROR in /chat/stream: {e}")
+                traceback.print_exc()
+                metrics.record_error("chat")
+                yield _sse("error", {"response": f"System Error: {str(e)}"})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """
+    Answers a list of standalone questions ({"questions": [...]}, optionally
+    "corpus"), e.g. a quiz. Streams NDJSON: one {"index", "question", "response", "thoughts", "citations"} line per
+    answer as it finishes, then {"done": true, "count": n}. Nothing is saved
+    to a session.
+    """
+    data = request.json or {}
+    questions = data.get("questions")
+    if not isinstance(questions, list) or not questions or \
+            not all(isinstance(question, str) and question.strip() for question in questions):
+        return jsonify({"error": "questions must be a non-empty list of strings"}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"At most {BATCH_MAX_QUESTIONS} questions per batch"}), 400
+    try:
+        corpora = parse_corpora(data.get("corpus"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        import traceback
+        with metrics.trace("/chat/batch"):
+            metrics.annotate(questions=len(questions))
+            try:
+                for index, response, thoughts, citations in agent_batch(questions, corpora=corpora):
+                    yield json.dumps({"index": index, "question": questions[index],
+                                      "response": response, "thoughts": thoughts, "citations": citations}) + "\n"
+                yield json.dumps({"done": True, "count": len(questions)}) + "\n"
+            except Exception as e:
+                print(f"CRITICAL ERROR in /chat/batch: {e}")
+                traceback.print_exc()
+                metrics.record_error("chat")
+                yield json.dumps({"error": f"System Error: {str(e)}"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the OS Buddy development server.")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Report per-module import cost and time to ready, then exit")
+    args = parser.parse_args()
+    if args.profile_startup:
+        from tools import startup_profile
+        startup_profile.main([])
+    else:
+        app.run(debug=True, port=5000)
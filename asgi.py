@@ -0,0 +1,183 @@
+import os
+import json
+import uuid
+import asyncio
+import traceback
+from asgiref.wsgi import WsgiToAsgi
+from app import app as flask_app, db, new_turn, turn_messages, session_entry, schedule_summary, busy_payload, \
+    parse_corpora, HISTORY_MESSAGES
+from agent import agent_async, agent_stream_async
+from tools.db import AsyncMongoDBManager
+from tools import registry, metrics
+from tools.llm_gateway import LLMSaturated
+
+# Async serving mode. /chat and /chat/stream are handled natively on the event
+# loop (LLM awaited via ainvoke/astream, Mongo via motor, embedding + FAISS on a
+# bounded thread pool) so one process holds many in-flight conversations.
+# Every other route is served by the regular Flask app through WsgiToAsgi.
+#
+# Run with:  gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+#      or:   uvicorn asgi:app --port 5000
+
+# Max conversations waiting on the LLM at once per process; extra requests queue
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", "64"))
+
+wsgi_app = WsgiToAsgi(flask_app)
+adb = AsyncMongoDBManager(db)
+_chat_slots = asyncio.Semaphore(CHAT_CONCURRENCY)
+
+async def read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        return json.loads(body or b"{}")
+    except ValueError:
+        return {}
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                    *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def header(scope, name):
+    for key, value in scope.get("headers", []):
+        if key.decode("latin-1").lower() == name.lower():
+            return value.decode("latin-1")
+    return None
+
+def _sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode()
+
+async def chat(scope, receive, send):
+    with metrics.trace("/chat"):
+        await _chat(scope, receive, send)
+
+async def _chat(scope, receive, send):
+    try:
+        data = await read_json(receive)
+        user_message = data.get("message", "")
+        session_id = data.get("session_id") or str(uuid.uuid4())
+
+        if not user_message:
+            return await send_json(send, {"response": "Please enter a message.", "thoughts": "Empty input"})
+        try:
+            corpora = parse_corpora(data.get("corpus"))
+        except ValueError as e:
+            metrics.annotate(status="bad_request")
+            return await send_json(send, {"error": str(e)}, 400)
+
+        async with _chat_slots:
+            with metrics.span("session_load"):
+                session_data = await adb.get_session(session_id, last_n=HISTORY_MESSAGES)
+            chat_history, metadata, memory = new_turn(session_data, user_message, corpora)
+            response, thought_process, citations = await agent_async(
+                user_message, chat_history=chat_history, memory=memory, corpora=metadata.get("corpus"))
+            metrics.annotate(session_id=session_id, mode=thought_process)
+            new_messages = turn_messages(chat_history, response, citations)
+            with metrics.span("save"):
+                await adb.append_messages(session_id, new_messages, metadata, header(scope, "X-User-ID"))
+            schedule_summary(session_id, memory, chat_history[:-1] + new_messages)
+
+        await send_json(send, {"response": response, "thoughts": thought_process, "citations": citations,
+                               "session_id": session_id, "session": session_entry(session_id, metadata)})
+    except LLMSaturated as e:
+        metrics.annotate(status="saturated")
+        payload, retry_after = busy_payload(e)
+        await send_json(send, payload, 503, [(b"retry-after", str(retry_after).encode())])
+    except Exception as e:
+        print(f"CRITICAL ERROR in /chat: {e}")
+        traceback.print_exc()
+        metrics.record_error("chat")
+        await send_json(send, {"response": f"System Error: {str(e)}", "thoughts": "Backend Crash"})
+
+async def chat_stream(scope, receive, send):
+    with metrics.trace("/chat/stream"):
+        await _chat_stream(scope, receive, send)
+
+async def _chat_stream(scope, receive, send):
+    data = await read_json(receive)
+    user_message = data.get("message", "")
+    session_id = data.get("session_id") or str(uuid.uuid4())
+
+    if not user_message:
+        return await send_json(send, {"response": "Please enter a message.", "thoughts": "Empty input"})
+    try:
+        corpora = parse_corpora(data.get("corpus"))
+    except ValueError as e:
+        metrics.annotate(status="bad_request")
+        return await send_json(send, {"error": str(e)}, 400)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")],
+    })
+
+    async def emit(event, payload):
+        await send({"type": "http.response.body", "body": _sse(event, payload), "more_body": True})
+
+    try:
+        async with _chat_slots:
+            parts, citations = [], []
+            with metrics.span("session_load"):
+                session_data = await adb.get_session(session_id, last_n=HISTORY_MESSAGES)
+            chat_history, metadata, memory = new_turn(session_data, user_message, corpora)
+            async for kind, value in agent_stream_async(user_message, chat_history=chat_history, memory=memory,
+                                                        corpora=metadata.get("corpus")):
+                if kind == "mode":
+                    metrics.annotate(session_id=session_id, mode=value)
+                    await emit("meta", {"session_id": session_id, "thoughts": value})
+                elif kind == "citations":
+                    citations = value
+                    await emit("citations", {"citations": value})
+                else:
+                    parts.append(value)
+                    await emit("token", {"text": value})
+            response = "".join(parts)
+            new_messages = turn_messages(chat_history, response, citations)
+            with metrics.span("save"):
+                await adb.append_messages(session_id, new_messages, metadata, header(scope, "X-User-ID"))
+            schedule_summary(session_id, memory, chat_history[:-1] + new_messages)
+        await emit("done", {"session_id": session_id, "session": session_entry(session_id, metadata)})
+    except LLMSaturated as e:
+        metrics.annotate(status="saturated")
+        await emit("error", busy_payload(e)[0])
+    except Exception as e:
+        print(f"CRITICAL ERROR in /chat/stream: {e}")
+        traceback.print_exc()
+        metrics.record_error("chat")
+        await emit("error", {"response": f"System Error: {str(e)}"})
+    await send({"type": "http.response.body", "body": b""})
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Warm in the background so the worker starts accepting connections immediately
+            asyncio.get_running_loop().run_in_executor(None, registry.warm)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+ROUTES = {
+    ("POST", "/chat"): chat,
+    ("POST", "/chat/stream"): chat_stream,
+}
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(scope, receive, send)
+    handler = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler:
+        return await handler(scope, receive, send)
+    return await wsgi_app(scope, receive, send)
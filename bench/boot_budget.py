@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+
+# Boot-time regression check. Profiles the app's startup in fresh processes
+# (see tools/startup_profile.py) and exits 1 if `import app` pulls in a heavy
+# module eagerly, if the import takes longer than --import-budget-s, or if a
+# worker takes longer than --ready-budget-s from spawn to ready (embedding
+# model, default index, LLM client and router centroids loaded). With
+# --baseline, times are also compared against a previous --json run. Each
+# phase is measured --runs times and the median is used.
+#
+#   python bench/boot_budget.py --json bench/results/boot.json
+#   python bench/boot_budget.py --baseline bench/results/boot.json --import-only
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from tools import startup_profile
+
+def measure(module, runs, ready):
+    imports, readies = [], []
+    for _ in range(runs):
+        result = startup_profile.profile(module, ready=ready)
+        imports.append(result)
+        if ready:
+            readies.append(result["ready"]["time_to_ready_s"])
+    last = imports[-1]
+    return {
+        "module": module,
+        "runs": runs,
+        "import_s": round(statistics.median(r["import"]["total_s"] for r in imports), 3),
+        "time_to_ready_s": round(statistics.median(readies), 3) if readies else None,
+        "ready": last["ready"]["ready"] if ready else None,
+        "eager_heavy": last["eager_heavy"],
+        "top_packages": last["import"]["packages"][:10],
+    }
+
+def check(results, args, baseline=None):
+    """Returns human-readable budget violations."""
+    failures = [f"`import {results['module']}` loads {name} eagerly" for name in results["eager_heavy"]]
+    if results["import_s"] > args.import_budget_s:
+        failures.append(f"import: {results['import_s']}s > budget {args.import_budget_s}s")
+    ready_s = results["time_to_ready_s"]
+    if ready_s is not None and ready_s > args.ready_budget_s:
+        failures.append(f"time to ready: {ready_s}s > budget {args.ready_budget_s}s")
+    for key in ("import_s", "time_to_ready_s"):
+        before, after = (baseline or {}).get(key), results[key]
+        if before and after is not None and after > before * (1 + args.tolerance):
+            failures.append(f"{key}: {before} -> {after} s (baseline)")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail if the app's import or boot time is over budget.")
+    parser.add_argument("--module", default="app", help="Module a worker imports (app or asgi)")
+    parser.add_argument("--import-budget-s", type=float, default=1.5)
+    parser.add_argument("--ready-budget-s", type=float, default=30.0)
+    parser.add_argument("--import-only", action="store_true", help="Skip the warm-up (no models needed)")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Previous --json output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression vs baseline")
+    args = parser.parse_args()
+
+    results = measure(args.module, max(1, args.runs), ready=not args.import_only)
+    for key in ("import_s", "time_to_ready_s", "ready", "eager_heavy"):
+        print(f"{key:>16}: {results[key]}")
+    for name, seconds in results["top_packages"]:
+        print(f"{name:>28}: {seconds * 1000:.1f} ms")
+
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    failures = check(results, args, baseline)
+    for line in failures:
+        print(f"FAIL {line}")
+    if failures:
+        sys.exit(1)
+    print("\nBoot within budget.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+# End-to-end benchmark that needs no Groq key and no MongoDB. It builds a
+# synthetic PDF corpus, times ingestion, serves the real Flask app in-process
+# with FakeLLM installed in the registry and sessions on the local SQLite
+# store, then drives /chat, /sessions and /sessions/<id> at each concurrency
+# level. The LLM gateway's rate limits are lifted unless --rate-limits is
+# given. Results are written as JSON; with --baseline, a p95 or RPS regression
+# beyond --tolerance exits 1. The embedding model is the real one (download
+# it once, or use EMBEDDING_BACKEND=onnx).
+#
+#   python bench/e2e.py --levels 1,4,16 --duration 10 --json bench/results/e2e.json
+#   python bench/e2e.py --baseline bench/results/e2e.json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from loadtest import QUESTIONS, percentile
+
+TOPICS = {
+    "Processes": ["A process is a program in execution with its own address space.",
+                  "The process control block stores the state, program counter and registers.",
+                  "fork() creates a child process that is a copy of the parent."],
+    "Scheduling": ["Round robin gives each ready process a fixed time quantum.",
+                   "Shortest job first minimizes average waiting time but needs burst estimates.",
+                   "The dispatcher performs the context switch to the selected process."],
+    "Deadlocks": ["Deadlock requires mutual exclusion, hold and wait, no preemption and circular wait.",
+                  "The Banker's algorithm grants a request only if the resulting state is safe.",
+                  "A resource allocation graph with a cycle may indicate deadlock."],
+    "Memory": ["Paging maps fixed-size pages to frames through a page table.",
+               "The TLB caches page table entries to speed up address translation.",
+               "Thrashing happens when processes spend more time paging than executing."],
+    "Synchronization": ["A semaphore is an integer accessed only through wait() and signal().",
+                        "A critical section must satisfy mutual exclusion, progress and bounded waiting.",
+                        "Monitors bundle shared data with the procedures that operate on it."],
+}
+
+def make_corpus(data_dir, documents, pages, seed=0):
+    """Writes `documents` PDFs of `pages` pages of OS-flavoured text. Returns the page count."""
+    import pymupdf
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for number in range(documents):
+        doc = pymupdf.open()
+        for page_number in range(pages):
+            topic = rng.choice(sorted(TOPICS))
+            lines = [rng.choice(TOPICS[topic]) for _ in range(40)]
+            page = doc.new_page()
+            # A larger font, so pymupdf4llm's header detection renders it as a heading
+            page.insert_text((40, 60), f"{topic} ({number}.{page_number})", fontsize=16)
+            page.insert_textbox(pymupdf.Rect(40, 80, 555, 800), "\n".join(lines), fontsize=9)
+        doc.save(os.path.join(data_dir, f"synthetic_{number:03d}.pdf"))
+        doc.close()
+    return documents * pages
+
+def serve(flask_app):
+    """Runs the app on a free local port in a background thread. Returns its base URL."""
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+async def user_loop(client, url, scenario, deadline, latencies, errors, user_index):
+    user_id = f"bench_{user_index}"
+    session_id = None
+    i = user_index
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if scenario == "chat" or session_id is None:
+                payload = {"message": QUESTIONS[i % len(QUESTIONS)], "session_id": session_id}
+                response = await client.post(f"{url}/chat", json=payload, headers={"X-User-ID": user_id})
+                response.raise_for_status()
+                session_id = response.json().get("session_id")
+                if scenario != "chat":
+                    continue  # setup request, not measured
+            elif scenario == "sessions":
+                (await client.get(f"{url}/sessions", headers={"X-User-ID": user_id})).raise_for_status()
+            else:
+                (await client.get(f"{url}/sessions/{session_id}")).raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+        except Exception:
+            errors.append(1)
+        i += 1
+
+async def run_level(url, scenario, concurrency, duration):
+    import httpx
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(user_loop(client, url, scenario, deadline, latencies, errors, i)
+                               for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+    }
+
+def compare(results, baseline, tolerance):
+    """Returns human-readable regressions of results vs a previous run."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline.get("levels", [])}
+    regressions = []
+    for result in results["levels"]:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if not before:
+            continue
+        label = f"{result['scenario']} @ {result['concurrency']}"
+        if before["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if before["rps"] and result["rps"] < before["rps"] * (1 - tolerance):
+            regressions.append(f"{label}: {before['rps']} -> {result['rps']} req/s")
+    before, after = baseline.get("ingest", {}), results["ingest"]
+    if before.get("seconds") and after["seconds"] > before["seconds"] * (1 + tolerance):
+        regressions.append(f"ingest: {before['seconds']} -> {after['seconds']} s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of ingestion, /chat and /sessions.")
+    parser.add_argument("--levels", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario and level")
+    parser.add_argument("--scenarios", default="chat,sessions,session", help="Subset of chat, sessions, session")
+    parser.add_argument("--documents", type=int, default=4, help="Synthetic PDFs")
+    parser.add_argument("--pages", type=int, default=25, help="Pages per synthetic PDF")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Fake LLM seconds to first token")
+    parser.add_argument("--llm-token-rate", type=float, default=200.0, help="Fake LLM tokens/second")
+    parser.add_argument("--llm-tokens", type=int, default=150, help="Fake LLM reply length in tokens")
+    parser.add_argument("--response-cache", action="store_true", help="Leave the semantic answer cache on")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Keep the production LLM_RPM/LLM_TPM limits (measures the gateway, not the app)")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Previous --json output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression vs baseline")
+    args = parser.parse_args()
+
+    args.json = args.json and os.path.abspath(args.json)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+
+    # Everything the app writes lives in a scratch directory; settings are read at import
+    workdir = tempfile.mkdtemp(prefix="osbuddy-bench-")
+    os.environ.update({
+        "FAISS_INDEX_PATH": os.path.join(workdir, "faiss_index"),
+        "INGEST_DATA_DIR": os.path.join(workdir, "data"),
+        "LOCAL_DB_PATH": os.path.join(workdir, "chat_history.db"),
+        "MONGO_URI": "",
+        "LOG_REQUESTS": "0",
+        "RESPONSE_CACHE_ENABLED": "1" if args.response_cache else "0",
+    })
+    if not args.rate_limits:
+        # The fake LLM has no provider limits; with Groq's, most requests would be 503s
+        os.environ.update({"LLM_RPM": "1000000", "LLM_TPM": "1000000000", "LLM_QUEUE_WAIT": "60",
+                           "WEB_CONCURRENCY": "1"})
+    os.chdir(workdir)
+
+    from tools import registry
+    from tools.ingest import ingest
+    from fake_llm import FakeLLM
+
+    pages = make_corpus(os.environ["INGEST_DATA_DIR"], args.documents, args.pages)
+    start = time.perf_counter()
+    manifest = ingest(rebuild=True)
+    ingest_s = time.perf_counter() - start
+    chunks = sum(len(entry["chunk_ids"]) for entry in manifest["files"].values())
+    print(f"Ingested {pages} pages / {chunks} chunks in {ingest_s:.1f}s ({pages / ingest_s:.1f} pages/s)")
+
+    llm = FakeLLM(args.llm_latency, args.llm_token_rate, args.llm_tokens)
+    registry.provide("llm", llm)
+    registry.provide("summary_llm", llm)
+    registry.warm()
+
+    from app import app as flask_app
+    url = serve(flask_app)
+
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+        "ingest": {"pages": pages, "chunks": chunks, "seconds": round(ingest_s, 2),
+                   "pages_per_s": round(pages / ingest_s, 2)},
+        "levels": [],
+    }
+    print(f"\n{'scenario':>9} {'conc':>5} {'reqs':>6} {'err':>4} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for scenario in args.scenarios.split(","):
+        for concurrency in (int(level) for level in args.levels.split(",")):
+            result = asyncio.run(run_level(url, scenario, concurrency, args.duration))
+            results["levels"].append(result)
+            print(f"{scenario:>9} {concurrency:>5} {result['requests']:>6} {result['errors']:>4} {result['rps']:>8} "
+                  f"{result['p50_ms']:>8} {result['p95_ms']:>8} {result['p99_ms']:>8}")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json), exist_ok=True)
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.tolerance:.0%} of {args.baseline}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Compares embedding backends (EMBEDDING_BACKEND=torch|onnx) on import time,
+# model load time, RSS and single-query / batch throughput, and checks the
+# ONNX vectors against torch. Each backend runs in a fresh interpreter so
+# import cost and RSS are not shared. Exits 1 if any sentence's cosine
+# similarity falls below --min-cosine.
+#
+#   python bench/embedding_backends.py --backends torch,onnx --min-cosine 0.99
+
+SENTENCES = [
+    "What is paging?",
+    "Explain the difference between a process and a thread.",
+    "How does the Banker's algorithm avoid deadlock?",
+    "What is a TLB shootdown and when does the kernel need one?",
+    "Compare FCFS and round robin CPU scheduling.",
+    "A semaphore is an integer variable accessed only through two atomic operations, wait() and signal().",
+    "Thrashing occurs when a process spends more time paging than executing.",
+    "The dispatcher gives control of the CPU to the process selected by the short-term scheduler.",
+]
+
+def child(backend, model_name, seconds):
+    from tools import registry
+    start = time.perf_counter()
+    if backend == "onnx":
+        import onnxruntime, tokenizers  # noqa: F401
+    else:
+        import sentence_transformers, langchain_huggingface  # noqa: F401
+    import_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings = registry.make_embeddings(model_name, backend=backend)
+    embeddings.embed_query("warm up")
+    load_s = time.perf_counter() - start
+
+    vectors = embeddings.embed_documents(SENTENCES)
+    queries, deadline = 0, time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        embeddings.embed_query(SENTENCES[queries % len(SENTENCES)])
+        queries += 1
+    start = time.perf_counter()
+    embeddings.embed_documents(SENTENCES * 8)
+    batch_s = time.perf_counter() - start
+
+    print(json.dumps({
+        "backend": backend,
+        "import_s": round(import_s, 3),
+        "load_s": round(load_s, 3),
+        "query_qps": round(queries / seconds, 1),
+        "batch_docs_per_s": round(len(SENTENCES) * 8 / batch_s, 1),
+        # ru_maxrss is reported in KiB on Linux
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "vectors": vectors,
+    }))
+
+def run(backend, model_name, seconds, quantized):
+    env = dict(os.environ, ONNX_QUANTIZED="1" if quantized else "0")
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", backend, "--model", model_name, "--seconds", str(seconds)],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark embedding backends and check they agree.")
+    parser.add_argument("--backends", default="torch,onnx")
+    parser.add_argument("--model", default=None, help="Defaults to the index's embedding model")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Duration of the single-query loop")
+    parser.add_argument("--quantized", action="store_true", help="Use the int8 ONNX model")
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="Lowest acceptable per-sentence cosine vs the first backend")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.model is None:
+        from tools import registry
+        args.model = registry.embedding_model_name()
+    if args.child:
+        child(args.child, args.model, args.seconds)
+        return
+
+    results = [run(backend, args.model, args.seconds, args.quantized) for backend in args.backends.split(",")]
+    baseline = np.asarray(results[0]["vectors"])
+    failed = False
+    print(f"{'backend':>8} {'import s':>9} {'load s':>7} {'rss MB':>7} {'query/s':>8} {'docs/s':>7} {'min cos':>8}")
+    for result in results:
+        vectors = np.asarray(result.pop("vectors"))
+        cosines = (vectors * baseline).sum(axis=1) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(baseline, axis=1))
+        result["min_cosine"] = round(float(cosines.min()), 5)
+        failed |= result["min_cosine"] < args.min_cosine
+        print(f"{result['backend']:>8} {result['import_s']:>9} {result['load_s']:>7} {result['max_rss_mb']:>7} "
+              f"{result['query_qps']:>8} {result['batch_docs_per_s']:>7} {result['min_cosine']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"model": args.model, "quantized": args.quantized, "results": results}, f, indent=2)
+    if failed:
+        print(f"\nFAIL: a backend disagrees with {results[0]['backend']} (cosine < {args.min_cosine})")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
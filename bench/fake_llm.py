@@ -0,0 +1,46 @@
+import time
+import asyncio
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+# Stand-in for ChatGroq in benchmarks: same invoke/stream/ainvoke/astream
+# surface, no network. Waits `latency` seconds before the first token, then
+# emits `tokens` tokens at `token_rate` tokens/second. Install it with
+# registry.provide("llm", FakeLLM(...)).
+
+REPLY = ("Paging splits logical memory into fixed-size pages and physical memory into frames of the same size. "
+         "The page table maps each page number to a frame, and the TLB caches recent translations so most "
+         "accesses avoid the extra memory reference. ")
+
+class FakeLLM:
+    def __init__(self, latency=0.3, token_rate=200.0, tokens=150):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.words = (REPLY.split() * (tokens // len(REPLY.split()) + 1))[:tokens]
+        self.calls = 0
+
+    def _pause(self, count):
+        return count / self.token_rate if self.token_rate > 0 else 0.0
+
+    def invoke(self, prompt):
+        self.calls += 1
+        time.sleep(self.latency + self._pause(len(self.words)))
+        return AIMessage(content=" ".join(self.words))
+
+    def stream(self, prompt):
+        self.calls += 1
+        time.sleep(self.latency)
+        for word in self.words:
+            time.sleep(self._pause(1))
+            yield AIMessageChunk(content=word + " ")
+
+    async def ainvoke(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.latency + self._pause(len(self.words)))
+        return AIMessage(content=" ".join(self.words))
+
+    async def astream(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        for word in self.words:
+            await asyncio.sleep(self._pause(1))
+            yield AIMessageChunk(content=word + " ")
@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+
+# Exercises the corpus index pool: builds several synthetic corpora, then runs
+# queries against them with a skewed (Zipf-like) popularity, so a few courses
+# stay hot while the rest are loaded and evicted under INDEX_POOL_MAX_MB. It
+# reports cold (load) vs warm search latency, loads, evictions, the pool's
+# estimated size and RSS, plus one fan-out query across every corpus. Exits 1
+# if the pool ever holds more than its cap (beyond the one shard it always keeps).
+#
+#   python bench/index_pool.py --corpora 6 --max-mb 2 --queries 300
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from loadtest import QUESTIONS, percentile
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading, eviction and fan-out of the corpus index pool.")
+    parser.add_argument("--corpora", type=int, default=6, help="Synthetic corpora besides the default one")
+    parser.add_argument("--documents", type=int, default=2, help="Synthetic PDFs per corpus")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per synthetic PDF")
+    parser.add_argument("--max-mb", type=float, default=2.0, help="INDEX_POOL_MAX_MB for the run")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--skew", type=float, default=1.2, help="Zipf exponent of corpus popularity")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+    args.json = args.json and os.path.abspath(args.json)
+
+    workdir = tempfile.mkdtemp(prefix="osbuddy-pool-")
+    os.environ.update({
+        "FAISS_INDEX_PATH": os.path.join(workdir, "faiss_index"),
+        "INGEST_DATA_DIR": os.path.join(workdir, "data"),
+        "INDEX_POOL_MAX_MB": str(args.max_mb),
+        "QUERY_CACHE_SIZE": "0",  # every query really searches
+    })
+    os.chdir(workdir)
+
+    from e2e import make_corpus
+    from tools import registry, retrieval
+    from tools.ingest import ingest_all
+    from tools.index_pool import pool
+
+    make_corpus(registry.DATA_DIR, args.documents, args.pages)
+    for number in range(args.corpora):
+        make_corpus(os.path.join(registry.DATA_DIR, f"course{number}"), args.documents, args.pages, seed=number + 1)
+    start = time.perf_counter()
+    ingest_all(rebuild=True)
+    print(f"Ingested {args.corpora + 1} corpora in {time.perf_counter() - start:.1f}s")
+
+    registry.get_embeddings()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    corpora = registry.list_corpora()
+    weights = [1 / (rank + 1) ** args.skew for rank in range(len(corpora))]
+    rng = random.Random(0)
+    cold, warm, overflow = [], [], 0.0
+    for i in range(args.queries):
+        corpus = rng.choices(corpora, weights)[0]
+        loads = pool.loads
+        start = time.perf_counter()
+        retrieval.search(QUESTIONS[i % len(QUESTIONS)], k=3, corpora=[corpus])
+        elapsed = (time.perf_counter() - start) * 1000
+        (cold if pool.loads > loads else warm).append(elapsed)
+        status = pool.status()
+        largest = max((shard["size_mb"] for shard in status["shards"].values()), default=0.0)
+        overflow = max(overflow, status["used_mb"] - max(args.max_mb, largest))
+
+    start = time.perf_counter()
+    _, hits = retrieval.search(QUESTIONS[0], k=5, corpora=corpora)
+    fan_out_ms = (time.perf_counter() - start) * 1000
+
+    status = pool.status()
+    results = {
+        "corpora": len(corpora),
+        "max_mb": args.max_mb,
+        "queries": args.queries,
+        "loads": status["loads"],
+        "evictions": status["evictions"],
+        "used_mb": status["used_mb"],
+        "cold_p50_ms": round(percentile(cold, 50), 1),
+        "warm_p50_ms": round(percentile(warm, 50), 1),
+        "warm_p95_ms": round(percentile(warm, 95), 1),
+        "fan_out_ms": round(fan_out_ms, 1),
+        "fan_out_hits": len(hits),
+        # ru_maxrss is reported in KiB on Linux
+        "rss_growth_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss_before, 1),
+        "overflow_mb": round(overflow, 1),
+    }
+    for key, value in results.items():
+        print(f"{key:>14}: {value}")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json), exist_ok=True)
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if overflow > 0:
+        print(f"\nFAIL: pool went {overflow:.1f} MB over its {args.max_mb:g} MB cap")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import statistics
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import registry
+from tools.ingest import INDEX_TYPES, IVF_NLIST, PQ_M, TRAIN_SIZE, index_options, factory_string
+
+# Recall@k / latency / size report for the FAISS layouts tools/ingest.py can
+# build, measured on the chunks of the current index against exact flat search.
+# Queries are the opening of randomly sampled chunks, embedded with the
+# index's model.
+#
+#   python bench/index_recall.py --k 3 --queries 200 --nprobe 1,4,16,64
+
+def load_corpus(corpus=None):
+    """Returns (texts, vectors) for every chunk in the corpus's current index."""
+    import faiss
+    index_path = registry.corpus_index_path(corpus)
+    index = faiss.read_index(os.path.join(index_path, "index.faiss"))
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    texts = [docstore.search(index_to_docstore_id[i]).page_content for i in range(index.ntotal)]
+    if (registry.get_manifest(corpus) or {}).get("index_factory", "Flat") == "Flat":
+        return texts, index.reconstruct_n(0, index.ntotal)
+    # Quantized codes only approximate the vectors; re-embed for the baseline
+    print(f"Re-embedding {len(texts)} chunks for the exact baseline...")
+    embeddings = registry.make_embeddings(registry.embedding_model_name())
+    return texts, np.asarray(embeddings.embed_documents(texts), dtype="float32")
+
+def build(factory, vectors, train_size):
+    import faiss
+    index = faiss.index_factory(vectors.shape[1], factory)
+    if not index.is_trained:
+        index.train(vectors[:train_size])
+    index.add(vectors)
+    return index
+
+def measure(index, queries, truth, k):
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        _, positions = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(positions[0]) & set(expected))
+    latencies.sort()
+    return {
+        "recall": round(hits / (len(queries) * k), 4),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 3),
+    }
+
+def size_mb(index):
+    import faiss
+    return round(faiss.serialize_index(index).size / (1 << 20), 2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FAISS index layouts against exact search.")
+    parser.add_argument("--corpus", default=None, help="Corpus to measure (default: the default corpus)")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200, help="Chunks sampled as queries")
+    parser.add_argument("--types", default="flat,sq8,fp16,ivfpq", help=f"Layouts from {', '.join(INDEX_TYPES)}")
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST)
+    parser.add_argument("--m", type=int, default=PQ_M)
+    parser.add_argument("--nprobe", default="1,4,16,64", help="nprobe values swept for IVF layouts")
+    parser.add_argument("--threads", type=int, default=1, help="FAISS OpenMP threads (1 = per-request latency)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    import faiss
+    faiss.omp_set_num_threads(args.threads)
+    texts, vectors = load_corpus(args.corpus)
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(texts), size=min(args.queries, len(texts)), replace=False)
+    embeddings = registry.make_embeddings(registry.embedding_model_name())
+    queries = np.asarray(embeddings.embed_documents([texts[i][:300] for i in sample]), dtype="float32")
+
+    exact = build("Flat", vectors, 0)
+    _, truth = exact.search(queries, args.k)
+    train_size = min(TRAIN_SIZE, len(vectors))
+
+    rows = []
+    for index_type in args.types.split(","):
+        factory = factory_string(index_options(index_type, args.nlist, args.m), train_size)
+        start = time.perf_counter()
+        index = build(factory, vectors, train_size)
+        build_s = round(time.perf_counter() - start, 2)
+        nprobes = [int(n) for n in args.nprobe.split(",")] if factory.startswith("IVF") else [None]
+        for nprobe in nprobes:
+            if nprobe is not None:
+                faiss.extract_index_ivf(index).nprobe = nprobe
+            row = {"type": index_type, "factory": factory, "nprobe": nprobe,
+                   "size_mb": size_mb(index), "build_s": build_s}
+            row.update(measure(index, queries, truth, args.k))
+            rows.append(row)
+
+    print(f"\n{len(vectors)} vectors x {vectors.shape[1]} dims, {len(queries)} queries, recall@{args.k} vs exact flat")
+    print(f"{'type':>6} {'factory':>16} {'nprobe':>6} {'size MB':>8} {'build s':>8} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for row in rows:
+        print(f"{row['type']:>6} {row['factory']:>16} {str(row['nprobe'] or '-'):>6} {row['size_mb']:>8} "
+              f"{row['build_s']:>8} {row['recall']:>7} {row['p50_ms']:>8} {row['p95_ms']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"k": args.k, "vectors": len(vectors), "queries": len(queries), "results": rows}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import sys
+import time
+import json
+import asyncio
+import argparse
+import statistics
+import httpx
+
+# Closed-loop load test for /chat. Steps through increasing concurrency levels
+# and reports requests/sec and latency percentiles at each; the summary is the
+# best throughput achieved while p95 stayed under --p95-ms.
+#
+#   python bench/loadtest.py --url http://localhost:5000 --levels 1,4,16,64 --p95-ms 3000
+
+QUESTIONS = [
+    "What is paging?",
+    "Explain the difference between a process and a thread.",
+    "How does the Banker's algorithm avoid deadlock?",
+    "What is a TLB and why does it matter for memory access time?",
+    "Compare FCFS and round robin CPU scheduling.",
+    "What does a semaphore protect against?",
+]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def user_loop(client, url, deadline, latencies, errors, user_index):
+    i = user_index
+    while time.perf_counter() < deadline:
+        payload = {"message": QUESTIONS[i % len(QUESTIONS)], "session_id": None}
+        start = time.perf_counter()
+        try:
+            response = await client.post(f"{url}/chat", json=payload, headers={"X-User-ID": f"load_{user_index}"})
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+        except Exception:
+            errors.append(1)
+        i += 1
+
+async def run_level(url, concurrency, duration):
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(user_loop(client, url, deadline, latencies, errors, u) for u in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "mean_ms": round(statistics.mean(latencies), 1) if latencies else 0.0,
+    }
+
+async def main_async(args):
+    levels = [int(level) for level in args.levels.split(",")]
+    results = []
+    print(f"{'conc':>5} {'reqs':>6} {'err':>4} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for concurrency in levels:
+        result = await run_level(args.url, concurrency, args.duration)
+        results.append(result)
+        print(f"{result['concurrency']:>5} {result['requests']:>6} {result['errors']:>4} {result['rps']:>8} "
+              f"{result['p50_ms']:>8} {result['p95_ms']:>8} {result['p99_ms']:>8}")
+
+    within = [r for r in results if r["p95_ms"] <= args.p95_ms and r["requests"] and not r["errors"]]
+    best = max(within, key=lambda r: r["rps"]) if within else None
+    if best:
+        print(f"\nBest: {best['rps']} req/s at concurrency {best['concurrency']} (p95 {best['p95_ms']} ms <= {args.p95_ms} ms)")
+    else:
+        print(f"\nNo level kept p95 under {args.p95_ms} ms without errors.")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"url": args.url, "p95_target_ms": args.p95_ms, "levels": results, "best": best}, f, indent=2)
+    return 0 if best else 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the /chat endpoint.")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--levels", default="1,2,4,8,16,32,64", help="Comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per level")
+    parser.add_argument("--p95-ms", type=float, default=3000.0, help="Latency target for the summary")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import argparse
+import tempfile
+
+# Smoke check of the PDF parsing step with the pymupdf/pymupdf4llm actually
+# installed (requirements.txt does not pin them). Parses one PDF in-process
+# and on a spawned worker pool, as tools/ingest.py does, and exits 1 if
+# parsing raises, yields no text or no headings, or if the page-grouped parse
+# is cut into other sections than a single to_markdown call. Without --pdf a
+# small synthetic PDF (see bench/e2e.py) is generated. Needs no models.
+#
+#   python bench/parse_smoke.py
+#   python bench/parse_smoke.py --pdf tools/data/textbook.pdf
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that PDF parsing works with the installed pymupdf4llm.")
+    parser.add_argument("--pdf", help="PDF to parse (default: a generated one)")
+    parser.add_argument("--pages", type=int, default=20, help="Pages of the generated PDF")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    from e2e import make_corpus
+    from section_search import check_grouping
+    from tools import ingest
+
+    path = args.pdf and os.path.abspath(args.pdf)
+    if path is None:
+        data_dir = tempfile.mkdtemp(prefix="osbuddy-parse-")
+        make_corpus(data_dir, 1, args.pages)
+        path = os.path.join(data_dir, "synthetic_000.pdf")
+
+    failures = []
+    try:
+        with ingest.parse_pool(args.workers) as pool:
+            pages = [page for group in ingest.iter_page_markdown(path, pool) for page in group]
+        failures += check_grouping([path])
+    except Exception as e:
+        pages = []
+        failures.append(f"parsing {os.path.basename(path)} raised {type(e).__name__}: {e}")
+    text = "".join(markdown for _, markdown in pages)
+    if pages and not text.strip():
+        failures.append("no text extracted")
+    if pages and not any(line.startswith("#") for line in text.splitlines()):
+        failures.append("no headings detected")
+
+    print(f"{os.path.basename(path)}: {len(pages)} pages, {len(text)} chars")
+    for line in failures:
+        print(f"FAIL {line}")
+    if failures:
+        sys.exit(1)
+    print("PDF parsing OK.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+# Two-stage (sections first) vs whole-shard search as a corpus grows. Adds
+# synthetic books to one corpus step by step (incremental ingest), and at each
+# size times the search stage alone (query vectors precomputed) both ways and
+# measures how often two-stage finds chunks as near as the whole-shard top k
+# (dense scores; the synthetic text repeats, so chunk ids tie). Exits 1 if
+# that recall drops below --min-recall, or if two-stage latency grows faster
+# than (chunks ratio) ** --max-exponent between the smallest and largest size,
+# or if a PDF parsed in page groups (as ingest does) is cut into different
+# sections than the same PDF parsed in one call (--pdf checks real books too).
+#
+#   python bench/section_search.py --books 1,4,16 --pages 40
+#   python bench/section_search.py --books 1 --pdf data/textbook.pdf
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from loadtest import QUESTIONS, percentile
+
+def time_search(retrieval, shard, queries, k, candidates):
+    retrieval.SECTION_CANDIDATES = candidates
+    latencies, results = [], []
+    for text, vector in queries:
+        start = time.perf_counter()
+        results.append(retrieval.hybrid_search(text, vector, k, shard=shard))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, results
+
+def section_paths(path, grouped):
+    """[(heading path, pages)] of a PDF's sections, parsed in PAGES_PER_TASK groups or in one call."""
+    from tools import ingest
+    from tools.sections import Sectioner
+    if grouped:
+        batches = ingest.iter_page_markdown(path)
+    else:
+        batches = [ingest.parse_pages(path, list(range(ingest.page_count(path))))]
+    sectioner = Sectioner(os.path.basename(path), "check")
+    found = []
+    for pages in batches:
+        for page, markdown in pages:
+            found += sectioner.feed(page, markdown)
+    found += sectioner.close()
+    return [(section["path"], section["pages"]) for section in found]
+
+def check_grouping(paths):
+    """Returns a failure line per PDF whose grouped parse yields other sections than a single call."""
+    failures = []
+    for path in paths:
+        grouped, single = section_paths(path, True), section_paths(path, False)
+        if grouped != single:
+            first = next((i for i, pair in enumerate(zip(grouped, single)) if pair[0] != pair[1]),
+                         min(len(grouped), len(single)))
+            failures.append(f"{os.path.basename(path)}: grouped parse has {len(grouped)} sections, "
+                            f"single parse {len(single)}; first difference at section {first}")
+        else:
+            print(f"{os.path.basename(path)}: {len(grouped)} sections, same grouped and single-call")
+    return failures
+
+def near_recall(flat, staged, k):
+    """Share of two-stage hits scoring at least the whole-shard k-th best score."""
+    hits = total = 0
+    for expected, found in zip(flat, staged):
+        if not expected:
+            continue
+        floor = expected[min(k, len(expected)) - 1][1] - 1e-4
+        hits += sum(1 for _, score in found if score >= floor)
+        total += min(k, len(expected))
+    return hits / total if total else 1.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark two-stage section search against whole-shard search.")
+    parser.add_argument("--books", default="1,4,16", help="Corpus sizes (synthetic PDFs) to measure")
+    parser.add_argument("--pages", type=int, default=40, help="Pages per synthetic PDF")
+    parser.add_argument("--sections", type=int, default=8, help="SECTION_CANDIDATES for the two-stage runs")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--min-recall", type=float, default=0.8)
+    parser.add_argument("--max-exponent", type=float, default=0.75,
+                        help="Two-stage latency may grow at most as (chunks ratio) ** this")
+    parser.add_argument("--pdf", action="append", default=[],
+                        help="Also check this PDF's sections for grouped vs single-call parsing (repeatable)")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+    args.json = args.json and os.path.abspath(args.json)
+    args.pdf = [os.path.abspath(path) for path in args.pdf]
+
+    workdir = tempfile.mkdtemp(prefix="osbuddy-sections-")
+    os.environ.update({
+        "FAISS_INDEX_PATH": os.path.join(workdir, "faiss_index"),
+        "INGEST_DATA_DIR": os.path.join(workdir, "data"),
+        "RETRIEVAL_MODE": "dense",  # scores are distances, comparable between the two runs
+    })
+    os.chdir(workdir)
+
+    from e2e import make_corpus
+    from tools import registry, retrieval
+    from tools.ingest import ingest
+    from tools.index_pool import pool
+
+    rows = []
+    for books in (int(size) for size in args.books.split(",")):
+        # Same seed: earlier books are regenerated identically and skipped by the incremental ingest
+        make_corpus(registry.DATA_DIR, books, args.pages)
+        start = time.perf_counter()
+        ingest()
+        ingest_s = time.perf_counter() - start
+        pool.reset()
+        shard = registry.get_shard()
+        texts = [QUESTIONS[i % len(QUESTIONS)] for i in range(args.queries)]
+        queries = list(zip(texts, retrieval.embed_queries(texts)))
+
+        flat_ms, flat = time_search(retrieval, shard, queries, args.k, 0)
+        staged_ms, staged = time_search(retrieval, shard, queries, args.k, args.sections)
+        row = {
+            "books": books,
+            "chunks": shard.info["vectors"],
+            "sections": shard.info["sections"],
+            "ingest_s": round(ingest_s, 1),
+            "flat_p50_ms": round(percentile(flat_ms, 50), 3),
+            "two_stage_p50_ms": round(percentile(staged_ms, 50), 3),
+            "two_stage_p95_ms": round(percentile(staged_ms, 95), 3),
+            "near_recall": round(near_recall(flat, staged, args.k), 3),
+        }
+        rows.append(row)
+        print("  ".join(f"{key}={value}" for key, value in row.items()))
+
+    failures = [f"{row['books']} books: near recall {row['near_recall']} < {args.min_recall}"
+                for row in rows if row["near_recall"] < args.min_recall]
+    first, last = rows[0], rows[-1]
+    if last["chunks"] > first["chunks"] and first["two_stage_p50_ms"]:
+        allowed = (last["chunks"] / first["chunks"]) ** args.max_exponent
+        growth = last["two_stage_p50_ms"] / first["two_stage_p50_ms"]
+        print(f"\nChunks x{last['chunks'] / first['chunks']:.1f}: two-stage p50 x{growth:.2f} "
+              f"(allowed x{allowed:.2f}), whole-shard p50 x{last['flat_p50_ms'] / max(first['flat_p50_ms'], 1e-9):.2f}")
+        if growth > allowed:
+            failures.append(f"two-stage p50 grew x{growth:.2f}, more than x{allowed:.2f}")
+
+    print()
+    synthetic = sorted(os.path.join(registry.DATA_DIR, name) for name in os.listdir(registry.DATA_DIR)
+                       if name.endswith(".pdf"))
+    failures += check_grouping(synthetic[:1] + args.pdf)
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json), exist_ok=True)
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": rows}, f, indent=2)
+    for line in failures:
+        print(f"FAIL {line}")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
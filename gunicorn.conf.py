@@ -0,0 +1,31 @@
+import os
+from tools.registry import WEB_CONCURRENCY
+
+# Gunicorn settings (used by the Procfile).
+# PRELOAD_APP=1 imports the app and warms the model/index registry once in the
+# master so forked workers share those pages copy-on-write instead of each
+# loading their own copy.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = WEB_CONCURRENCY  # also divides the LLM rate limits (tools/llm_gateway.py)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("PRELOAD_APP", "1") == "1"
+
+def when_ready(server):
+    # Runs in the master before workers are spawned
+    if preload_app:
+        from tools import registry
+        server.log.info(f"Warmed registry in master: {registry.warm()}")
+
+def post_fork(server, worker):
+    # HTTP clients must not be shared across a fork; rebuild the LLM client per worker
+    if preload_app:
+        from tools import registry
+        registry.reset("llm", "summary_llm")
+
+def post_worker_init(worker):
+    from tools import registry, router
+    status = registry.warm()
+    # Runs the embedding model, so only ever in the worker (never before fork)
+    router.warm()
+    worker.log.info(f"Worker {worker.pid} registry ready: {status['timings_s']}")
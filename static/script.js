@@ -1,4 +1,8 @@
 let currentSessionId = null;
+// Messages are loaded newest page first; older pages are fetched on scroll-up
+const MESSAGES_PAGE_SIZE = 30;
+let olderCursor = null; // X-Next-Cursor of the oldest page loaded so far (null: none left)
+let loadingOlder = false;
 
 // Get or Create User ID (Isolation)
 function getUserId() {
@@ -37,6 +41,11 @@ document.addEventListener('DOMContentLoaded', () => {
     // 1. Initial Load: Fetch Sessions
     fetchSessions();
 
+    const messagesContainer = document.getElementById('messages-container');
+    messagesContainer.addEventListener('scroll', () => {
+        if (messagesContainer.scrollTop < 80) loadOlderMessages();
+    });
+
     userInput.addEventListener('keypress', (e) => {
         if (e.key === 'Enter') sendMessage();
     });
@@ -44,53 +53,96 @@ document.addEventListener('DOMContentLoaded', () => {
     sendBtn.addEventListener('click', sendMessage);
 });
 
-async function fetchSessions() {
+async function fetchSessions(cursor = null) {
     try {
-        const res = await fetch('/sessions', {
+        const url = cursor ? `/sessions?cursor=${encodeURIComponent(cursor)}` : '/sessions';
+        const res = await fetch(url, {
             headers: { 'X-User-ID': getUserId() }
         });
         const sessions = await res.json();
-        renderHistoryList(sessions);
+        // Server pages the list newest first; X-Next-Cursor points at the next page
+        renderHistoryList(sessions, res.headers.get('X-Next-Cursor'), Boolean(cursor));
     } catch (e) {
         console.error("Failed to fetch sessions", e);
     }
 }
 
-function renderHistoryList(sessions) {
+function renderHistoryList(sessions, nextCursor = null, append = false) {
     const historyList = document.getElementById('history-list');
     if (!historyList) return;
-    historyList.innerHTML = ''; // Clear
 
-    // Always add "New Chat" at top
-    const newChatLi = document.createElement('li');
-    newChatLi.textContent = "+ New Chat";
-    newChatLi.classList.add('new-chat-btn');
-    newChatLi.onclick = startNewChat;
-    historyList.appendChild(newChatLi);
+    // Drop the previous "Show older" item; it is re-added below if there are more pages
+    const moreLi = historyList.querySelector('.load-more');
+    if (moreLi) moreLi.remove();
 
-    sessions.forEach(session => {
-        const li = document.createElement('li');
+    if (!append) {
+        historyList.innerHTML = ''; // Clear
+
+        // Always add "New Chat" at top
+        const newChatLi = document.createElement('li');
+        newChatLi.textContent = "+ New Chat";
+        newChatLi.classList.add('new-chat-btn');
+        newChatLi.onclick = startNewChat;
+        historyList.appendChild(newChatLi);
+    }
+
+    sessions.forEach(session => historyList.appendChild(createHistoryItem(session)));
 
-        // Chat Title
-        const titleSpan = document.createElement('span');
-        titleSpan.textContent = session.title;
-        titleSpan.classList.add('chat-title');
-        titleSpan.onclick = () => loadSession(session.id);
-
-        // Delete Button
-        const delBtn = document.createElement('span');
-        delBtn.innerHTML = '&times;'; // Simple 'x' or use SVG
-        delBtn.classList.add('delete-btn');
-        delBtn.onclick = (e) => {
-            e.stopPropagation(); // Stop click from loading session
-            deleteSession(session.id);
-        };
-
-        li.appendChild(titleSpan);
-        li.appendChild(delBtn);
-
-        if (session.id === currentSessionId) li.classList.add('active');
+    if (nextCursor) {
+        const li = document.createElement('li');
+        li.textContent = "Show older chats";
+        li.classList.add('load-more');
+        li.onclick = () => fetchSessions(nextCursor);
         historyList.appendChild(li);
+    }
+}
+
+function createHistoryItem(session) {
+    const li = document.createElement('li');
+    li.dataset.sessionId = session.id;
+
+    // Chat Title
+    const titleSpan = document.createElement('span');
+    titleSpan.textContent = session.title;
+    titleSpan.classList.add('chat-title');
+    titleSpan.onclick = () => loadSession(session.id);
+
+    // Delete Button
+    const delBtn = document.createElement('span');
+    delBtn.innerHTML = '&times;'; // Simple 'x' or use SVG
+    delBtn.classList.add('delete-btn');
+    delBtn.onclick = (e) => {
+        e.stopPropagation(); // Stop click from loading session
+        deleteSession(session.id);
+    };
+
+    li.appendChild(titleSpan);
+    li.appendChild(delBtn);
+
+    if (session.id === currentSessionId) li.classList.add('active');
+    return li;
+}
+
+// Moves a session to the top of the sidebar (adding it if new) from the entry
+// /chat returns, instead of re-fetching the whole list after every message
+function upsertHistoryItem(session) {
+    const historyList = document.getElementById('history-list');
+    if (!historyList || !session) return;
+
+    let li = historyList.querySelector(`li[data-session-id="${CSS.escape(session.id)}"]`);
+    if (li) {
+        if (session.title) li.querySelector('.chat-title').textContent = session.title;
+    } else {
+        li = createHistoryItem({ id: session.id, title: session.title || "New Chat" });
+    }
+    const newChatLi = historyList.querySelector('.new-chat-btn');
+    historyList.insertBefore(li, newChatLi ? newChatLi.nextSibling : historyList.firstChild);
+    highlightActiveSession();
+}
+
+function highlightActiveSession() {
+    document.querySelectorAll('#history-list li').forEach(li => {
+        li.classList.toggle('active', Boolean(li.dataset.sessionId) && li.dataset.sessionId === currentSessionId);
     });
 }
 
@@ -111,6 +163,7 @@ async function startNewChat() {
         });
         const data = await res.json();
         currentSessionId = data.id;
+        olderCursor = null;
 
         document.getElementById('messages-container').innerHTML = `
             <div class="message ai-message">
@@ -119,11 +172,8 @@ async function startNewChat() {
             </div>
         `;
 
-        // Refresh list instantly (New Chat appears in sidebar)
-        fetchSessions();
-
-        // Remove active class from others
-        document.querySelectorAll('#history-list li').forEach(li => li.classList.remove('active'));
+        // New Chat appears at the top of the sidebar
+        upsertHistoryItem(data);
     } catch (e) {
         console.error("Failed to create new chat", e);
     }
@@ -131,6 +181,7 @@ async function startNewChat() {
 
 async function loadSession(sessionId) {
     currentSessionId = sessionId;
+    olderCursor = null;
     // 4. Instant UI Feedback (Optimistic)
     // Clear chat & Show loader IMMEDIATELY
     const container = document.getElementById('messages-container');
@@ -142,22 +193,23 @@ async function loadSession(sessionId) {
     `;
 
     // Highlight sidebar immediately
-    document.querySelectorAll('#history-list li').forEach(li => li.classList.remove('active'));
-    // (Optional: find the li by ID if we had it, but for now just clear active)
+    highlightActiveSession();
 
-    // Fetch History
+    // Fetch the latest page of history (a 304 reuses the browser's copy)
     try {
-        const res = await fetch(`/sessions/${sessionId}`, {
+        const res = await fetch(`/sessions/${sessionId}?limit=${MESSAGES_PAGE_SIZE}`, {
             headers: { 'X-User-ID': getUserId() }
         });
         const data = await res.json();
+        if (currentSessionId !== sessionId) return; // switched chats meanwhile
+        olderCursor = res.headers.get('X-Next-Cursor');
 
         // Render Messages
         container.innerHTML = ''; // Clear loader
 
         if (data.messages && data.messages.length > 0) {
             data.messages.forEach(msg => {
-                appendMessage(msg.role === 'user' ? 'user-message' : 'ai-message', msg.content);
+                appendMessage(msg.role === 'user' ? 'user-message' : 'ai-message', msg.content, msg.citations);
             });
         } else {
             container.innerHTML = `
@@ -167,18 +219,49 @@ async function loadSession(sessionId) {
                 </div>
             `;
         }
-        // Background update of session list (don't block UI)
-        fetchSessions().then(() => {
-            // Re-highlight active after list refresh
-            const items = document.querySelectorAll('#history-list li');
-            // Logic to find and highlight currentSessionId would go here if needed
-        });
+        fillViewport();
     } catch (e) {
         console.error(e);
         container.innerHTML = `<div class="error">Failed to load chat.</div>`;
     }
 }
 
+// Prepends the next older page of the open chat, keeping the visible messages in place
+async function loadOlderMessages() {
+    if (!olderCursor || loadingOlder) return;
+    loadingOlder = true;
+    const sessionId = currentSessionId;
+    const container = document.getElementById('messages-container');
+
+    try {
+        const res = await fetch(`/sessions/${sessionId}?limit=${MESSAGES_PAGE_SIZE}&before=${encodeURIComponent(olderCursor)}`, {
+            headers: { 'X-User-ID': getUserId() }
+        });
+        const data = await res.json();
+        if (currentSessionId !== sessionId) return;
+        olderCursor = res.headers.get('X-Next-Cursor');
+
+        const previousHeight = container.scrollHeight;
+        const first = container.firstChild;
+        const nodes = (data.messages || []).map(msg => buildMessage(msg.role === 'user' ? 'user-message' : 'ai-message', msg.content, msg.citations));
+        nodes.forEach(node => container.insertBefore(node, first));
+        container.scrollTop += container.scrollHeight - previousHeight;
+        nodes.forEach(node => renderMermaidNodes([...node.querySelectorAll('.mermaid')]));
+    } catch (e) {
+        console.error("Failed to load older messages", e);
+        olderCursor = null;
+    } finally {
+        loadingOlder = false;
+    }
+    fillViewport();
+}
+
+// A short first page cannot be scrolled, so keep loading until it can (or history runs out)
+function fillViewport() {
+    const container = document.getElementById('messages-container');
+    if (olderCursor && container.scrollHeight <= container.clientHeight) loadOlderMessages();
+}
+
 
 async function deleteSession(sessionId) {
     if (!confirm("Delete this chat?")) return;
@@ -192,6 +275,7 @@ async function deleteSession(sessionId) {
         // If we deleted the active chat, reset view
         if (currentSessionId === sessionId) {
             currentSessionId = null;
+            olderCursor = null;
             document.getElementById('messages-container').innerHTML = `
             <div class="message ai-message">
                 <div class="avatar">AI</div>
@@ -200,7 +284,8 @@ async function deleteSession(sessionId) {
         `;
         }
 
-        fetchSessions();
+        const li = document.querySelector(`#history-list li[data-session-id="${CSS.escape(sessionId)}"]`);
+        if (li) li.remove();
     } catch (e) {
         console.error("Delete failed", e);
     }
@@ -215,11 +300,11 @@ async function sendMessage() {
     appendMessage('user-message', message);
     input.value = '';
 
-    // Loading Indicator
-    const loadingId = appendMessage('ai-message', 'Thinking...');
+    // Streaming AI bubble (shows "Thinking..." until the first token)
+    const stream = createStreamingMessage();
 
     try {
-        const response = await fetch('/chat', {
+        const response = await fetch('/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -230,27 +315,53 @@ async function sendMessage() {
                 session_id: currentSessionId
             })
         });
-        const data = await response.json();
-
-        // Remove loading
-        removeMessage(loadingId);
 
-        // Update Session ID if it was new
-        if (data.session_id) {
-            currentSessionId = data.session_id;
-            fetchSessions(); // Refresh title in sidebar
+        // Non-streaming replies (e.g. empty input) come back as plain JSON
+        if (!(response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+            const data = await response.json();
+            stream.finish(data.response);
+            return;
         }
 
-        appendMessage('ai-message', data.response);
+        await readEventStream(response, (event, data) => {
+            if (event === 'meta') {
+                // Update Session ID if it was new
+                currentSessionId = data.session_id;
+            } else if (event === 'citations') {
+                stream.cite(data.citations);
+            } else if (event === 'token') {
+                stream.append(data.text);
+            } else if (event === 'done') {
+                upsertHistoryItem(data.session); // Title and order in the sidebar
+            } else if (event === 'error') {
+                stream.append(`\n\n${data.response}`);
+            }
+        });
+
+        stream.finish();
 
     } catch (error) {
-        removeMessage(loadingId);
-        appendMessage('ai-message', "Error: Could not connect to OS Buddy.");
+        stream.finish(stream.text + "\n\nError: Could not connect to OS Buddy.");
     }
 }
 
-function appendMessage(type, text) {
+function appendMessage(type, text, citations) {
     const container = document.getElementById('messages-container');
+    const msgDiv = buildMessage(type, text, citations);
+
+    container.appendChild(msgDiv);
+    container.scrollTop = container.scrollHeight;
+
+    // 5. Run Mermaid (Robust)
+    if (type === 'ai-message') {
+        renderMermaidNodes([...msgDiv.querySelectorAll('.mermaid')]);
+    }
+
+    return msgDiv.id;
+}
+
+// Builds a message bubble (markdown + mermaid placeholders) without inserting it
+function buildMessage(type, text, citations) {
     const msgDiv = document.createElement('div');
     msgDiv.className = `message ${type}`;
     // 0. Cleanup previous renderer hacks if any
@@ -282,84 +393,202 @@ function appendMessage(type, text) {
     markers.forEach(marker => {
         const idParts = marker.id.split('-');
         const index = parseInt(idParts[idParts.length - 1]);
-        let code = mermaidBlocks[index];
-
-        // SAFETY: Decode HTML entities just in case (e.g. &gt; -> >)
-        // and trim whitespace which can confuse mermaid
-        const txt = document.createElement("textarea");
-        txt.innerHTML = code;
-        code = txt.value.trim()
-            .replace(/\u00A0/g, ' ')
-            .replace(/[\u201C\u201D]/g, '"')
-            .replace(/[\u2018\u2019]/g, "'")
-            .replace(/\|\>/g, '|') // Fix arrow ending
-            .replace(/(-->\|.*?)\|>/g, '$1|');
-
-        // SPECIAL FIX: If Sequence Diagram, fix mixed syntax (Flowchart arrows in Sequence)
-        if (code.includes('sequenceDiagram')) {
-            // Replace "A-->|text|B" with "A->>B: text"
-            // Regex breakdown: (\S+) = Node A, -->\|(.*?)\| = arrow+label, (\S+) = Node B
-            code = code.replace(/(\S+)\s*-->\|(.*?)\|\s*(\S+)/g, '$1->>$3: $2');
-
-            // Fix "Note over A,B,C" -> "Note over A,B" (Truncate to 2 to avoid crashing)
-            code = code.replace(/Note over ([^,]+),([^,]+),([^:]+):/g, 'Note over $1,$2:');
-        }
+        // Replace the marker with the actual code div
+        marker.replaceWith(buildMermaidNode(mermaidBlocks[index]));
+    });
 
-        const div = document.createElement('div');
-        div.classList.add('mermaid');
-        div.textContent = code; // CRITICAL: textContent escapes special chars effectively for display
+    if (type === 'ai-message' && citations && citations.length > 0) {
+        msgDiv.querySelector('.content').appendChild(buildCitations(citations));
+    }
 
-        // Replace the marker with the actual code div
-        marker.replaceWith(div);
+    return msgDiv;
+}
+
+// Page citations under an answer: "book.pdf · Chapter > Section · pp. 12–14"
+function buildCitations(citations) {
+    const div = document.createElement('div');
+    div.className = 'citations';
+    const label = document.createElement('span');
+    label.className = 'citations-label';
+    label.textContent = 'Sources:';
+    div.appendChild(label);
+
+    citations.forEach(citation => {
+        const [first, last] = citation.pages;
+        const pages = first === last ? `p. ${first}` : `pp. ${first}–${last}`;
+        const item = document.createElement('span');
+        item.className = 'citation';
+        // textContent: file names and headings come from the PDFs
+        item.textContent = [citation.source, citation.section, pages].filter(Boolean).join(' · ');
+        item.title = item.textContent;
+        div.appendChild(item);
     });
+    return div;
+}
+
+function buildMermaidNode(code) {
+    // SAFETY: Decode HTML entities just in case (e.g. &gt; -> >)
+    // and trim whitespace which can confuse mermaid
+    const txt = document.createElement("textarea");
+    txt.innerHTML = code;
+    code = txt.value.trim()
+        .replace(/\u00A0/g, ' ')
+        .replace(/[\u201C\u201D]/g, '"')
+        .replace(/[\u2018\u2019]/g, "'")
+        .replace(/\|\>/g, '|') // Fix arrow ending
+        .replace(/(-->\|.*?)\|>/g, '$1|');
+
+    // SPECIAL FIX: If Sequence Diagram, fix mixed syntax (Flowchart arrows in Sequence)
+    if (code.includes('sequenceDiagram')) {
+        // Replace "A-->|text|B" with "A->>B: text"
+        // Regex breakdown: (\S+) = Node A, -->\|(.*?)\| = arrow+label, (\S+) = Node B
+        code = code.replace(/(\S+)\s*-->\|(.*?)\|\s*(\S+)/g, '$1->>$3: $2');
+
+        // Fix "Note over A,B,C" -> "Note over A,B" (Truncate to 2 to avoid crashing)
+        code = code.replace(/Note over ([^,]+),([^,]+),([^:]+):/g, 'Note over $1,$2:');
+    }
+
+    const div = document.createElement('div');
+    div.classList.add('mermaid');
+    div.textContent = code; // CRITICAL: textContent escapes special chars effectively for display
+    return div;
+}
+
+async function renderMermaidNodes(nodes) {
+    if (typeof mermaid === 'undefined') return;
+    const validNodes = [];
+
+    for (const el of nodes) {
+        try {
+            // Pre-validate to avoid red syntax error boxes
+            await mermaid.parse(el.textContent);
+            validNodes.push(el);
+        } catch (err) {
+            console.error("Mermaid Parse Error:", err);
+
+            // Fallback UI
+            el.style.display = 'none';
+
+            const errorDiv = document.createElement('div');
+            errorDiv.className = 'mermaid-error';
+            errorDiv.style.cssText = 'color: #ef4444; padding: 10px; border: 1px solid #ef4444; border-radius: 8px; margin-top: 10px;';
+            errorDiv.innerHTML = `<strong>⚠️ Diagram Error</strong><br><small>${err.message}</small><br><small>The AI generated invalid syntax. Here is the raw code:</small>`;
+
+            const pre = document.createElement('pre');
+            pre.style.cssText = 'background: rgba(0,0,0,0.3); padding: 10px; margin-top: 5px; overflow-x: auto; white-space: pre-wrap;';
+            pre.textContent = el.textContent;
+
+            errorDiv.appendChild(pre);
+            el.parentNode.insertBefore(errorDiv, el.nextSibling);
+            el.classList.remove('mermaid');
+        }
+    }
 
+    if (validNodes.length > 0) {
+        try {
+            await mermaid.run({ nodes: validNodes });
+        } catch (e) { console.error("Mermaid Run Failed:", e); }
+    }
+}
+
+// --- Streaming Renderer ---
+// Re-renders the markdown of a growing AI message. Closed ```mermaid fences
+// are rendered once and their nodes re-attached on every repaint; an open
+// fence is hidden behind a placeholder until its closing ``` arrives.
+function createStreamingMessage() {
+    const container = document.getElementById('messages-container');
+    const msgDiv = document.createElement('div');
+    msgDiv.className = 'message ai-message';
+    msgDiv.innerHTML = `
+        <div class="avatar">AI</div>
+        <div class="content"><span class="loader">Thinking...</span></div>
+    `;
     container.appendChild(msgDiv);
     container.scrollTop = container.scrollHeight;
 
-    // 5. Run Mermaid
-    // 5. Run Mermaid (Robust)
-    if (type === 'ai-message' && typeof mermaid !== 'undefined') {
-        (async () => {
-            const nodes = [...msgDiv.querySelectorAll('.mermaid')];
-            const validNodes = [];
-
-            for (const el of nodes) {
-                try {
-                    // Pre-validate to avoid red syntax error boxes
-                    await mermaid.parse(el.textContent);
-                    validNodes.push(el);
-                } catch (err) {
-                    console.error("Mermaid Parse Error:", err);
-
-                    // Fallback UI
-                    el.style.display = 'none';
-
-                    const errorDiv = document.createElement('div');
-                    errorDiv.className = 'mermaid-error';
-                    errorDiv.style.cssText = 'color: #ef4444; padding: 10px; border: 1px solid #ef4444; border-radius: 8px; margin-top: 10px;';
-                    errorDiv.innerHTML = `<strong>⚠️ Diagram Error</strong><br><small>${err.message}</small><br><small>The AI generated invalid syntax. Here is the raw code:</small>`;
-
-                    const pre = document.createElement('pre');
-                    pre.style.cssText = 'background: rgba(0,0,0,0.3); padding: 10px; margin-top: 5px; overflow-x: auto; white-space: pre-wrap;';
-                    pre.textContent = el.textContent;
-
-                    errorDiv.appendChild(pre);
-                    el.parentNode.insertBefore(errorDiv, el.nextSibling);
-                    el.classList.remove('mermaid');
-                }
-            }
-
+    const contentDiv = msgDiv.querySelector('.content');
+    const diagrams = []; // index -> rendered mermaid wrapper
+    let text = '';
+    let frame = null;
+    let citationsNode = null;
+
+    function paint() {
+        frame = null;
+        const blocks = [];
+        let processed = text.replace(/```mermaid\s*([\s\S]*?)\s*```/g, (match, code) => {
+            blocks.push(code);
+            return `<span id="stream-mermaid-${blocks.length - 1}" class="mermaid-marker"></span>`;
+        });
 
+        // Hide an unterminated mermaid fence until it closes
+        const openFence = processed.indexOf('```mermaid');
+        if (openFence !== -1) {
+            processed = processed.slice(0, openFence) + '\n\n<span class="loader">Drawing diagram...</span>';
+        }
 
-            if (validNodes.length > 0) {
-                try {
-                    await mermaid.run({ nodes: validNodes });
-                } catch (e) { console.error("Mermaid Run Failed:", e); }
+        contentDiv.innerHTML = typeof marked !== 'undefined' ? marked.parse(processed) : processed;
+
+        const fresh = [];
+        contentDiv.querySelectorAll('.mermaid-marker').forEach(marker => {
+            const index = parseInt(marker.id.split('-').pop());
+            if (!diagrams[index]) {
+                // Wrapper keeps any parse-error box attached across repaints
+                const node = buildMermaidNode(blocks[index]);
+                diagrams[index] = document.createElement('div');
+                diagrams[index].appendChild(node);
+                fresh.push(node);
             }
-        })();
+            marker.replaceWith(diagrams[index]);
+        });
+        if (fresh.length > 0) renderMermaidNodes(fresh);
+        if (citationsNode) contentDiv.appendChild(citationsNode);
+
+        const container = document.getElementById('messages-container');
+        container.scrollTop = container.scrollHeight;
     }
 
-    return msgDiv.id;
+    return {
+        append(chunk) {
+            text += chunk;
+            if (!frame) frame = requestAnimationFrame(paint);
+        },
+        cite(citations) {
+            citationsNode = citations && citations.length > 0 ? buildCitations(citations) : null;
+        },
+        finish(finalText) {
+            if (finalText !== undefined) text = finalText;
+            if (frame) cancelAnimationFrame(frame);
+            paint();
+        },
+        get text() { return text; }
+    };
+}
+
+// Parses a text/event-stream body, invoking onEvent(event, data) per message.
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const raw = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            raw.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
 }
 
 function removeMessage(id) {
@@ -0,0 +1,110 @@
+import os
+import re
+import json
+import math
+import heapq
+from collections import Counter
+
+# Okapi BM25 over the same chunks as the FAISS index, keyed by the same chunk
+# ids. Dense retrieval blurs exact terms ("Banker's algorithm", "TLB
+# shootdown"); this catches them. Built and updated incrementally by
+# tools/ingest.py and saved next to the index as bm25.json.
+
+FILENAME = "bm25.json"
+FORMAT_VERSION = 1
+K1 = 1.5
+B = 0.75
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i in is it its of on or
+that the their then there these this to was what when where which who why will with you
+""".split())
+
+def tokenize(text):
+    # Single characters are mostly possessive "s" and list markers
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower())
+            if len(token) > 1 and token not in STOPWORDS]
+
+class BM25Index:
+    def __init__(self):
+        self.doc_lengths = {}  # chunk_id -> token count
+        self.postings = {}  # term -> {chunk_id: term frequency}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, chunk_id, text):
+        if chunk_id in self.doc_lengths:
+            self.remove([chunk_id])
+        tokens = tokenize(text)
+        self.doc_lengths[chunk_id] = len(tokens)
+        self.total_length += len(tokens)
+        for term, count in Counter(tokens).items():
+            self.postings.setdefault(term, {})[chunk_id] = count
+
+    def remove(self, chunk_ids):
+        doomed = {chunk_id for chunk_id in chunk_ids if chunk_id in self.doc_lengths}
+        if not doomed:
+            return
+        for chunk_id in doomed:
+            self.total_length -= self.doc_lengths.pop(chunk_id)
+        for term in list(self.postings):
+            docs = self.postings[term]
+            for chunk_id in doomed.intersection(docs):
+                del docs[chunk_id]
+            if not docs:
+                del self.postings[term]
+
+    def search(self, text, k=10, within=None):
+        """Returns [(chunk_id, score)] for the k best-scoring chunks, best first.
+        `within` limits the search to those chunk ids (the work is then proportional to them)."""
+        n = len(self.doc_lengths)
+        if not n:
+            return []
+        avg_length = self.total_length / n or 1.0
+        scores = {}
+        for term in set(tokenize(text)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            if within is not None:
+                matches = ((chunk_id, docs[chunk_id]) for chunk_id in within if chunk_id in docs)
+            else:
+                matches = docs.items()
+            for chunk_id, tf in matches:
+                norm = K1 * (1 - B + B * self.doc_lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, directory):
+        path = os.path.join(directory, FILENAME)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": FORMAT_VERSION, "doc_lengths": self.doc_lengths, "postings": self.postings}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, directory):
+        """Reads bm25.json from the index directory (None if absent or outdated)."""
+        path = os.path.join(directory, FILENAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != FORMAT_VERSION:
+            return None
+        index = cls()
+        index.doc_lengths = data["doc_lengths"]
+        index.postings = data["postings"]
+        index.total_length = sum(index.doc_lengths.values())
+        return index
+
+    @classmethod
+    def from_docstore(cls, vector_store):
+        """Builds the index from the chunks already stored in a FAISS vector store."""
+        index = cls()
+        for chunk_id in vector_store.index_to_docstore_id.values():
+            index.add(chunk_id, vector_store.docstore.search(chunk_id).page_content)
+        return index
@@ -1,27 +1,146 @@
 import os
 import time
-from pymongo import MongoClient
-import dns.resolver
-import pymongo
-import certifi
-import json
+import asyncio
+import threading
+from tools.local_store import LocalSessionStore
 
-# Fix for Windows/Network DNS issues: Force Google DNS
-dns.resolver.default_resolver = dns.resolver.Resolver(configure=False)
-dns.resolver.default_resolver.nameservers = ['8.8.8.8', '8.8.4.4']
+# pymongo, bson and certifi are imported where they are used (on the probe
+# thread, off the boot path), so importing the app costs nothing for them and
+# a deployment without MONGO_URI never loads them.
+
+# Fix for Windows/Network DNS issues: opt in to explicit resolvers,
+# e.g. MONGO_DNS_SERVERS=8.8.8.8,8.8.4.4
+if os.getenv("MONGO_DNS_SERVERS"):
+    import dns.resolver
+    dns.resolver.default_resolver = dns.resolver.Resolver(configure=False)
+    dns.resolver.default_resolver.nameservers = os.getenv("MONGO_DNS_SERVERS").split(",")
+
+# Sort directions, as pymongo.ASCENDING / DESCENDING
+ASCENDING, DESCENDING = 1, -1
+
+# Seconds between reconnect probes while MongoDB is unreachable (doubles up to the max)
+PROBE_INTERVAL = float(os.getenv("MONGO_PROBE_INTERVAL", "5"))
+PROBE_MAX_INTERVAL = float(os.getenv("MONGO_PROBE_MAX_INTERVAL", "60"))
+# How long a request may wait for the very first connection attempt after boot
+STARTUP_WAIT = float(os.getenv("MONGO_STARTUP_WAIT", "1.0"))
+
+def parse_cursor(cursor):
+    """Session-list cursors are "<timestamp>:<id>" of the last item on the previous page."""
+    if not cursor:
+        return None
+    try:
+        timestamp, session_id = cursor.split(":", 1)
+        return float(timestamp), session_id
+    except ValueError:
+        return None
+
+def make_cursor(session):
+    return f"{session.get('timestamp', 0)}:{session.get('id')}"
+
+class CircuitBreaker:
+    """
+    Tracks whether MongoDB is usable. Closed: requests go to Mongo. Open:
+    requests go to the local store while a background thread probes Mongo
+    with exponential backoff and closes the circuit once probe() succeeds.
+    """
+    def __init__(self, probe, interval=PROBE_INTERVAL, max_interval=PROBE_MAX_INTERVAL):
+        self.probe = probe
+        self.interval = interval
+        self.max_interval = max_interval
+        self.state = "open"  # until the first connection succeeds
+        self.trips = 0
+        self.last_error = None
+        self.first_attempt = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def is_open(self):
+        return self.state == "open"
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="mongo-probe", daemon=True)
+                self._thread.start()
+
+    def trip(self, error=None):
+        with self._lock:
+            if self.state == "closed":
+                self.trips += 1
+            self.state = "open"
+            if error is not None:
+                self.last_error = str(error)
+        self.start()
+
+    def reset_after_fork(self):
+        # Threads do not survive fork(); the child must start its own probe
+        self._lock = threading.Lock()
+        self._thread = None
+        self.state = "open"
+        self.first_attempt = threading.Event()
+        self.start()
+
+    def _run(self):
+        delay = self.interval
+        while True:
+            try:
+                healthy = self.probe(self)
+            except Exception as e:
+                print(f"MongoDB probe failed: {e}")
+                self.last_error = str(e)
+                healthy = False
+            self.first_attempt.set()
+            if healthy:
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_interval)
 
 class MongoDBManager:
     def __init__(self):
         self.uri = os.getenv("MONGO_URI")
         self.client = None
         self.db = None
-        self.use_local = False
-        self.local_file = "chat_history.json"
-        
-        try:
-            if not self.uri:
-                raise ValueError("MONGO_URI not found")
-            
+        self.local_file = os.getenv("LOCAL_DB_PATH", "chat_history.db")
+        # Pre-SQLite fallback file; imported once into local_file
+        self.legacy_file = "chat_history.json"
+        self._local = None
+        self._indexes_ready = False
+        self.breaker = CircuitBreaker(self._probe)
+
+        # Startup never blocks on the network: the probe thread connects in the
+        # background and requests use local storage until it succeeds.
+        if self.uri:
+            self.breaker.start()
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(after_in_child=self._after_fork)
+        else:
+            print("\n[WARNING] MONGO_URI not found")
+            print(f"[ACTION] Using Local File Storage ({self.local_file})\n")
+            self.breaker.first_attempt.set()
+
+    @property
+    def use_local(self):
+        if not self.uri:
+            return True
+        if self.breaker.is_open and not self.breaker.first_attempt.is_set():
+            # Just booted: give the first connection attempt a moment so early
+            # requests read from Mongo instead of an empty local store
+            self.breaker.first_attempt.wait(STARTUP_WAIT)
+        return self.breaker.is_open
+
+    def _after_fork(self):
+        # MongoClient is not fork-safe; each gunicorn worker reconnects on its own
+        self.client = None
+        self.db = None
+        self._local = None
+        self.breaker.reset_after_fork()
+
+    def _probe(self, breaker):
+        """Connects (or pings), replays queued fallback writes, then closes the circuit."""
+        if self.client is None:
+            import certifi
+            from pymongo import MongoClient
             self.client = MongoClient(
                 self.uri, 
                 serverSelectionTimeoutMS=3000,
@@ -29,16 +148,71 @@ class MongoDBManager:
                 socketTimeoutMS=3000,
                 tlsCAFile=certifi.where()
             )
-            # Test Connection
-            self.client.admin.command('ping')
-            self.db = self.client["chat_db"]
-            print("Connected to MongoDB Atlas!")
+        # Test Connection
+        self.client.admin.command('ping')
+        self.db = self.client["chat_db"]
+        if not self._indexes_ready:
             self._ensure_indexes()
-        except Exception as e:
-            print(f"\n[WARNING] MongoDB Connection Failed: {e}")
-            print(f"[ACTION] Switching to Local File Storage ({self.local_file})\n")
-            print(f"[ACTION] Switching to Local File Storage ({self.local_file})\n")
-            self.use_local = True
+            self._indexes_ready = True
+
+        if not self._replay_pending():
+            return False  # another worker is replaying; keep writing locally until it is done
+        with breaker._lock:
+            breaker.state = "closed"
+        # Writes queued while the circuit was closing
+        self._replay_pending()
+        print("Connected to MongoDB Atlas!" if not breaker.trips else "MongoDB recovered; circuit closed.")
+        return True
+
+    def _replay_pending(self):
+        """Applies writes queued during an outage, oldest first. False if another worker holds the replay lock."""
+        if self._local is None and not os.path.exists(self.local_file):
+            return True
+        from bson import json_util
+        replayed = self.local.replay_writes(lambda op: self._apply_write(json_util.loads(op)))
+        if replayed:
+            print(f"Replayed {replayed} queued writes to MongoDB.")
+        return replayed is not None
+
+    def _apply_write(self, op):
+        if op["op"] == "save":
+            self.db.sessions.update_one({"id": op["session_id"]}, {"$set": op["session_data"]}, upsert=True)
+        elif op["op"] == "append":
+            # The queued title was picked from the local copy, which may not know the
+            # session's real one: only a new or still untitled session takes it
+            metadata = dict(op["metadata"])
+            title = metadata.pop("title", None)
+            update = self._append_update(op["messages"], metadata, op.get("user_id"))
+            if title:
+                update["$setOnInsert"] = {"title": title}
+            self.db.sessions.update_one({"id": op["session_id"]}, update, upsert=True)
+            if title:
+                self.db.sessions.update_one({"id": op["session_id"], "title": "New Chat"}, {"$set": {"title": title}})
+        elif op["op"] == "set":
+            self.db.sessions.update_one({"id": op["session_id"]}, {"$set": op["fields"]})
+        elif op["op"] == "delete":
+            query = {"id": op["session_id"]}
+            if op.get("user_id"):
+                query["user_id"] = op["user_id"]
+            self.db.sessions.delete_one(query)
+
+    def _queue(self, **op):
+        # bson's JSON keeps datetimes as dates so the TTL index still applies after replay
+        if not self.uri:
+            return None
+        from bson import json_util
+        return json_util.dumps(op)
+
+    def status(self):
+        has_local = self._local is not None or os.path.exists(self.local_file)
+        return {
+            "mode": "local" if self.breaker.is_open else "mongo",
+            "circuit": self.breaker.state,
+            "trips": self.breaker.trips,
+            "last_error": self.breaker.last_error,
+            "pending_writes": self.local.pending_count() if has_local else 0,
+            "dead_writes": self.local.dead_count() if has_local else 0,
+        }
 
     def _ensure_indexes(self):
         try:
@@ -49,64 +223,107 @@ class MongoDBManager:
         except Exception as e:
             print(f"Warning: Could not create TTL index: {e}")
 
-    def _load_local(self):
-        if not os.path.exists(self.local_file):
-            return {}
-        try:
-            with open(self.local_file, "r") as f:
-                return json.load(f)
-        except:
-            return {}
+        # Every session lookup is by 'id'; the sidebar lists a user's sessions newest first
+        for keys, options in (
+            ([("id", ASCENDING)], {"unique": True, "name": "id_unique"}),
+            # 'id' is the tie-breaker in the paging sort, so include it to keep the sort index-only
+            ([("user_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+             {"name": "user_id_timestamp"}),
+        ):
+            try:
+                self.db.sessions.create_index(keys, **options)
+            except Exception as e:
+                print(f"Warning: Could not create index {options['name']}: {e}")
 
-    def _save_local(self, data):
-        try:
-            with open(self.local_file, "w") as f:
-                json.dump(data, f, indent=2, default=str)
-        except Exception as e:
-            print(f"Failed to save local history: {e}")
+    @property
+    def local(self):
+        # Opened lazily so a healthy Mongo deployment never touches the file
+        if self._local is None:
+            self._local = LocalSessionStore(self.local_file, legacy_json=self.legacy_file)
+        return self._local
 
-    def get_sessions(self, user_id=None):
+    def get_sessions(self, user_id=None, limit=None, cursor=None):
+        """
+        Lists sessions newest first. With a limit, returns at most that many
+        after the given cursor (see make_cursor) - sorting and paging happen
+        server-side on the (user_id, timestamp) index.
+        """
+        after = parse_cursor(cursor)
         if self.use_local:
-            history = self._load_local()
-            # Convert dict to list format expected by app
-            sessions = []
-            for sid, data in history.items():
-                # Filter by user_id if provided
-                if user_id and data.get("user_id") != user_id:
-                    continue
-                    
-                sessions.append({
-                    "id": sid,
-                    "title": data.get("title", "New Chat"),
-                    "timestamp": data.get("timestamp", 0)
-                })
-            return sessions 
+            return self.local.list_sessions(user_id, limit=limit, after=after)
         
         try:
             # MongoDB
             query = {}
             if user_id:
                 query["user_id"] = user_id
+            if after:
+                timestamp, session_id = after
+                query["$or"] = [
+                    {"timestamp": {"$lt": timestamp}},
+                    {"timestamp": timestamp, "id": {"$lt": session_id}},
+                ]
                 
             cursors = self.db.sessions.find(query, {"id": 1, "title": 1, "timestamp": 1, "_id": 0})
+            cursors = cursors.sort([("timestamp", DESCENDING), ("id", DESCENDING)])
+            if limit:
+                cursors = cursors.limit(limit)
             return list(cursors)
         except Exception as e:
             print(f"MongoDB Read Failed: {e}. Switching to Local.")
-            self.use_local = True
-            return self.get_sessions(user_id)
+            self.breaker.trip(e)
+            return self.get_sessions(user_id, limit, cursor)
 
-    def get_session(self, session_id):
+    def get_session(self, session_id, last_n=None):
+        """Returns the session document; with last_n, only its last N messages."""
         if self.use_local:
-            history = self._load_local()
-            return history.get(session_id, {"messages": []})
+            return self.local.get_session(session_id, last_n=last_n) or {"messages": []}
         
         try:
-            data = self.db.sessions.find_one({"id": session_id}, {"_id": 0})
+            projection = {"_id": 0}
+            if last_n:
+                projection["messages"] = {"$slice": -last_n}
+            data = self.db.sessions.find_one({"id": session_id}, projection)
             return data if data else {"messages": []}
         except Exception as e:
             print(f"MongoDB Read Session Failed: {e}. Switching to Local.")
-            self.use_local = True
-            return self.get_session(session_id)
+            self.breaker.trip(e)
+            return self.get_session(session_id, last_n)
+
+    def get_messages_page(self, session_id, limit, before=None):
+        """
+        Returns (session, start): the session document with only the `limit`
+        messages that precede index `before` (the newest ones if None), and
+        the index of its first message - the cursor for the next older page.
+        session["message_count"] is the total. Sliced server-side, so long
+        sessions never travel whole.
+        """
+        if self.use_local:
+            return self.local.get_messages_page(session_id, limit, before) or ({"messages": []}, 0)
+
+        try:
+            count = {"$size": {"$ifNull": ["$messages", []]}}
+            end = count if before is None else {"$min": [count, before]}
+            docs = list(self.db.sessions.aggregate([
+                {"$match": {"id": session_id}},
+                {"$unset": "_id"},
+                {"$set": {"message_count": count, "page_end": end}},
+                {"$set": {"page_start": {"$max": [0, {"$subtract": ["$page_end", limit]}]}}},
+                {"$set": {"messages": {"$cond": [
+                    {"$gt": ["$page_end", "$page_start"]},
+                    {"$slice": ["$messages", "$page_start", {"$subtract": ["$page_end", "$page_start"]}]},
+                    [],
+                ]}}},
+            ]))
+            if not docs:
+                return {"messages": []}, 0
+            session = docs[0]
+            session.pop("page_end", None)
+            return session, session.pop("page_start", 0)
+        except Exception as e:
+            print(f"MongoDB Read Session Failed: {e}. Switching to Local.")
+            self.breaker.trip(e)
+            return self.get_messages_page(session_id, limit, before)
 
     def save_session(self, session_id, session_data, user_id=None):
         # Ensure ID is in data
@@ -116,9 +333,8 @@ class MongoDBManager:
 
         
         if self.use_local:
-            history = self._load_local()
-            history[session_id] = session_data
-            self._save_local(history)
+            self.local.save_session(session_id, session_data,
+                                    pending=self._queue(op="save", session_id=session_id, session_data=session_data))
             return
 
         try:
@@ -129,18 +345,72 @@ class MongoDBManager:
             )
         except Exception as e:
             print(f"MongoDB Write Failed: {e}. Switching to Local.")
-            self.use_local = True
+            self.breaker.trip(e)
             self.save_session(session_id, session_data, user_id)
 
+    def set_session_fields(self, session_id, fields):
+        """
+        Sets fields on an existing session without ever creating one, for
+        writes that may land after the session was deleted (the rolling
+        summary). Returns False if the session no longer exists.
+        """
+        if self.use_local:
+            return self.local.set_session_fields(
+                session_id, fields, pending=self._queue(op="set", session_id=session_id, fields=fields)
+            )
+
+        try:
+            result = self.db.sessions.update_one({"id": session_id}, {"$set": fields}, upsert=False)
+            return result.matched_count > 0
+        except Exception as e:
+            print(f"MongoDB Update Failed: {e}. Switching to Local.")
+            self.breaker.trip(e)
+            return self.set_session_fields(session_id, fields)
+
+    @staticmethod
+    def _append_update(messages, metadata, user_id):
+        """$push the new messages and $set only the small fields that changed."""
+        fields = dict(metadata)
+        if user_id:
+            fields["user_id"] = user_id
+        update = {"$push": {"messages": {"$each": list(messages)}}}
+        if fields:
+            update["$set"] = fields
+        return update
+
+    def append_messages(self, session_id, messages, metadata=None, user_id=None):
+        """
+        Appends messages to a session (creating it if needed) and updates the
+        given metadata fields (timestamp, last_active, title...). Unlike
+        save_session, the write size does not grow with the conversation.
+        """
+        metadata = metadata or {}
+        if self.use_local:
+            self.local.append_messages(
+                session_id, messages, dict(metadata, **({"user_id": user_id} if user_id else {})),
+                pending=self._queue(op="append", session_id=session_id, messages=messages,
+                                    metadata=metadata, user_id=user_id)
+            )
+            return
+
+        try:
+            self.db.sessions.update_one(
+                {"id": session_id},
+                self._append_update(messages, metadata, user_id),
+                upsert=True
+            )
+        except Exception as e:
+            print(f"MongoDB Append Failed: {e}. Switching to Local.")
+            self.breaker.trip(e)
+            self.append_messages(session_id, messages, metadata, user_id)
+
     def delete_session(self, session_id, user_id=None):
         if self.use_local:
-            history = self._load_local()
-            if session_id in history:
-                # Optional: Check ownership
-                if user_id and history[session_id].get("user_id") != user_id:
-                    return False
-                del history[session_id]
-                self._save_local(history)
+            # Same rule as the Mongo query below: with a user id, only that user's session matches
+            if user_id and self.local.session_owner(session_id) != user_id:
+                return False
+            self.local.delete_session(session_id,
+                                      pending=self._queue(op="delete", session_id=session_id, user_id=user_id))
             return True
         
         try:
@@ -151,7 +421,100 @@ class MongoDBManager:
             result = self.db.sessions.delete_one(query)
             return result.deleted_count > 0
         except Exception as e:
-            print(f"MongoDB Delete Failed: {e}")
-            return False
+            print(f"MongoDB Delete Failed: {e}. Switching to Local.")
+            self.breaker.trip(e)
+            return self.delete_session(session_id, user_id)
+
+class AsyncMongoDBManager:
+    """
+    asyncio front-end used by the ASGI chat path (asgi.py). Talks to MongoDB
+    through motor so awaiting a query never blocks the event loop; while the
+    wrapped sync manager is in local-file mode, calls run on a worker thread.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.client = None
+        self.db = None
 
+    def _ensure_client(self):
+        # Created on first use inside the worker (after fork, on its event loop)
+        if self.db is None and self.manager.uri:
+            try:
+                import certifi
+                from motor.motor_asyncio import AsyncIOMotorClient
+                self.client = AsyncIOMotorClient(
+                    self.manager.uri,
+                    serverSelectionTimeoutMS=3000,
+                    connectTimeoutMS=3000,
+                    socketTimeoutMS=3000,
+                    tlsCAFile=certifi.where()
+                )
+                self.db = self.client["chat_db"]
+            except Exception as e:
+                print(f"[WARNING] Async MongoDB client unavailable: {e}")
+        return self.db
 
+    async def use_local(self):
+        """The sync manager's circuit breaker decides for both clients. Its
+        startup wait and the first client setup (motor's import) run on a
+        worker thread, so neither blocks the event loop."""
+        if not self.manager.uri:
+            return True
+        breaker = self.manager.breaker
+        if breaker.is_open and not breaker.first_attempt.is_set():
+            await asyncio.to_thread(breaker.first_attempt.wait, STARTUP_WAIT)
+        if breaker.is_open:
+            return True
+        if self.db is None:
+            await asyncio.to_thread(self._ensure_client)
+        return self.db is None
+
+    async def get_session(self, session_id, last_n=None):
+        if await self.use_local():
+            return await asyncio.to_thread(self.manager.get_session, session_id, last_n)
+
+        try:
+            projection = {"_id": 0}
+            if last_n:
+                projection["messages"] = {"$slice": -last_n}
+            data = await self.db.sessions.find_one({"id": session_id}, projection)
+            return data if data else {"messages": []}
+        except Exception as e:
+            print(f"MongoDB Read Session Failed: {e}. Switching to Local.")
+            self.manager.breaker.trip(e)
+            return await self.get_session(session_id, last_n)
+
+    async def save_session(self, session_id, session_data, user_id=None):
+        session_data["id"] = session_id
+        if user_id:
+            session_data["user_id"] = user_id
+
+        if await self.use_local():
+            return await asyncio.to_thread(self.manager.save_session, session_id, session_data, user_id)
+
+        try:
+            await self.db.sessions.update_one(
+                {"id": session_id},
+                {"$set": session_data},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"MongoDB Write Failed: {e}. Switching to Local.")
+            self.manager.breaker.trip(e)
+            await self.save_session(session_id, session_data, user_id)
+
+    async def append_messages(self, session_id, messages, metadata=None, user_id=None):
+        metadata = metadata or {}
+        if await self.use_local():
+            return await asyncio.to_thread(self.manager.append_messages, session_id, messages, metadata, user_id)
+
+        try:
+            await self.db.sessions.update_one(
+                {"id": session_id},
+                self.manager._append_update(messages, metadata, user_id),
+                upsert=True
+            )
+        except Exception as e:
+            print(f"MongoDB Append Failed: {e}. Switching to Local.")
+            self.manager.breaker.trip(e)
+            await self.append_messages(session_id, messages, metadata, user_id)
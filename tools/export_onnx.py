@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import argparse
+
+# Make `tools.*` importable when run as `python tools/export_onnx.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import registry
+from tools.onnx_embeddings import CONFIG_FILE
+
+# Exports a sentence-transformers model for EMBEDDING_BACKEND=onnx. Run it
+# once on a machine with torch installed and ship the output directory;
+# serving then needs only onnxruntime and tokenizers.
+# Usage: python -m tools.export_onnx [--model NAME] [--out DIR] [--quantize]
+
+def export(model_name, out_dir, quantize=False):
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    model = SentenceTransformer(model_name, device="cpu")
+    pooling = next((module for module in model if isinstance(module, Pooling)), None)
+    if pooling is None or pooling.get_pooling_mode_str() != "mean":
+        raise ValueError(f"{model_name} does not use mean pooling; OnnxEmbeddings only implements mean pooling")
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = model.tokenizer
+    tokenizer.save_pretrained(out_dir)  # writes tokenizer.json for fast tokenizers
+    if not os.path.exists(os.path.join(out_dir, "tokenizer.json")):
+        raise ValueError(f"{model_name} has no fast tokenizer; cannot export tokenizer.json")
+
+    sample = tokenizer(["Export sample for the ONNX graph."], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    model_path = os.path.join(out_dir, "model.onnx")
+    transformer = model[0].auto_model
+
+    class Encoder(torch.nn.Module):
+        """Returns only last_hidden_state; pooling happens in OnnxEmbeddings."""
+
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            extra = {"token_type_ids": token_type_ids} if token_type_ids is not None else {}
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask, **extra).last_hidden_state
+
+    encoder = Encoder().eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            tuple(sample[name] for name in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+            opset_version=14,
+        )
+    print(f"Exported {model_name} to {model_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantized_path = os.path.join(out_dir, "model_int8.onnx")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        print(f"Wrote int8 weights to {quantized_path}")
+
+    config = {
+        "model_name": model_name,
+        "max_length": model.max_seq_length,
+        "pad_token": tokenizer.pad_token,
+        "pad_id": tokenizer.pad_token_id,
+        "normalize": any(isinstance(module, Normalize) for module in model),
+        "dimension": model.get_sentence_embedding_dimension(),
+    }
+    with open(os.path.join(out_dir, CONFIG_FILE), "w") as f:
+        json.dump(config, f, indent=2)
+    return config
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX for EMBEDDING_BACKEND=onnx.")
+    parser.add_argument("--model", default=registry.embedding_model_name(), help="sentence-transformers model name")
+    parser.add_argument("--out", help="Output directory (default: models/<model>-onnx)")
+    parser.add_argument("--quantize", action="store_true", help="Also write int8 dynamically quantized weights")
+    args = parser.parse_args()
+    export(args.model, args.out or registry.onnx_model_dir(args.model), quantize=args.quantize)
+
+if __name__ == "__main__":
+    main()
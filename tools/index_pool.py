@@ -0,0 +1,209 @@
+import os
+import time
+import pickle
+import threading
+from collections import OrderedDict
+from tools import registry, metrics, sections
+
+# Loaded corpus indexes ("shards"), one per course. A shard is loaded the first
+# time a request needs it (index.faiss memory-mapped, docstore and BM25 in
+# memory) and kept in an LRU; when the estimated size of the loaded shards
+# goes over INDEX_POOL_MAX_MB, the least recently used ones are dropped. A
+# search already holding an evicted shard finishes on it, and its memory is
+# released once the last reference goes away.
+#
+# Size is estimated from disk: index.faiss and sections.npy as is (mapped
+# pages still count, they are just shared between workers), the pickled
+# docstore, bm25.json and sections.json times OBJECT_OVERHEAD for their
+# Python objects.
+
+INDEX_POOL_MAX_MB = float(os.getenv("INDEX_POOL_MAX_MB", "512"))
+OBJECT_OVERHEAD = 3
+
+LOADS = metrics.counter("osbuddy_index_loads_total", "Corpus indexes loaded into the pool", ("corpus",))
+EVICTIONS = metrics.counter("osbuddy_index_evictions_total", "Corpus indexes evicted from the pool", ("corpus",))
+MMAP_FALLBACKS = metrics.counter("osbuddy_index_mmap_fallbacks_total",
+                                 "Corpus indexes read into memory because memory-mapping failed", ("corpus",))
+
+def mmap_flags(factory):
+    """faiss.read_index flags to try, in order, for an index built with `factory`."""
+    import faiss
+    if factory.startswith("IVF"):
+        # IO_FLAG_MMAP maps the IVF lists; FAISS refuses IVF loads with the IFC/read-only flags
+        return [faiss.IO_FLAG_MMAP]
+    # IO_FLAG_MMAP_IFC (FAISS >= 1.9) maps flat/SQ codes
+    flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | getattr(faiss, "IO_FLAG_READ_ONLY", 0)
+    return list(dict.fromkeys([flags, faiss.IO_FLAG_MMAP]))
+
+def read_index(path, factory="Flat"):
+    """Reads a FAISS index, memory-mapped when enabled. Returns (index, mmapped)."""
+    import faiss
+    if registry.INDEX_MMAP:
+        for flags in mmap_flags(factory):
+            try:
+                return faiss.read_index(path, flags), True
+            except Exception as e:
+                error = e
+        print(f"Index pool: mmap load failed ({error}); reading index into memory")
+    return faiss.read_index(path), False
+
+def set_nprobe(index, nprobe):
+    import faiss
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        return None  # not an IVF index
+    return nprobe
+
+def estimate_mb(path):
+    def size(name):
+        file_path = os.path.join(path, name)
+        return os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    total = size("index.faiss") + size(sections.VECTORS_FILENAME) + \
+        OBJECT_OVERHEAD * (size("index.pkl") + size("bm25.json") + size(sections.FILENAME))
+    return round(total / (1 << 20), 1)
+
+class Shard:
+    """One corpus's loaded index: FAISS vector store plus its BM25 and section
+    indexes. `sections` is None for indexes built before sections existed."""
+
+    def __init__(self, corpus, vector_store, lexical, manifest, mmapped, nprobe, size_mb, section_index=None):
+        self.corpus = corpus
+        self.vector_store = vector_store
+        self.lexical = lexical
+        self.sections = section_index
+        # chunk id -> FAISS position, to search within the chunks of a few sections
+        self.positions = None if section_index is None else \
+            {chunk_id: position for position, chunk_id in vector_store.index_to_docstore_id.items()}
+        self.nprobe = nprobe
+        self.revision = manifest.get("revision", 0)
+        self.size_mb = size_mb
+        self.info = {
+            "revision": self.revision,
+            "factory": manifest.get("index_factory", "Flat"),
+            "vectors": vector_store.index.ntotal,
+            "mmap": mmapped,
+            "nprobe": nprobe,
+            "sections": len(section_index) if section_index is not None else None,
+            "size_mb": size_mb,
+        }
+
+def load_shard(corpus):
+    """Loads a corpus's index from disk. Returns None if it has not been built."""
+    path = registry.corpus_index_path(corpus)
+    index_file = os.path.join(path, "index.faiss")
+    if not os.path.exists(index_file):
+        return None
+    embeddings = registry.get_embeddings()
+    if embeddings is None:
+        return None
+    from langchain_community.vectorstores import FAISS
+    from tools.bm25 import BM25Index
+
+    manifest = registry.get_manifest(corpus) or {}
+    model = manifest.get("embedding_model")
+    loaded = getattr(embeddings, "model_name", model)
+    if model and model.split("/")[-1] != loaded.split("/")[-1]:
+        # Every corpus is searched with the same query vector
+        raise ValueError(f"built with {model}, but queries are embedded with {loaded}; re-ingest it")
+    index, mmapped = read_index(index_file, manifest.get("index_factory", "Flat"))
+    # Same pickle FAISS.load_local reads; written by our own ingest
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    vector_store = FAISS(embedding_function=embeddings, index=index, docstore=docstore,
+                         index_to_docstore_id=index_to_docstore_id)
+    lexical = BM25Index.load(path)
+    if lexical is None:
+        print(f"Index pool: no bm25.json for {corpus}; building it from the docstore")
+        lexical = BM25Index.from_docstore(vector_store)
+    return Shard(corpus, vector_store, lexical, manifest, mmapped,
+                 set_nprobe(index, registry.FAISS_NPROBE), estimate_mb(path), sections.SectionIndex.load(path))
+
+class IndexPool:
+    def __init__(self, max_mb=INDEX_POOL_MAX_MB):
+        self.max_mb = max_mb
+        self._shards = OrderedDict()  # corpus -> Shard, least recently used first
+        self._loading = {}  # corpus -> lock held while that corpus loads
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        self.mmap_fallbacks = 0
+        self.errors = {}
+
+    def _touch(self, corpus):
+        shard = self._shards.get(corpus)
+        if shard is not None:
+            self._shards.move_to_end(corpus)
+        return shard
+
+    def get(self, corpus):
+        """Returns the corpus's Shard, loading it on first use (None if it has no index)."""
+        with self._lock:
+            shard = self._touch(corpus)
+            if shard is not None:
+                return shard
+            loading = self._loading.setdefault(corpus, threading.Lock())
+        # One load per corpus at a time; other corpora stay searchable meanwhile
+        with loading:
+            with self._lock:
+                shard = self._touch(corpus)
+                if shard is not None:
+                    return shard
+            start = time.perf_counter()
+            try:
+                shard = load_shard(corpus)
+            except Exception as e:
+                print(f"Index pool: failed to load {corpus}: {e}")
+                self.errors[corpus] = str(e)
+                return None
+            if shard is None:
+                return None
+            with self._lock:
+                self._shards[corpus] = shard
+                self.loads += 1
+                self.errors.pop(corpus, None)
+                if registry.INDEX_MMAP and not shard.info["mmap"]:
+                    self.mmap_fallbacks += 1
+                self._evict()
+            LOADS.inc(corpus)
+            if registry.INDEX_MMAP and not shard.info["mmap"]:
+                MMAP_FALLBACKS.inc(corpus)
+            print(f"Index pool: {corpus} ready in {time.perf_counter() - start:.3f}s ({shard.size_mb} MB)")
+            return shard
+
+    def peek(self, corpus):
+        """The loaded shard, without loading it or marking it used."""
+        with self._lock:
+            return self._shards.get(corpus)
+
+    def used_mb(self):
+        return round(sum(shard.size_mb for shard in self._shards.values()), 1)
+
+    def _evict(self):
+        """Drops least recently used shards until the pool fits (always keeps the newest). Holds the lock."""
+        while len(self._shards) > 1 and self.used_mb() > self.max_mb:
+            corpus, shard = self._shards.popitem(last=False)
+            self.evictions += 1
+            EVICTIONS.inc(corpus)
+            print(f"Index pool: evicted {corpus} ({shard.size_mb} MB) to stay under {self.max_mb:g} MB")
+
+    def reset(self, *corpora):
+        """Drops loaded shards so they are reloaded on next use (all if no names)."""
+        with self._lock:
+            for corpus in corpora or list(self._shards):
+                self._shards.pop(corpus, None)
+
+    def status(self):
+        with self._lock:
+            return {
+                "max_mb": self.max_mb,
+                "used_mb": self.used_mb(),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "mmap_fallbacks": self.mmap_fallbacks,
+                "shards": {corpus: dict(shard.info) for corpus, shard in self._shards.items()},
+                "errors": dict(self.errors),
+            }
+
+pool = IndexPool()
+metrics.gauge("osbuddy_index_pool_mb", "Estimated memory of the loaded corpus indexes", lambda: pool.status()["used_mb"])
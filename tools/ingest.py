@@ -1,43 +1,450 @@
 import os
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-
-# Paths
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DATA_DIR = os.path.join(BASE_DIR, "tools", "data")
-PDF_PATH = os.path.join(DATA_DIR, "Abraham-Silberschatz-Operating-System-Concepts-10th-2018.pdf")
-INDEX_PATH = os.path.join(BASE_DIR, "faiss_index")
-
-def ingest():
-    print(f"Loading PDF from {PDF_PATH}...")
-    if not os.path.exists(PDF_PATH):
-        print("Error: PDF not found!")
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+# Make `tools.*` importable when run as `python tools/ingest.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import registry, sections
+from tools.bm25 import BM25Index
+from tools.sections import Sectioner, SectionIndex, page_at
+
+# Single ingestion pipeline for the RAG indexes read by agent.py.
+# Usage: python -m tools.ingest [--corpus NAME] [--rebuild] [--dry-run] [--workers N] [--batch-size N]
+#                               [--index-type flat|sq8|fp16|ivfpq] [--nlist N] [--m N]
+#
+# Each corpus (see registry.corpus_data_dir) gets its own index; without
+# --corpus every corpus found under tools/data/ is brought up to date.
+# A manifest next to each index records, per PDF, its content hash and the
+# vector ids of its chunks, plus the settings the index was built with.
+# PDFs are cut into sections along their heading tree before chunking, and a
+# coarse index of those sections is saved next to the chunk index (see
+# tools/sections.py).
+# Unchanged PDFs are skipped; changed/removed PDFs have their vectors deleted
+# and only new content is parsed and embedded. Changing any setting below
+# (or the embedding model) forces a full rebuild.
+
+DATA_DIR = registry.DATA_DIR
+
+INDEX_VERSION = 2  # 2: section-aware chunks + sections.json
+PARSER = "pymupdf4llm"
+CHUNK_SIZE = 2000  # Larger chunks for markdown tables
+CHUNK_OVERLAP = 200
+EXCLUDED_NAMES = ("Finance", "budget")
+
+# Parallelism: pages are parsed in groups of PAGES_PER_TASK across one process
+# pool per run, all groups of a PDF sharing the heading levels found once for
+# the whole document; chunks are embedded and written to the index EMBED_BATCH_SIZE at a time
+# so only one batch of text + vectors is held in memory.
+WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+PAGES_PER_TASK = 8
+
+# Index layout. "flat" is exact search over float32 vectors. "sq8" and "fp16"
+# store int8/float16 codes (4x/2x smaller, still exhaustive). "ivfpq" clusters
+# the vectors into NLIST lists of PQ_M-byte codes and only scans the registry's
+# FAISS_NPROBE nearest lists per query. Trained layouts (sq8, ivfpq) are
+# trained on the first TRAIN_SIZE vectors of a rebuild.
+INDEX_TYPES = ("flat", "sq8", "fp16", "ivfpq")
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+IVF_NLIST = int(os.getenv("INDEX_NLIST", "256"))
+PQ_M = int(os.getenv("INDEX_PQ_M", "16"))
+TRAIN_SIZE = int(os.getenv("INDEX_TRAIN_SIZE", "10000"))
+MIN_PQ_TRAIN = 256  # one training point per PQ centroid (8-bit codes)
+
+def index_options(index_type=INDEX_TYPE, nlist=IVF_NLIST, m=PQ_M):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}")
+    if index_type == "ivfpq":
+        return {"type": index_type, "nlist": nlist, "m": m}
+    return {"type": index_type}
+
+def current_settings(index=None):
+    return {
+        "index_version": INDEX_VERSION,
+        "parser": PARSER,
+        "chunker": {"type": "sections", "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP,
+                    "section_depth": sections.SECTION_DEPTH},
+        "embedding_model": registry.EMBEDDING_MODEL,
+        "index": index or index_options(),
+    }
+
+def factory_string(index, n_train):
+    """faiss.index_factory description for the layout, scaled down for small corpora."""
+    if index["type"] == "sq8":
+        return "SQ8"
+    if index["type"] == "fp16":
+        return "SQfp16"
+    if index["type"] == "ivfpq":
+        if n_train < MIN_PQ_TRAIN:
+            print(f"Only {n_train} vectors; too few to train IVF-PQ, building a flat index instead.")
+            return "Flat"
+        # FAISS wants ~39 training points per IVF centroid
+        nlist = max(1, min(index["nlist"], n_train // 39))
+        return f"IVF{nlist},PQ{index['m']}"
+    return "Flat"
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def discover_corpora():
+    """The default corpus plus one corpus per subdirectory of tools/data/."""
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    corpora = [registry.DEFAULT_CORPUS]
+    for name in sorted(os.listdir(DATA_DIR)):
+        if not os.path.isdir(os.path.join(DATA_DIR, name)):
+            continue
+        if not registry.CORPUS_NAME.match(name) or name == registry.DEFAULT_CORPUS:
+            print(f"Skipping folder {name!r}: corpus names are lowercase letters, digits, - and _, "
+                  f"and {registry.DEFAULT_CORPUS!r} is the top-level folder")
+            continue
+        corpora.append(name)
+    return corpora
+
+def scan_pdfs(data_dir):
+    """Returns {filename: sha256} for every indexable PDF directly in data_dir."""
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    pdfs = {}
+    for filename in sorted(os.listdir(data_dir)):
+        if not filename.endswith(".pdf"):
+            continue
+        # CRITICAL: Filter out leftover Finance/Tax files that might be locked
+        if any(name in filename for name in EXCLUDED_NAMES):
+            print(f"Skipping excluded file: {filename}")
+            continue
+        pdfs[filename] = file_hash(os.path.join(data_dir, filename))
+    return pdfs
+
+def plan(manifest, pdfs, index_path, rebuild=False, index=None):
+    """Diffs the data folder against the manifest. Returns (to_add, to_remove, rebuild)."""
+    settings = current_settings(index)
+    if manifest is None or not os.path.exists(os.path.join(index_path, "index.faiss")):
+        rebuild = True
+    # Manifests written before index layouts were configurable describe a flat index
+    elif any(manifest.get(key, {"type": "flat"} if key == "index" else None) != value
+             for key, value in settings.items()):
+        print("Index settings changed; rebuilding from scratch.")
+        rebuild = True
+    elif SectionIndex.load(index_path) is None:
+        print("No usable section index; rebuilding from scratch.")
+        rebuild = True
+
+    if rebuild:
+        return sorted(pdfs), [], True
+
+    indexed = manifest.get("files", {})
+    to_add = [name for name, sha in pdfs.items() if indexed.get(name, {}).get("sha256") != sha]
+    to_remove = [name for name in indexed if name not in pdfs or name in to_add]
+    if to_remove and manifest.get("index_factory", "Flat").startswith("IVF"):
+        # IVF remove_ids leaves gaps in the positions the docstore mapping relies on
+        print("IVF index cannot delete vectors in place; rebuilding from scratch.")
+        return sorted(pdfs), [], True
+    return sorted(to_add), sorted(to_remove), False
+
+def page_count(path):
+    import pymupdf
+    with pymupdf.open(path) as doc:
+        return doc.page_count
+
+class HeaderLevels:
+    """Heading prefix ("# ", "## ", ...) by rounded font size, as pymupdf4llm's
+    IdentifyHeaders finds them for a whole PDF. Passed to to_markdown as
+    hdr_info so page groups neither rescan the document's fonts nor disagree
+    on heading levels; a plain dict, so it pickles to the workers."""
+
+    def __init__(self, header_id):
+        self.header_id = header_id
+
+    def get_header_id(self, span, page=None):
+        return self.header_id.get(round(span["size"]), "")
+
+def markdown_converter():
+    """pymupdf4llm in its classic mode. Since 1.27 layout mode is the default, and it
+    ignores hdr_info and drops IdentifyHeaders; called in every process that parses
+    (the parent and each spawned worker)."""
+    import pymupdf4llm
+    if hasattr(pymupdf4llm, "use_layout"):
+        pymupdf4llm.use_layout(False)
+    return pymupdf4llm
+
+def header_levels(path):
+    """The PDF's HeaderLevels, or None if this pymupdf4llm has no IdentifyHeaders
+    (to_markdown then scans the headers itself on every call)."""
+    pymupdf4llm = markdown_converter()
+    if not hasattr(pymupdf4llm, "IdentifyHeaders"):
+        return None
+    return HeaderLevels(dict(pymupdf4llm.IdentifyHeaders(path).header_id))
+
+def parse_pool(workers):
+    """The process pool every PDF of one ingest run is parsed on (a null context for in-process parsing)."""
+    if workers <= 1:
+        return nullcontext(None)
+    # spawn: never fork a process that may already hold torch/OpenMP threads
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=markdown_converter)
+
+def parse_pages(path, pages, headers=None):
+    """Process-pool task: converts a range of pages to markdown (Tables preserved, Images skipped).
+    Returns [(page_number, markdown)], page numbers starting at 1."""
+    pymupdf4llm = markdown_converter()
+    chunks = pymupdf4llm.to_markdown(path, pages=pages, hdr_info=headers or header_levels(path),
+                                     write_images=False, page_chunks=True)
+    return [(chunk.get("metadata", {}).get("page", number + 1), chunk["text"])
+            for number, chunk in zip(pages, chunks)]
+
+def iter_page_markdown(path, pool=None):
+    """Yields [(page_number, markdown)] per page group, in page order."""
+    total = page_count(path)
+    groups = [list(range(i, min(i + PAGES_PER_TASK, total))) for i in range(0, total, PAGES_PER_TASK)]
+    headers = header_levels(path)
+    if pool is None or len(groups) <= 1:
+        for pages in groups:
+            yield parse_pages(path, pages, headers)
         return
+    yield from pool.map(parse_pages, [path] * len(groups), groups, [headers] * len(groups))
+
+def iter_sections(path, sectioner, pool, stats):
+    """Yields one PDF's sections (see tools/sections.py) as its pages are parsed."""
+    for pages in iter_page_markdown(path, pool):
+        stats["pages"] += len(pages)
+        for page, md_text in pages:
+            yield from sectioner.feed(page, md_text)
+    yield from sectioner.close()
+
+def iter_chunks(data_dir, filename, sha, pool, stats, section_index=None):
+    """Yields (Document, id) for one PDF as its pages are parsed. Chunks never
+    cross a section and carry its heading path and their pages; each section
+    is registered in `section_index` before its chunks are yielded."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                              add_start_index=True)
+    index = 0
+    sectioner = Sectioner(filename, sha[:16])
+    for section in iter_sections(os.path.join(data_dir, filename), sectioner, pool, stats):
+        split_start = time.perf_counter()
+        metadata = {"source": filename, "section": " > ".join(section["path"]), "section_id": section["id"]}
+        chunks = splitter.create_documents([section["text"]], metadatas=[metadata])
+        ids = []
+        for chunk in chunks:
+            start = max(chunk.metadata.pop("start_index", 0), 0)
+            chunk.metadata["page"] = page_at(section, start)
+            chunk.metadata["page_end"] = page_at(section, start + len(chunk.page_content) - 1)
+            ids.append(f"{sha[:16]}-{index}")
+            index += 1
+        stats["split_s"] += time.perf_counter() - split_start
+        if not chunks:
+            continue
+        stats["sections"] += 1
+        if section_index is not None:
+            section_index.add(section, ids)
+        for chunk, chunk_id in zip(chunks, ids):
+            stats["chunks"] += 1
+            yield chunk, chunk_id
+
+class IndexWriter:
+    """Embeds batches of chunks and appends them to the vector store, the
+    BM25 index and their sections' vectors.
+
+    The store is created on the first write. For trained layouts the first
+    TRAIN_SIZE vectors are held back, used to train the index, then added.
+    """
+
+    def __init__(self, embeddings, index, vector_store=None):
+        self.embeddings = embeddings
+        self.index = index
+        self.vector_store = vector_store
+        self.lexical = BM25Index()
+        self.sections = SectionIndex()
+        self.factory = None
+        self.pending = []
+
+    def write(self, batch, stats):
+        embed_start = time.perf_counter()
+        texts = [doc.page_content for doc, _ in batch]
+        vectors = self.embeddings.embed_documents(texts)
+        self.sections.add_vectors([doc.metadata.get("section_id") for doc, _ in batch], vectors)
+        rows = list(zip(texts, vectors, [doc.metadata for doc, _ in batch], [chunk_id for _, chunk_id in batch]))
+        if self.vector_store is None:
+            self.pending.extend(rows)
+            if self.index["type"] not in ("sq8", "ivfpq") or len(self.pending) >= TRAIN_SIZE:
+                self.flush()
+        else:
+            self._add(rows)
+        stats["vectors"] += len(batch)
+        stats["embed_s"] += time.perf_counter() - embed_start
+
+    def flush(self):
+        """Creates the store from held-back vectors (if any). Returns the store."""
+        if self.vector_store is None and self.pending:
+            self.vector_store = self._create([vector for _, vector, _, _ in self.pending])
+            self._add(self.pending)
+            self.pending = []
+        return self.vector_store
+
+    def _create(self, training_vectors):
+        import faiss
+        import numpy as np
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        from langchain_community.vectorstores import FAISS
+
+        self.factory = factory_string(self.index, len(training_vectors))
+        train_start = time.perf_counter()
+        index = faiss.index_factory(len(training_vectors[0]), self.factory)
+        if not index.is_trained:
+            index.train(np.asarray(training_vectors, dtype="float32"))
+            print(f"Trained {self.factory} on {len(training_vectors)} vectors in {time.perf_counter() - train_start:.1f}s")
+        return FAISS(embedding_function=self.embeddings, index=index,
+                     docstore=InMemoryDocstore(), index_to_docstore_id={})
+
+    def _add(self, rows):
+        texts, vectors, metadatas, ids = zip(*rows)
+        self.vector_store.add_embeddings(list(zip(texts, vectors)), metadatas=list(metadatas), ids=list(ids))
+        for chunk_id, text in zip(ids, texts):
+            self.lexical.add(chunk_id, text)
+
+def index_file(writer, data_dir, filename, sha, pool, batch_size):
+    """Streams one PDF through parse -> split -> embed -> index. Returns the chunk ids."""
+    stats = {"pages": 0, "sections": 0, "chunks": 0, "vectors": 0, "split_s": 0.0, "embed_s": 0.0}
+    start = time.perf_counter()
+    ids, batch = [], []
+    for chunk, chunk_id in iter_chunks(data_dir, filename, sha, pool, stats, writer.sections):
+        batch.append((chunk, chunk_id))
+        ids.append(chunk_id)
+        if len(batch) >= batch_size:
+            writer.write(batch, stats)
+            batch = []
+    if batch:
+        writer.write(batch, stats)
+
+    elapsed = time.perf_counter() - start
+    parse_s = max(elapsed - stats["split_s"] - stats["embed_s"], 1e-9)
+    print(f"Indexed {filename}: {stats['pages']} pages, {stats['sections']} sections, "
+          f"{stats['chunks']} chunks in {elapsed:.1f}s "
+          f"[parse {stats['pages'] / parse_s:.1f} pages/s, "
+          f"split {stats['chunks'] / max(stats['split_s'], 1e-9):.0f} chunks/s, "
+          f"embed {stats['vectors'] / max(stats['embed_s'], 1e-9):.1f} vectors/s]")
+    return ids, stats["sections"]
+
+def save_manifest(manifest, index_path):
+    manifest_path = os.path.join(index_path, "manifest.json")
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def save_index(vector_store, lexical, section_index, index_path):
+    """Writes the index next to the live one and swaps it in with a rename.
+
+    Workers may have the old index.faiss memory-mapped; overwriting it in place
+    would change pages under them, while a rename leaves their inode intact.
+    """
+    tmp_path = index_path + ".tmp"
+    vector_store.save_local(tmp_path)
+    lexical.save(tmp_path)
+    section_index.save(tmp_path)
+    os.makedirs(index_path, exist_ok=True)
+    for name in ("index.faiss", "index.pkl", "bm25.json", sections.FILENAME, sections.VECTORS_FILENAME):
+        os.replace(os.path.join(tmp_path, name), os.path.join(index_path, name))
+    os.rmdir(tmp_path)
+
+def ingest(rebuild=False, dry_run=False, workers=WORKERS, batch_size=EMBED_BATCH_SIZE, index=None, corpus=None):
+    """Brings one corpus's index up to date (the default corpus if none). Returns its manifest."""
+    start = time.perf_counter()
+    corpus = corpus or registry.DEFAULT_CORPUS
+    data_dir, index_path = registry.corpus_data_dir(corpus), registry.corpus_index_path(corpus)
+    index = index or index_options()
+    manifest = registry.get_manifest(corpus)
+    pdfs = scan_pdfs(data_dir)
+    to_add, to_remove, rebuild = plan(manifest, pdfs, index_path, rebuild, index)
+
+    print(f"[{corpus}] {len(pdfs)} PDFs found: {len(to_add)} to (re)index, {len(to_remove)} to remove"
+          f"{' (full rebuild)' if rebuild else ''}.")
+    if dry_run or (not to_add and not to_remove):
+        print("Index is up to date." if not dry_run else "Dry run; nothing written.")
+        return manifest
+
+    from langchain_community.vectorstores import FAISS
+
+    settings = current_settings(index)
+    embeddings = registry.make_embeddings(settings["embedding_model"], batch_size=batch_size)
+    files = {} if rebuild else dict(manifest.get("files", {}))
+    writer = IndexWriter(embeddings, index)
+    if not rebuild:
+        writer.vector_store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+        writer.factory = manifest.get("index_factory", "Flat")
+        # Indexes built before BM25 was added get it backfilled from their chunks
+        writer.lexical = BM25Index.load(index_path) or BM25Index.from_docstore(writer.vector_store)
+        writer.sections = SectionIndex.load(index_path)
+
+    for filename in to_remove:
+        ids = files.pop(filename, {}).get("chunk_ids", [])
+        if ids:
+            writer.vector_store.delete(ids)
+            writer.lexical.remove(ids)
+        writer.sections.remove([filename])
+        print(f"Removed {len(ids)} vectors for {filename}")
 
-    loader = PyPDFLoader(PDF_PATH)
-    documents = loader.load()
-    print(f"Loaded {len(documents)} pages.")
+    with parse_pool(workers) as pool:
+        for filename in to_add:
+            print(f"Processing PDF: {filename}...")
+            ids, section_count = index_file(writer, data_dir, filename, pdfs[filename], pool, batch_size)
+            files[filename] = {
+                "sha256": pdfs[filename],
+                "chunk_ids": ids,
+                "sections": section_count,
+                "indexed_at": datetime.now(timezone.utc).isoformat(),
+            }
 
-    print("Splitting text...")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        add_start_index=True
-    )
-    chunks = text_splitter.split_documents(documents)
-    print(f"Created {len(chunks)} chunks.")
+    vector_store = writer.flush()
+    if vector_store is None:
+        print("No PDF documents found to index.")
+        return manifest
 
-    print("Creating embeddings (this may take a minute)...")
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    save_index(vector_store, writer.lexical, writer.sections, index_path)
+    manifest = dict(settings, corpus=corpus, files=files, index_factory=writer.factory,
+                    revision=(manifest or {}).get("revision", 0) + 1,
+                    updated_at=datetime.now(timezone.utc).isoformat())
+    save_manifest(manifest, index_path)
+    print(f"Index revision {manifest['revision']} saved to {index_path} in {time.perf_counter() - start:.1f}s")
+    return manifest
 
-    print("Building Vector Store...")
-    vector_store = FAISS.from_documents(chunks, embeddings)
+def ingest_all(**options):
+    """Runs ingest() for every corpus under tools/data/. Returns {corpus: manifest}."""
+    return {corpus: ingest(corpus=corpus, **options) for corpus in discover_corpora()}
 
-    print(f"Saving index to {INDEX_PATH}...")
-    vector_store.save_local(INDEX_PATH)
-    print("Done!")
+def main():
+    parser = argparse.ArgumentParser(description="Build or incrementally update the OS Buddy RAG indexes.")
+    parser.add_argument("--corpus", help="Only this corpus (default: every corpus under tools/data/)")
+    parser.add_argument("--rebuild", action="store_true", help="Ignore the manifest and re-index every PDF")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would change")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Processes used to parse PDF pages")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Chunks embedded and written per batch")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=INDEX_TYPE, help="FAISS index layout")
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST, help="IVF lists (ivfpq only)")
+    parser.add_argument("--m", type=int, default=PQ_M, help="PQ bytes per vector; must divide the dimension (ivfpq only)")
+    args = parser.parse_args()
+    options = dict(rebuild=args.rebuild, dry_run=args.dry_run, workers=args.workers, batch_size=args.batch_size,
+                   index=index_options(args.index_type, args.nlist, args.m))
+    if args.corpus:
+        if args.corpus not in discover_corpora():
+            parser.error(f"no corpus {args.corpus!r}; expected one of {', '.join(discover_corpora())}")
+        ingest(corpus=args.corpus, **options)
+    else:
+        ingest_all(**options)
 
 if __name__ == "__main__":
-    ingest()
+    main()
@@ -0,0 +1,281 @@
+import os
+import time
+import random
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import Future
+from tools import metrics, prompt_builder, registry
+
+# Every Groq call goes through here. Per model, a token bucket enforces
+# LLM_RPM requests and LLM_TPM tokens per minute; a call that would wait
+# longer than LLM_QUEUE_WAIT seconds for its turn fails fast with
+# LLMSaturated (the app answers 503 + Retry-After). Identical prompts already
+# in flight share one call, and rate-limit / transient errors are retried
+# with jittered exponential backoff. A 429 from Groq pauses the bucket for
+# the Retry-After it sends.
+#
+# Limits are for the whole Groq account and split evenly across the
+# registry.WEB_CONCURRENCY gunicorn workers, since each worker has its own
+# buckets (a single-process server therefore stays under the account limit).
+
+_WORKERS = registry.WEB_CONCURRENCY
+LLM_RPM = float(os.getenv("LLM_RPM", "30")) / _WORKERS
+LLM_TPM = float(os.getenv("LLM_TPM", "12000")) / _WORKERS
+LLM_QUEUE_WAIT = float(os.getenv("LLM_QUEUE_WAIT", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+# Reply tokens reserved up front; corrected once the reply is known
+COMPLETION_ESTIMATE = int(os.getenv("LLM_COMPLETION_ESTIMATE", "600"))
+
+CALLS = metrics.counter("osbuddy_llm_calls_total", "LLM gateway calls by outcome", ("model", "outcome"))
+QUEUE_SECONDS = metrics.histogram("osbuddy_llm_queue_seconds", "Time spent waiting for a rate-limit slot", ("model",))
+
+class LLMSaturated(Exception):
+    """The rate limit cannot admit the call within the allowed wait."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM rate limit saturated; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class RateLimiter:
+    """Request and token buckets for one model, refilled continuously."""
+
+    def __init__(self, rpm=LLM_RPM, tpm=LLM_TPM):
+        self.rates = (rpm / 60.0, tpm / 60.0)
+        self.capacity = (max(rpm, 1.0), max(tpm, 1.0))
+        self.level = list(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        for i in (0, 1):
+            self.level[i] = min(self.capacity[i], self.level[i] + elapsed * self.rates[i])
+
+    def reserve(self, tokens, max_wait):
+        """Takes one request and `tokens` tokens. Returns seconds to wait before calling.
+        Levels may go negative; later callers queue behind the debt."""
+        tokens = min(tokens, self.capacity[1])
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(
+                self.paused_until - now,
+                (1 - self.level[0]) / self.rates[0],
+                (tokens - self.level[1]) / self.rates[1],
+                0.0,
+            )
+            if wait > max_wait:
+                raise LLMSaturated(wait)
+            self.level[0] -= 1
+            self.level[1] -= tokens
+            return wait
+
+    def refund(self, tokens):
+        with self._lock:
+            self.level[1] = min(self.capacity[1], self.level[1] + tokens)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def waiting_seconds(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, -self.level[0] / self.rates[0], -self.level[1] / self.rates[1])
+
+def retry_after(error):
+    """Seconds the provider asked us to wait, if the error carries a Retry-After header."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def is_rate_limited(error):
+    return getattr(error, "status_code", None) == 429 or "rate limit" in str(error).lower()
+
+def is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if is_rate_limited(error) or (status is not None and status >= 500):
+        return True
+    text = str(error).lower()
+    return "timed out" in text or "connection" in text
+
+def backoff(attempt, error):
+    hinted = retry_after(error)
+    if hinted is not None:
+        return hinted + random.uniform(0, 1)
+    return min(30.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+class LLMGateway:
+    def __init__(self):
+        self._limiters = {}
+        self._inflight = {}  # (model, prompt hash) -> Future shared by identical calls
+        self._lock = threading.Lock()
+
+    def limiter(self, model):
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = RateLimiter()
+            return self._limiters[model]
+
+    @staticmethod
+    def model_name(llm):
+        return getattr(llm, "model_name", None) or type(llm).__name__
+
+    def _admit(self, model, tokens, max_wait):
+        """Reserves a slot. Returns (limiter, seconds to wait)."""
+        limiter = self.limiter(model)
+        try:
+            wait = limiter.reserve(tokens + COMPLETION_ESTIMATE, LLM_QUEUE_WAIT if max_wait is None else max_wait)
+        except LLMSaturated:
+            CALLS.inc(model, "saturated")
+            raise
+        QUEUE_SECONDS.observe(wait, model)
+        return limiter, wait
+
+    def _settle(self, limiter, reply):
+        limiter.refund(max(0, COMPLETION_ESTIMATE - prompt_builder.count_tokens(reply)))
+
+    def _failed(self, model, limiter, attempt, error):
+        """Returns seconds to sleep before retrying, or re-raises."""
+        if attempt >= LLM_MAX_RETRIES or not is_retryable(error):
+            CALLS.inc(model, "error")
+            raise error
+        delay = backoff(attempt, error)
+        if is_rate_limited(error):
+            limiter.pause(delay)  # the provider's window is stricter than ours; hold everyone back
+        CALLS.inc(model, "retry")
+        print(f"LLM call to {model} failed ({error}); retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+        return delay
+
+    def _join(self, key):
+        """Returns (future, leader): the in-flight call for `key`, or a new one this caller must run."""
+        with self._lock:
+            if key in self._inflight:
+                return self._inflight[key], False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def _publish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def invoke(self, llm, prompt, tokens=0, max_wait=None):
+        """llm.invoke(prompt) under the model's rate limit. `tokens` is the prompt's size."""
+        model = self.model_name(llm)
+        key = (model, hashlib.sha256(prompt.encode()).hexdigest())
+        future, leader = self._join(key)
+        if not leader:
+            CALLS.inc(model, "coalesced")
+            return future.result()
+        try:
+            limiter, wait = self._admit(model, tokens, max_wait)
+            time.sleep(wait)
+            attempt = 0
+            while True:
+                try:
+                    reply = llm.invoke(prompt)
+                    break
+                except Exception as e:
+                    time.sleep(self._failed(model, limiter, attempt, e))
+                    attempt += 1
+            CALLS.inc(model, "ok")
+            self._settle(limiter, reply.content)
+        except BaseException as e:
+            self._publish(key, future, error=e)
+            raise
+        self._publish(key, future, reply)
+        return reply
+
+    async def ainvoke(self, llm, prompt, tokens=0, max_wait=None):
+        """asyncio variant of invoke()."""
+        model = self.model_name(llm)
+        key = (model, hashlib.sha256(prompt.encode()).hexdigest())
+        future, leader = self._join(key)
+        if not leader:
+            CALLS.inc(model, "coalesced")
+            return await asyncio.wrap_future(future)
+        try:
+            limiter, wait = self._admit(model, tokens, max_wait)
+            await asyncio.sleep(wait)
+            attempt = 0
+            while True:
+                try:
+                    reply = await llm.ainvoke(prompt)
+                    break
+                except Exception as e:
+                    await asyncio.sleep(self._failed(model, limiter, attempt, e))
+                    attempt += 1
+            CALLS.inc(model, "ok")
+            self._settle(limiter, reply.content)
+        except BaseException as e:
+            self._publish(key, future, error=e)
+            raise
+        self._publish(key, future, reply)
+        return reply
+
+    def stream(self, llm, prompt, tokens=0, max_wait=None):
+        """llm.stream(prompt) under the rate limit. Retries only until the first chunk arrives."""
+        model = self.model_name(llm)
+        limiter, wait = self._admit(model, tokens, max_wait)
+        time.sleep(wait)
+        attempt, parts = 0, []
+        while True:
+            try:
+                for chunk in llm.stream(prompt):
+                    parts.append(chunk.content or "")
+                    yield chunk
+                break
+            except Exception as e:
+                if parts:
+                    CALLS.inc(model, "error")
+                    raise
+                time.sleep(self._failed(model, limiter, attempt, e))
+                attempt += 1
+        CALLS.inc(model, "ok")
+        self._settle(limiter, "".join(parts))
+
+    async def astream(self, llm, prompt, tokens=0, max_wait=None):
+        """asyncio variant of stream()."""
+        model = self.model_name(llm)
+        limiter, wait = self._admit(model, tokens, max_wait)
+        await asyncio.sleep(wait)
+        attempt, parts = 0, []
+        while True:
+            try:
+                async for chunk in llm.astream(prompt):
+                    parts.append(chunk.content or "")
+                    yield chunk
+                break
+            except Exception as e:
+                if parts:
+                    CALLS.inc(model, "error")
+                    raise
+                await asyncio.sleep(self._failed(model, limiter, attempt, e))
+                attempt += 1
+        CALLS.inc(model, "ok")
+        self._settle(limiter, "".join(parts))
+
+    def status(self):
+        with self._lock:
+            limiters = dict(self._limiters)
+            inflight = len(self._inflight)
+        return {
+            "rpm": LLM_RPM,
+            "tpm": LLM_TPM,
+            "coalescing": inflight,
+            "backlog_s": {model: round(limiter.waiting_seconds(), 2) for model, limiter in limiters.items()},
+        }
+
+gateway = LLMGateway()
+metrics.gauge("osbuddy_llm_backlog_seconds", "Seconds of queued LLM work per model",
+              lambda: gateway.status()["backlog_s"], label="model")
@@ -0,0 +1,390 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# Local fallback storage for MongoDBManager: SQLite in WAL mode with one row
+# per session and one row per message, so a chat turn touches only its own
+# session instead of rewriting the whole history file. SQLite's file locks
+# make it safe for several gunicorn workers to share the same database.
+#
+# Session metadata (id, user, title, timestamp) is kept in an in-memory index.
+# Every write transaction bumps a counter in `meta`; this process's own writes
+# patch just the sessions they touched, and the index is reloaded only when
+# the counter shows a write from another worker, so listing sessions normally
+# costs one single-row read.
+#
+# While MongoDB is down, every write is also recorded in pending_writes (in the
+# same transaction) and replayed to Mongo in order once it recovers. A write
+# that still fails after REPLAY_MAX_ATTEMPTS replays is moved to dead_writes
+# (kept for inspection) so it cannot hold up the writes queued behind it.
+
+COMPACT_EVERY = int(os.getenv("LOCAL_STORE_COMPACT_EVERY", "500"))
+# A worker that dies mid-replay releases the replay lock after this many seconds
+REPLAY_LOCK_TTL = 120
+REPLAY_MAX_ATTEMPTS = int(os.getenv("LOCAL_STORE_REPLAY_MAX_ATTEMPTS", "5"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    title TEXT,
+    timestamp REAL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_user_timestamp ON sessions (user_id, timestamp DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS pending_writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS dead_writes (
+    id INTEGER PRIMARY KEY,
+    op TEXT NOT NULL,
+    created REAL NOT NULL,
+    failed REAL NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class LocalSessionStore:
+    def __init__(self, path, legacy_json=None):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._index = {}  # session id -> {"id", "user_id", "title", "timestamp"}
+        self._index_version = None  # value of the write counter the index reflects
+        self._writes = 0
+
+        self._conn().executescript(SCHEMA)
+        self._migrate()
+        if legacy_json:
+            self._import_legacy(legacy_json)
+
+    # --- Connections ---
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    class _Transaction:
+        def __init__(self, store):
+            self.store = store
+
+        def __enter__(self):
+            self.conn = self.store._conn()
+            # IMMEDIATE takes the write lock up front so concurrent workers queue instead of deadlocking
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.store._local.changes = {}
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            changes, self.store._local.changes = self.store._local.changes, None
+            if exc_type:
+                self.conn.execute("ROLLBACK")
+                return False
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('writes', 1) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+            )
+            version = int(self.conn.execute("SELECT value FROM meta WHERE key = 'writes'").fetchone()[0])
+            self.conn.execute("COMMIT")
+            self.store._patch_index(changes, version)
+            self.store._after_write()
+            return False
+
+    def _write(self):
+        return self._Transaction(self)
+
+    def _after_write(self):
+        self._writes += 1
+        if COMPACT_EVERY and self._writes % COMPACT_EVERY == 0:
+            self.compact()
+
+    def _migrate(self):
+        """Adds columns introduced after a database file was created."""
+        conn = self._conn()
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(pending_writes)")]
+        if "attempts" not in columns:
+            try:
+                conn.execute("ALTER TABLE pending_writes ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass  # another worker added it first
+
+    # --- Metadata index ---
+
+    def _refresh_index(self):
+        """Reloads session metadata if a write not yet in the index has been committed."""
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'writes'").fetchone()
+        version = int(row[0]) if row else 0
+        with self._lock:
+            if version == self._index_version:
+                return
+            rows = conn.execute("SELECT id, user_id, title, timestamp FROM sessions").fetchall()
+            self._index = {
+                row[0]: {"id": row[0], "user_id": row[1], "title": row[2], "timestamp": row[3]}
+                for row in rows
+            }
+            self._index_version = version
+
+    def _patch_index(self, changes, version):
+        """Applies a committed write's session changes (id -> entry, None if deleted) to the index.
+        If another write came in between, the index is left stale and reloads on the next read."""
+        with self._lock:
+            if self._index_version != version - 1:
+                return
+            for session_id, entry in changes.items():
+                if entry is None:
+                    self._index.pop(session_id, None)
+                else:
+                    self._index[session_id] = entry
+            self._index_version = version
+
+    # --- Sessions ---
+
+    @staticmethod
+    def _split(session_data):
+        meta = {k: v for k, v in session_data.items() if k != "messages"}
+        return meta, session_data.get("messages", [])
+
+    def list_sessions(self, user_id=None, limit=None, after=None):
+        """Newest first; `after` is the (timestamp, id) of the last item already seen."""
+        self._refresh_index()
+        sessions = [
+            {"id": s["id"], "title": s["title"] or "New Chat", "timestamp": s["timestamp"] or 0}
+            for s in self._index.values()
+            if not user_id or s["user_id"] == user_id
+        ]
+        sessions.sort(key=lambda s: (s["timestamp"], s["id"]), reverse=True)
+        if after:
+            sessions = [s for s in sessions if (s["timestamp"], s["id"]) < after]
+        return sessions[:limit] if limit else sessions
+
+    def get_session(self, session_id, last_n=None):
+        conn = self._conn()
+        row = conn.execute("SELECT doc FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        session = json.loads(row[0])
+        if last_n:
+            rows = conn.execute(
+                "SELECT data FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?", (session_id, last_n)
+            ).fetchall()[::-1]
+        else:
+            rows = conn.execute("SELECT data FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        session["messages"] = [json.loads(data) for (data,) in rows]
+        return session
+
+    def get_messages_page(self, session_id, limit, before=None):
+        """The `limit` messages before index `before` (newest if None). Returns (session, start) or None.
+        Message seq numbers are contiguous from 0, so they double as indexes."""
+        conn = self._conn()
+        row = conn.execute("SELECT doc FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        session = json.loads(row[0])
+        count = conn.execute("SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+        end = count if before is None else max(0, min(before, count))
+        rows = conn.execute(
+            "SELECT data FROM messages WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+            (session_id, end, limit)
+        ).fetchall()[::-1]
+        session["messages"] = [json.loads(data) for (data,) in rows]
+        session["message_count"] = count
+        return session, end - len(rows)
+
+    def save_session(self, session_id, session_data, pending=None):
+        meta, messages = self._split(session_data)
+        with self._write() as conn:
+            self._enqueue(conn, pending)
+            self._upsert_meta(conn, session_id, meta)
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, data) VALUES (?, ?, ?)",
+                [(session_id, seq, json.dumps(msg, default=str)) for seq, msg in enumerate(messages)]
+            )
+
+    def append_messages(self, session_id, messages, metadata, pending=None):
+        """Inserts only the new message rows and merges metadata into the session row."""
+        with self._write() as conn:
+            self._enqueue(conn, pending)
+            row = conn.execute("SELECT doc FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            meta = json.loads(row[0]) if row else {"id": session_id, "title": "New Chat"}
+            meta.update(metadata)
+            self._upsert_meta(conn, session_id, meta)
+            next_seq = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, data) VALUES (?, ?, ?)",
+                [(session_id, next_seq + i, json.dumps(msg, default=str)) for i, msg in enumerate(messages)]
+            )
+
+    def set_session_fields(self, session_id, fields, pending=None):
+        """Merges fields into an existing session row. Returns False (and queues nothing) if it is gone."""
+        with self._write() as conn:
+            row = conn.execute("SELECT doc FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return False
+            self._enqueue(conn, pending)
+            meta = json.loads(row[0])
+            meta.update(fields)
+            conn.execute(
+                "UPDATE sessions SET user_id = ?, title = ?, timestamp = ?, doc = ? WHERE id = ?",
+                (meta.get("user_id"), meta.get("title"), meta.get("timestamp"), json.dumps(meta, default=str),
+                 session_id)
+            )
+            self._local.changes[session_id] = self._entry(session_id, meta)
+        return True
+
+    @staticmethod
+    def _entry(session_id, meta):
+        """A session's row in the in-memory metadata index."""
+        return {"id": session_id, "user_id": meta.get("user_id"), "title": meta.get("title"),
+                "timestamp": meta.get("timestamp")}
+
+    def _upsert_meta(self, conn, session_id, meta):
+        conn.execute(
+            "INSERT INTO sessions (id, user_id, title, timestamp, doc) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET user_id = excluded.user_id, title = excluded.title, "
+            "timestamp = excluded.timestamp, doc = excluded.doc",
+            (session_id, meta.get("user_id"), meta.get("title"), meta.get("timestamp"),
+             json.dumps(meta, default=str))
+        )
+        self._local.changes[session_id] = self._entry(session_id, meta)
+
+    def session_owner(self, session_id):
+        row = self._conn().execute("SELECT user_id FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def delete_session(self, session_id, pending=None):
+        with self._write() as conn:
+            self._enqueue(conn, pending)
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._local.changes[session_id] = None
+
+    # --- Write-ahead queue for MongoDB ---
+
+    @staticmethod
+    def _enqueue(conn, pending):
+        if pending is not None:
+            conn.execute("INSERT INTO pending_writes (op, created) VALUES (?, ?)", (pending, time.time()))
+
+    def pending_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM pending_writes").fetchone()[0]
+
+    def dead_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM dead_writes").fetchone()[0]
+
+    def replay_writes(self, apply, batch_size=100):
+        """
+        Calls apply(op) for each queued write, oldest first, deleting each once
+        applied. Returns the number replayed, or None if another worker holds
+        the replay lock. If apply raises, the write's attempt count goes up, the
+        lock is released and the error propagates; unapplied writes stay queued.
+        A write failing for the REPLAY_MAX_ATTEMPTS-th time is moved to
+        dead_writes instead and the replay goes on with the next one.
+        """
+        owner = f"{os.getpid()}:{threading.get_ident()}"
+        with self._write() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'replay_lock'").fetchone()
+            if row and row[0].split("|")[0] != owner and float(row[0].split("|")[1]) > time.time():
+                return None
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('replay_lock', ?)",
+                         (f"{owner}|{time.time() + REPLAY_LOCK_TTL}",))
+
+        replayed = 0
+        try:
+            while True:
+                rows = self._conn().execute(
+                    "SELECT id, op, attempts FROM pending_writes ORDER BY id LIMIT ?", (batch_size,)
+                ).fetchall()
+                if not rows:
+                    return replayed
+                for write_id, op, attempts in rows:
+                    try:
+                        apply(op)
+                    except Exception as e:
+                        dead = attempts + 1 >= REPLAY_MAX_ATTEMPTS
+                        with self._write() as conn:
+                            if dead:
+                                conn.execute(
+                                    "INSERT OR REPLACE INTO dead_writes (id, op, created, failed, error) "
+                                    "SELECT id, op, created, ?, ? FROM pending_writes WHERE id = ?",
+                                    (time.time(), repr(e), write_id)
+                                )
+                                conn.execute("DELETE FROM pending_writes WHERE id = ?", (write_id,))
+                            else:
+                                conn.execute("UPDATE pending_writes SET attempts = attempts + 1 WHERE id = ?",
+                                             (write_id,))
+                        if not dead:
+                            raise
+                        print(f"Queued write {write_id} failed {attempts + 1} times, moved to dead_writes: {e}")
+                        continue
+                    with self._write() as conn:
+                        conn.execute("DELETE FROM pending_writes WHERE id = ?", (write_id,))
+                    replayed += 1
+        finally:
+            with self._write() as conn:
+                conn.execute("DELETE FROM meta WHERE key = 'replay_lock'")
+
+    # --- Maintenance ---
+
+    def compact(self):
+        """Folds the WAL back into the main file and reclaims space left by deletes."""
+        conn = self._conn()
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            total_pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            if total_pages and free_pages > total_pages // 4:
+                conn.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            # Another worker holds the database; try again on the next cycle
+            print(f"Local store compaction skipped: {e}")
+
+    def _import_legacy(self, legacy_json):
+        """One-time import of the old whole-file chat_history.json."""
+        if not os.path.exists(legacy_json):
+            return
+        if self._conn().execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return
+        try:
+            with open(legacy_json, "r") as f:
+                history = json.load(f)
+        except Exception as e:
+            print(f"Skipping legacy history import: {e}")
+            history = {}
+        with self._write() as conn:
+            # Re-check under the write lock; another worker may have imported meanwhile
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+                return
+            for session_id, session_data in history.items():
+                meta, messages = self._split(session_data)
+                self._upsert_meta(conn, session_id, meta)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO messages (session_id, seq, data) VALUES (?, ?, ?)",
+                    [(session_id, seq, json.dumps(msg, default=str)) for seq, msg in enumerate(messages)]
+                )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)", (legacy_json,))
+        print(f"Imported {len(history)} sessions from {legacy_json}")
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Per-process request tracing and Prometheus metrics, without a client
+# library. A trace covers one request: span(stage) times a stage into the
+# osbuddy_stage_seconds histogram and into the current trace, and the trace
+# logs one JSON line when it finishes. GET /metrics renders everything in the
+# Prometheus text format; each gunicorn worker reports its own series, so
+# scrape per worker or sum by pid.
+
+LOG_REQUESTS = os.getenv("LOG_REQUESTS", "1") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, values)} {total}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, tuple(labels), tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.setdefault(label_values, [0] * (len(self.buckets) + 1) + [0.0])
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for values, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                    cumulative += count
+                    labels = _label_text(self.labels + ("le",), values + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _label_text(self.labels, values)
+                lines.append(f"{self.name}_sum{labels} {round(series[-1], 6)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+REQUEST_SECONDS = Histogram("osbuddy_request_seconds", "End-to-end request latency", ("route",))
+STAGE_SECONDS = Histogram("osbuddy_stage_seconds", "Latency of each request stage", ("stage",))
+REQUESTS = Counter("osbuddy_requests_total", "Finished requests", ("route", "status"))
+ERRORS = Counter("osbuddy_errors_total", "Exceptions raised inside a stage", ("stage",))
+TOKENS = Counter("osbuddy_tokens_total", "Estimated LLM tokens (4 chars/token)", ("kind",))
+_metrics = [REQUEST_SECONDS, STAGE_SECONDS, REQUESTS, ERRORS, TOKENS]
+_gauges = []  # (name, help, callback returning a number or {label value: number}, label name)
+
+def counter(name, help_text, labels=()):
+    """Creates a counter that /metrics renders (for metrics owned by other modules)."""
+    metric = Counter(name, help_text, labels)
+    _metrics.append(metric)
+    return metric
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    metric = Histogram(name, help_text, labels, buckets)
+    _metrics.append(metric)
+    return metric
+
+def gauge(name, help_text, callback, label=None):
+    """Registers a gauge sampled at scrape time."""
+    _gauges.append((name, help_text, callback, label))
+
+class Trace:
+    def __init__(self, route):
+        self.route = route
+        self.id = uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.fields = {}
+
+    def add_span(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def finish(self, status):
+        elapsed = time.perf_counter() - self.start
+        REQUEST_SECONDS.observe(elapsed, self.route)
+        REQUESTS.inc(self.route, status)
+        if LOG_REQUESTS:
+            print(json.dumps({
+                "event": "request", "trace_id": self.id, "route": self.route, "status": status,
+                "duration_ms": round(elapsed * 1000, 1),
+                "spans_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.spans.items()},
+                **self.fields,
+            }, default=str), flush=True)
+
+_current = contextvars.ContextVar("osbuddy_trace", default=None)
+
+def current_trace():
+    return _current.get()
+
+@contextmanager
+def trace(route):
+    """Traces one request. Status is "ok" unless the block raises or sets fields["status"]."""
+    active = Trace(route)
+    token = _current.set(active)
+    status = "error"
+    try:
+        yield active
+        status = active.fields.pop("status", "ok")
+    finally:
+        _current.reset(token)
+        active.finish(status)
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage)
+        active = _current.get()
+        if active is not None:
+            active.add_span(stage, elapsed)
+
+def annotate(**fields):
+    """Adds fields to the current trace's log line (no-op outside a trace)."""
+    active = _current.get()
+    if active is not None:
+        active.fields.update(fields)
+
+def record_error(stage):
+    """Counts an error that was handled rather than raised."""
+    ERRORS.inc(stage)
+    annotate(status="error", error_stage=stage)
+
+def record_tokens(kind, count):
+    TOKENS.inc(kind, amount=count)
+    active = _current.get()
+    if active is not None:
+        active.fields[f"{kind}_tokens"] = active.fields.get(f"{kind}_tokens", 0) + count
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, help_text, callback, label in _gauges:
+        try:
+            value = callback()
+        except Exception as e:
+            print(f"Metrics: gauge {name} failed: {e}")
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        if isinstance(value, dict):
+            lines += [f"{name}{_label_text((label,), (key,))} {float(v)}" for key, v in sorted(value.items())]
+        else:
+            lines.append(f"{name} {float(value)}")
+    lines.append(f'osbuddy_process_info{{pid="{os.getpid()}"}} 1')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,62 @@
+import os
+import json
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Sentence-transformers models run through ONNX Runtime instead of PyTorch:
+# no torch import, a fraction of the RSS, and no network access. The model
+# directory is produced by `python -m tools.export_onnx` and holds
+# model.onnx (plus model_int8.onnx when quantized), tokenizer.json and
+# onnx_config.json. Pooling and normalization mirror the exported
+# sentence-transformers pipeline.
+
+CONFIG_FILE = "onnx_config.json"
+
+class OnnxEmbeddings(Embeddings):
+    def __init__(self, model_dir, batch_size=32, quantized=False, threads=None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, CONFIG_FILE), "r") as f:
+            self.config = json.load(f)
+        model_file = os.path.join(model_dir, "model_int8.onnx" if quantized else "model.onnx")
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(f"{model_file} not found; export it with python -m tools.export_onnx")
+
+        self.model_name = self.config["model_name"]
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.config["max_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_id"], pad_token=self.config["pad_token"])
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _encode(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        feed = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        }
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        hidden = self.session.run(None, feed)[0]
+
+        # Mean pooling over real (unpadded) tokens
+        mask = feed["attention_mask"][:, :, None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config.get("normalize", True):
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._encode(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
@@ -0,0 +1,81 @@
+import os
+
+# Token-budgeted prompt assembly. The prompt template + user message are
+# measured first; retrieved context gets up to CONTEXT_SHARE of what is left
+# (most relevant chunks first) and the conversation gets the rest, newest turns
+# first. Turns that no longer fit are folded into a rolling summary stored on
+# the session document ("summary" / "summary_through"), see messages_to_summarize.
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3500"))
+CONTEXT_SHARE = float(os.getenv("PROMPT_CONTEXT_SHARE", "0.6"))
+# A partially fitting chunk is truncated only if at least this much room is left
+MIN_CHUNK_TOKENS = 120
+# Summarize once unsummarized history exceeds this, keeping the last few turns verbatim
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "900"))
+KEEP_VERBATIM_MESSAGES = 4
+
+def count_tokens(text):
+    # ~4 characters per token for English under Llama/GPT-style BPE; cheap and
+    # close enough for budgeting (we stay well under the model's context window)
+    return (len(text) + 3) // 4 if text else 0
+
+def fit_context(chunks, budget):
+    """Joins chunks (most relevant first) until the budget is spent. Returns (text, tokens)."""
+    parts, used = [], 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if used + tokens <= budget:
+            parts.append(chunk)
+            used += tokens
+            continue
+        remaining = budget - used
+        if remaining >= MIN_CHUNK_TOKENS:
+            # Cut at a paragraph/line boundary where possible
+            cut = chunk[:remaining * 4]
+            boundary = max(cut.rfind("\n\n"), cut.rfind("\n"))
+            parts.append(cut[:boundary] if boundary > len(cut) // 2 else cut)
+            used += count_tokens(parts[-1])
+        break
+    return "\n\n---\n\n".join(parts), used
+
+def _ts(msg):
+    return msg.get("ts") or 0
+
+def unsummarized(messages, summary_through):
+    """Messages not yet folded into the rolling summary."""
+    if summary_through is None:
+        return list(messages)
+    return [msg for msg in messages if _ts(msg) > summary_through]
+
+def format_message(msg):
+    role = "User" if msg.get("role") == "user" else "Assistant"
+    return f"{role}: {msg.get('content', '')}\n"
+
+def fit_history(messages, summary, budget):
+    """Summary (if any) plus as many recent messages as fit. Returns (text, tokens)."""
+    summary_text = f"(Summary of earlier conversation: {summary})\n" if summary else ""
+    used = count_tokens(summary_text)
+    lines = []
+    for msg in reversed(messages):
+        line = format_message(msg)
+        tokens = count_tokens(line)
+        if used + tokens > budget:
+            break
+        lines.append(line)
+        used += tokens
+    return summary_text + "".join(reversed(lines)), used
+
+def split_budget(template_tokens):
+    """Tokens available for context and history once the fixed parts are paid for."""
+    available = max(PROMPT_TOKEN_BUDGET - template_tokens, 0)
+    return {"available": available, "context": int(available * CONTEXT_SHARE)}
+
+def messages_to_summarize(messages, memory):
+    """
+    Older messages that should be folded into the rolling summary now, or []
+    when the unsummarized history is still small enough to send verbatim.
+    """
+    pending = unsummarized(messages, (memory or {}).get("summary_through"))
+    if sum(count_tokens(format_message(msg)) for msg in pending) <= SUMMARY_TRIGGER_TOKENS:
+        return []
+    return pending[:-KEEP_VERBATIM_MESSAGES]
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import time
+import threading
+import resource
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Process-wide registry of the expensive, read-only resources (embedding model,
+# FAISS indexes, LLM client). Each one is built at most once per process; with
+# gunicorn's preload_app they are built in the master and shared copy-on-write
+# by every forked worker. Corpus indexes are held by tools/index_pool.py, which
+# loads them on demand and may evict them; warm() loads the default corpus.
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_PATH = os.getenv("FAISS_INDEX_PATH", os.path.join(BASE_DIR, "faiss_index"))
+MANIFEST_PATH = os.path.join(INDEX_PATH, "manifest.json")
+# One index per corpus (course). PDFs directly in DATA_DIR are DEFAULT_CORPUS,
+# indexed at INDEX_PATH; each subdirectory DATA_DIR/<name>/ is corpus <name>,
+# indexed at INDEX_PATH/corpora/<name>/. Indexes are loaded by tools/index_pool.py.
+DATA_DIR = os.getenv("INGEST_DATA_DIR", os.path.join(BASE_DIR, "tools", "data"))
+DEFAULT_CORPUS = os.getenv("DEFAULT_CORPUS", "os")
+CORPUS_NAME = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# "torch" runs sentence-transformers; "onnx" runs the model exported by
+# tools/export_onnx.py from ONNX_MODEL_DIR (default models/<model>-onnx)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "")
+ONNX_QUANTIZED = os.getenv("ONNX_QUANTIZED", "0") == "1"
+LLM_MODEL = "llama-3.3-70b-versatile"
+# Small, fast model for housekeeping calls (conversation summaries)
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "llama-3.1-8b-instant")
+# Memory-map index.faiss so forked workers share its pages through the page
+# cache instead of each holding a private copy
+INDEX_MMAP = os.getenv("INDEX_MMAP", "1") == "1"
+# IVF lists scanned per query (ignored by flat / scalar-quantized indexes)
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+# Optional cross-encoder that reorders the fused retrieval candidates
+# (e.g. cross-encoder/ms-marco-MiniLM-L-6-v2); unset disables reranking
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "")
+# gunicorn worker processes (gunicorn.conf.py). Per-process limits, such as the
+# LLM gateway's rate buckets, are split across them.
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "2")))
+
+_lock = threading.RLock()
+_resources = {}
+_timings = {}
+_errors = {}
+
+def _build(name, factory):
+    """Returns the cached resource, building it under the lock on first use."""
+    if name in _resources:
+        return _resources[name]
+    with _lock:
+        if name in _resources:
+            return _resources[name]
+        start = time.perf_counter()
+        try:
+            value = factory()
+        except Exception as e:
+            print(f"Registry: failed to load {name}: {e}")
+            _errors[name] = str(e)
+            return None
+        _timings[name] = round(time.perf_counter() - start, 3)
+        _errors.pop(name, None)
+        if value is not None:
+            _resources[name] = value
+            print(f"Registry: {name} ready in {_timings[name]}s")
+        return value
+
+def corpus_data_dir(corpus=None):
+    corpus = corpus or DEFAULT_CORPUS
+    return DATA_DIR if corpus == DEFAULT_CORPUS else os.path.join(DATA_DIR, corpus)
+
+def corpus_index_path(corpus=None):
+    corpus = corpus or DEFAULT_CORPUS
+    return INDEX_PATH if corpus == DEFAULT_CORPUS else os.path.join(INDEX_PATH, "corpora", corpus)
+
+def list_corpora():
+    """Names of the corpora that have a built index, default first."""
+    names = [DEFAULT_CORPUS] if os.path.exists(MANIFEST_PATH) else []
+    corpora_dir = os.path.join(INDEX_PATH, "corpora")
+    if os.path.isdir(corpora_dir):
+        names += [name for name in sorted(os.listdir(corpora_dir))
+                  if CORPUS_NAME.match(name) and name != DEFAULT_CORPUS
+                  and os.path.exists(os.path.join(corpora_dir, name, "manifest.json"))]
+    return names
+
+def get_manifest(corpus=None):
+    """Reads a corpus's ingestion manifest written by tools/ingest.py (None if absent)."""
+    path = os.path.join(corpus_index_path(corpus), "manifest.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Registry: unreadable manifest: {e}")
+        return None
+
+def embedding_model_name():
+    # Queries must be embedded with the model the indexes were built with
+    # (the pool refuses to load a corpus built with another one)
+    for corpus in list_corpora():
+        manifest = get_manifest(corpus)
+        if manifest and manifest.get("embedding_model"):
+            return manifest["embedding_model"]
+    return EMBEDDING_MODEL
+
+def onnx_model_dir(model_name):
+    return ONNX_MODEL_DIR or os.path.join(BASE_DIR, "models", model_name.split("/")[-1] + "-onnx")
+
+def make_embeddings(model_name, batch_size=None, backend=None):
+    backend = backend or EMBEDDING_BACKEND
+    if backend == "onnx":
+        from tools.onnx_embeddings import OnnxEmbeddings
+        embeddings = OnnxEmbeddings(onnx_model_dir(model_name), batch_size=batch_size or 32, quantized=ONNX_QUANTIZED)
+        if embeddings.model_name.split("/")[-1] != model_name.split("/")[-1]:
+            raise ValueError(f"ONNX model is {embeddings.model_name}, but the index needs {model_name}")
+        return embeddings
+    if backend != "torch":
+        raise ValueError(f"Unknown EMBEDDING_BACKEND {backend!r}; expected torch or onnx")
+    from langchain_huggingface import HuggingFaceEmbeddings
+    encode_kwargs = {"batch_size": batch_size} if batch_size else {}
+    return HuggingFaceEmbeddings(model_name=model_name, encode_kwargs=encode_kwargs)
+
+def _load_embeddings():
+    return make_embeddings(embedding_model_name())
+
+def _load_reranker():
+    if not RERANKER_MODEL:
+        return None
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(RERANKER_MODEL)
+
+def _make_groq(model):
+    api_key = os.getenv("GROQ_API_KEY")
+    if not api_key:
+        return None
+    from langchain_groq import ChatGroq
+    return ChatGroq(model=model, temperature=0, groq_api_key=api_key)
+
+def _load_llm():
+    return _make_groq(LLM_MODEL)
+
+def get_embeddings():
+    return _build("embeddings", _load_embeddings)
+
+def get_shard(corpus=None):
+    """The corpus's loaded index (vector store + BM25), loading it into the pool if needed."""
+    from tools.index_pool import pool
+    return pool.get(corpus or DEFAULT_CORPUS)
+
+def get_vector_store(corpus=None):
+    shard = get_shard(corpus)
+    return shard.vector_store if shard else None
+
+def get_reranker():
+    return _build("reranker", _load_reranker)
+
+def get_llm():
+    return _build("llm", _load_llm)
+
+def get_summary_llm():
+    return _build("summary_llm", lambda: _make_groq(SUMMARY_MODEL))
+
+def index_revision(corpus=None):
+    """Manifest revision of the corpus's loaded index (None if not loaded)."""
+    from tools.index_pool import pool
+    shard = pool.peek(corpus or DEFAULT_CORPUS)
+    return shard.revision if shard else None
+
+def provide(name, value):
+    """Installs a ready-made resource, e.g. the stand-in LLM used by bench/e2e.py."""
+    with _lock:
+        _resources[name] = value
+        _timings[name] = 0.0
+        _errors.pop(name, None)
+
+def reset(*names):
+    """Drops cached resources so they are rebuilt on next use (all if no names)."""
+    with _lock:
+        for name in names or list(_resources):
+            _resources.pop(name, None)
+            _timings.pop(name, None)
+
+def warm():
+    """Builds every resource up front. Called at worker boot (or in the gunicorn master)."""
+    start = time.perf_counter()
+    get_embeddings()
+    # The default index, or with none (per-course deployments) the first index that loads
+    for corpus in list_corpora() or [DEFAULT_CORPUS]:
+        if get_shard(corpus) is not None:
+            break
+    get_reranker()
+    get_llm()
+    _timings["warm_total"] = round(time.perf_counter() - start, 3)
+    return status()
+
+def is_ready():
+    """Models loaded and the pool has loaded an index, whichever corpus it was."""
+    from tools.index_pool import pool
+    return all(name in _resources for name in ("embeddings", "llm")) and pool.loads > 0
+
+def status():
+    from tools.index_pool import pool
+    return {
+        "ready": is_ready(),
+        "loaded": sorted(_resources),
+        "index_revision": index_revision(),
+        "index": pool.status(),
+        "timings_s": dict(_timings),
+        "errors": dict(_errors),
+        "pid": os.getpid(),
+        # ru_maxrss is reported in KiB on Linux
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
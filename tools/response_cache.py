@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Semantic cache of final LLM answers. A cached answer is reused when a new
+# question's embedding is within THRESHOLD cosine similarity of a cached one
+# AND retrieval returned the same context chunks. Entries expire after TTL
+# seconds and the least recently used entry is evicted beyond MAX_ENTRIES.
+
+ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+class SemanticCache:
+    def __init__(self, threshold=THRESHOLD, ttl=TTL, max_entries=MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> entry, oldest first
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype="float32")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry["created"] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        self.evictions += len(expired)
+
+    def get(self, vector, context_ids):
+        """Returns the cached (response, mode) for a similar question, or None."""
+        with self._lock:
+            self._expire(time.time())
+            context_ids = tuple(context_ids)
+            candidates = [(key, entry) for key, entry in self._entries.items() if entry["context_ids"] == context_ids]
+            if candidates:
+                query = self._normalize(vector)
+                matrix = np.stack([entry["vector"] for _, entry in candidates])
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    key, entry = candidates[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry["response"], entry["mode"]
+            self.misses += 1
+            return None
+
+    def put(self, vector, context_ids, response, mode):
+        with self._lock:
+            self._entries[self._next_key] = {
+                "vector": self._normalize(vector),
+                "context_ids": tuple(context_ids),
+                "response": response,
+                "mode": mode,
+                "created": time.time(),
+            }
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def bypass(self):
+        with self._lock:
+            self.bypasses += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": ENABLED,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+response_cache = SemanticCache()
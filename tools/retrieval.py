@@ -0,0 +1,369 @@
+import os
+import re
+import heapq
+import threading
+from collections import OrderedDict
+import numpy as np
+from tools import registry, metrics
+
+# Shared retrieval helpers for agent.py and pdf_query_tools.py. Searching by
+# an explicit query vector lets callers reuse the embedding (e.g. for the
+# semantic response cache) and get stable chunk ids back.
+#
+# Hybrid mode (the default) takes RETRIEVAL_CANDIDATES from FAISS and from the
+# BM25 index, merges the two rankings with reciprocal-rank fusion and, when a
+# reranker is configured, lets the cross-encoder order the top RERANK_CANDIDATES.
+#
+# A search covers one or more corpora (default: registry.DEFAULT_CORPUS). The
+# query is embedded once, each corpus's shard is searched on its own and the
+# per-shard top-k lists are merged by score.
+#
+# Shards with a section index (tools/sections.py) are searched in two stages:
+# the query picks its SECTION_CANDIDATES nearest sections, then dense and BM25
+# search only those sections' chunks, so the work per query follows the size
+# of a few sections rather than of every book in the corpus.
+#
+# Both steps are memoized on the normalized query text: text -> embedding and
+# (text, k, shard revisions) -> top-k chunk ids. Both caches are cleared
+# whenever the loaded embedding model changes; re-ingesting a corpus bumps its
+# revision, so its old results are never served.
+
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")  # hybrid | dense
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "8"))
+RRF_K = 60  # standard reciprocal-rank fusion damping constant
+SECTION_CANDIDATES = int(os.getenv("SECTION_CANDIDATES", "8"))  # 0 searches every chunk
+WITHIN_BATCH = 32  # queries per decode + distance product in search_within_many()
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+embedding_cache = LRUCache(QUERY_CACHE_SIZE)
+search_cache = LRUCache(QUERY_CACHE_SIZE)
+_cache_tag = None
+
+def normalize_query(text):
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+def _check_tag():
+    """Clears both caches when the loaded embedding model changes."""
+    global _cache_tag
+    # Holding the embeddings object (not its id) means a reloaded model never compares equal
+    embeddings = registry.get_embeddings()
+    if _cache_tag is None or embeddings is not _cache_tag:
+        embedding_cache.clear()
+        search_cache.clear()
+        _cache_tag = embeddings
+
+def resolve_shards(corpora=None):
+    """Shards for the named corpora (the default corpus if none), loading them as needed.
+    Corpora without an index are skipped."""
+    shards = []
+    for corpus in dict.fromkeys(corpora or [registry.DEFAULT_CORPUS]):
+        shard = registry.get_shard(corpus)
+        if shard is not None:
+            shards.append(shard)
+    return shards
+
+def embed_query(text):
+    embeddings = registry.get_embeddings()
+    if embeddings is None:
+        return None
+    key = normalize_query(text)
+    vector = embedding_cache.get(key)
+    if vector is None:
+        with metrics.span("embed"):
+            vector = embeddings.embed_query(key)
+        embedding_cache.put(key, vector)
+    return vector
+
+def embed_queries(texts):
+    """Batched embed_query(): cached vectors are reused, the rest go to the model in one call."""
+    embeddings = registry.get_embeddings()
+    if embeddings is None:
+        return [None] * len(texts)
+    keys = [normalize_query(text) for text in texts]
+    vectors = [embedding_cache.get(key) for key in keys]
+    missing = sorted({key for key, vector in zip(keys, vectors) if vector is None})
+    if missing:
+        # Both backends embed documents and queries identically (no query prefix)
+        with metrics.span("embed"):
+            fresh = dict(zip(missing, embeddings.embed_documents(missing)))
+        for key, vector in fresh.items():
+            embedding_cache.put(key, vector)
+        vectors = [fresh[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+    return vectors
+
+def search_by_vectors(vectors, k=3, shard=None):
+    """One FAISS search for several queries. Returns a [(chunk_id, Document, distance)] list per vector."""
+    shard = shard or registry.get_shard()
+    if shard is None or not vectors:
+        return [[] for _ in vectors]
+    vector_store = shard.vector_store
+    distances, positions = vector_store.index.search(np.array(vectors, dtype="float32"), k)
+    return [_hits(vector_store, zip(row_distances, row_positions))
+            for row_distances, row_positions in zip(distances, positions)]
+
+def _hits(vector_store, found):
+    """[(chunk_id, Document, distance)] for (distance, index position) pairs; -1 positions are padding."""
+    results = []
+    for distance, position in found:
+        if position == -1:
+            continue
+        chunk_id = vector_store.index_to_docstore_id[int(position)]
+        results.append((chunk_id, vector_store.docstore.search(chunk_id), float(distance)))
+    return results
+
+def search_by_vector(vector, k=3, shard=None):
+    """Returns [(chunk_id, Document, distance)] for the k nearest chunks."""
+    if vector is None:
+        return []
+    return search_by_vectors([vector], k, shard)[0]
+
+def two_stage(shard):
+    return shard.sections is not None and 0 < SECTION_CANDIDATES < len(shard.sections)
+
+def section_scope(vector, shard):
+    """Chunk ids of the sections nearest the query, or None to search the whole shard."""
+    if vector is None or not two_stage(shard):
+        return None
+    with metrics.span("search.sections"):
+        nearest = shard.sections.search(vector, SECTION_CANDIDATES)
+    return [chunk_id for section, _ in nearest for chunk_id in section["chunks"]] or None
+
+def search_within(vector, k, shard, chunk_ids):
+    """search_by_vector() restricted to the given chunks. Returns [(chunk_id, Document, distance)]."""
+    if vector is None:
+        return []
+    return search_within_many([vector], k, shard, [chunk_ids])[0]
+
+def search_within_many(vectors, k, shard, scopes):
+    """search_within() for several queries, each restricted to its own chunk ids (None: the
+    whole shard). The chunks of up to WITHIN_BATCH queries are decoded once and every query
+    is scored against them in one matrix product. Returns a result list per vector."""
+    results = [[] for _ in vectors]
+    whole = [i for i, scope in enumerate(scopes) if scope is None]
+    for i, found in zip(whole, search_by_vectors([vectors[i] for i in whole], k, shard)):
+        results[i] = found
+    positions = {i: np.array([shard.positions[chunk_id] for chunk_id in scope if chunk_id in shard.positions],
+                             dtype="int64")
+                 for i, scope in enumerate(scopes) if scope is not None}
+    scoped = [i for i in positions if len(positions[i])]
+    vector_store = shard.vector_store
+    for start in range(0, len(scoped), WITHIN_BATCH):
+        block = scoped[start:start + WITHIN_BATCH]
+        union = np.unique(np.concatenate([positions[i] for i in block]))
+        try:
+            # Decodes only these vectors; every layout ingest builds is L2, like these distances
+            candidates = vector_store.index.reconstruct_batch(union)
+        except RuntimeError:
+            # IVF layouts keep no direct map to decode from; filter the regular search instead
+            for i in block:
+                results[i] = _hits(vector_store, _search_selected(vectors[i], k, shard, positions[i]))
+            continue
+        queries = np.asarray([vectors[i] for i in block], dtype="float32")
+        distances = ((queries ** 2).sum(axis=1)[:, None] - 2 * queries @ candidates.T
+                     + (candidates ** 2).sum(axis=1)[None, :])
+        for row, i in zip(distances, block):
+            own = np.maximum(row[np.searchsorted(union, positions[i])], 0)
+            order = np.argsort(own)[:k]
+            results[i] = _hits(vector_store, zip(own[order], positions[i][order]))
+    return results
+
+def _search_selected(vector, k, shard, positions):
+    """One FAISS search over only the given index positions. Returns (distance, position) pairs."""
+    import faiss
+    selector = faiss.IDSelectorBatch(len(positions), faiss.swig_ptr(positions))
+    if shard.nprobe is None:
+        params = faiss.SearchParameters(sel=selector)
+    else:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=shard.nprobe)
+    query = np.asarray(vector, dtype="float32").reshape(1, -1)
+    distances, found = shard.vector_store.index.search(query, k, params=params)
+    return zip(distances[0], found[0])
+
+def fuse(rankings, k):
+    """Reciprocal-rank fusion of several best-first chunk id lists. Returns [(chunk_id, score)]."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+def rerank(text, candidates, vector_store):
+    """Orders [(chunk_id, score)] by cross-encoder relevance (unchanged if no reranker)."""
+    reranker = registry.get_reranker()
+    if reranker is None or len(candidates) < 2:
+        return candidates
+    with metrics.span("search.rerank"):
+        pairs = [(text, vector_store.docstore.search(chunk_id).page_content) for chunk_id, _ in candidates]
+        scores = reranker.predict(pairs)
+    return sorted(((chunk_id, float(score)) for (chunk_id, _), score in zip(candidates, scores)),
+                  key=lambda item: item[1], reverse=True)
+
+def candidate_depth(k, shard):
+    """Dense results hybrid_search() needs for a top-k query."""
+    if RETRIEVAL_MODE == "hybrid" and shard.lexical is not None:
+        return max(k, RETRIEVAL_CANDIDATES)
+    return k
+
+def hybrid_search(text, vector, k, dense=None, shard=None, within=None):
+    """Returns [(chunk_id, score)] from one shard's fused dense + BM25 rankings, best first.
+    `dense` is a precomputed search_by_vector(vector, candidate_depth(k, shard), shard), or for
+    a two-stage shard search_within() over `within`, the query's section_scope()."""
+    shard = shard or registry.get_shard()
+    if shard is None:
+        return []
+    depth = candidate_depth(k, shard)
+    lexical_index = shard.lexical if RETRIEVAL_MODE == "hybrid" else None
+
+    if dense is None:
+        within = section_scope(vector, shard)
+        with metrics.span("search.dense"):
+            if within is None:
+                dense = search_by_vector(vector, depth, shard)
+            else:
+                dense = search_within(vector, depth, shard, within)
+    if lexical_index is None:
+        # Dense only: negate distances so higher is better, as for fused scores
+        return [(chunk_id, -distance) for chunk_id, _, distance in dense]
+    dense = [chunk_id for chunk_id, _, _ in dense]
+
+    with metrics.span("search.lexical"):
+        lexical = [chunk_id for chunk_id, _ in lexical_index.search(text, depth, within)]
+    with metrics.span("search.fuse"):
+        fused = fuse([dense, lexical], max(k, RERANK_CANDIDATES))
+    return rerank(text, fused, shard.vector_store)[:k]
+
+def merge(rankings, k):
+    """Merges per-shard [(corpus, chunk_id, score)] lists into the overall top k.
+
+    Every shard is searched with the same query vector and scored the same way
+    (negated distance, RRF or cross-encoder), so scores compare directly; RRF
+    scores are rank-based, so without a reranker the shards interleave by rank.
+    A chunk found in several shards (the same PDF in two corpora) counts once.
+    """
+    best = {}
+    for ranking in rankings:
+        for corpus, chunk_id, score in ranking:
+            if chunk_id not in best or score > best[chunk_id][2]:
+                best[chunk_id] = (corpus, chunk_id, score)
+    return heapq.nlargest(k, best.values(), key=lambda hit: hit[2])
+
+def _cache_key(text, k, shards):
+    return normalize_query(text), k, tuple((shard.corpus, shard.revision) for shard in shards)
+
+def _documents(hits, shards):
+    by_corpus = {shard.corpus: shard for shard in shards}
+    return [(chunk_id, by_corpus[corpus].vector_store.docstore.search(chunk_id), score)
+            for corpus, chunk_id, score in hits]
+
+def search(text, k=3, corpora=None):
+    """Embeds the query and searches the given corpora (default corpus if None).
+    Returns (query_vector, [(chunk_id, Document, score)]), most relevant first."""
+    shards = resolve_shards(corpora)
+    _check_tag()
+    vector = embed_query(text)
+    if not shards or vector is None:
+        return vector, []
+
+    key = _cache_key(text, k, shards)
+    hits = search_cache.get(key)
+    if hits is None:
+        with metrics.span("search"):
+            hits = merge([[(shard.corpus, chunk_id, score)
+                           for chunk_id, score in hybrid_search(text, vector, k, shard=shard)]
+                          for shard in shards], k)
+        search_cache.put(key, hits)
+    return vector, _documents(hits, shards)
+
+def search_many(texts, k=3, corpora=None):
+    """Batched search(): one embedding call, and one FAISS search (or, for a two-stage
+    shard, one decode of the chunks of the texts' sections) per shard for every uncached
+    text. Returns a (query_vector, results) pair per text."""
+    shards = resolve_shards(corpora)
+    _check_tag()
+    vectors = embed_queries(texts)
+    if not shards or not texts or vectors[0] is None:
+        return [(vector, []) for vector in vectors]
+
+    keys = [_cache_key(text, k, shards) for text in texts]
+    hits = [search_cache.get(key) for key in keys]
+    todo = [i for i, found in enumerate(hits) if found is None]
+    if todo:
+        with metrics.span("search"):
+            rankings = {i: [] for i in todo}
+            for shard in shards:
+                # Two-stage shards: each query's own sections, their chunks decoded together
+                scopes = [section_scope(vectors[i], shard) for i in todo]
+                with metrics.span("search.dense"):
+                    if any(scope is not None for scope in scopes):
+                        dense = search_within_many([vectors[i] for i in todo], candidate_depth(k, shard),
+                                                   shard, scopes)
+                    else:
+                        dense = search_by_vectors([vectors[i] for i in todo], candidate_depth(k, shard), shard)
+                for i, candidates, within in zip(todo, dense, scopes):
+                    rankings[i].append([(shard.corpus, chunk_id, score) for chunk_id, score
+                                        in hybrid_search(texts[i], vectors[i], k, candidates, shard, within)])
+            for i in todo:
+                hits[i] = merge(rankings[i], k)
+                search_cache.put(keys[i], hits[i])
+    return [(vector, _documents(found, shards)) for vector, found in zip(vectors, hits)]
+
+def citations(results):
+    """Page citations for search() results: one per section, most relevant first. Chunks
+    from indexes built before sections carry no pages and are left out."""
+    cited = {}
+    for _, doc, _ in results:
+        metadata = doc.metadata
+        if "page" not in metadata:
+            continue
+        first, last = metadata["page"], metadata.get("page_end", metadata["page"])
+        key = (metadata.get("source"), metadata.get("section_id"))
+        entry = cited.setdefault(key, {"source": metadata.get("source"), "section": metadata.get("section") or None,
+                                       "pages": [first, last]})
+        entry["pages"] = [min(entry["pages"][0], first), max(entry["pages"][1], last)]
+    return list(cited.values())
+
+def stats():
+    return {"embedding_cache": embedding_cache.stats(), "search_cache": search_cache.stats(),
+            "mode": RETRIEVAL_MODE, "reranker": registry.RERANKER_MODEL or None,
+            "section_candidates": SECTION_CANDIDATES}
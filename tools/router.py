@@ -0,0 +1,129 @@
+import os
+import re
+import threading
+import numpy as np
+from tools import registry, retrieval
+
+# Embedding-based topic router. Each label has a handful of seed phrases whose
+# embeddings are averaged into a centroid (computed once per loaded model).
+# A query goes to the label with the highest cosine similarity, provided it
+# beats the runner-up by ROUTER_MARGIN; otherwise (or without an embedding
+# model) we fall back to whole-word keyword matching.
+
+ROUTER_MARGIN = float(os.getenv("ROUTER_MARGIN", "0.04"))
+
+SEED_PHRASES = {
+    "os": [
+        "What is paging in operating systems?",
+        "Explain the difference between a process and a thread.",
+        "How does round robin CPU scheduling work?",
+        "What are the necessary conditions for deadlock?",
+        "Explain the Banker's algorithm for deadlock avoidance.",
+        "What is a semaphore and how is it used for synchronization?",
+        "How does virtual memory and demand paging work?",
+        "What is a TLB miss and a page fault?",
+        "Explain the critical section problem and mutex locks.",
+        "How does the kernel handle a system call and interrupts?",
+        "Compare FCFS, SJF and priority scheduling.",
+        "What is thrashing and how does the working set model prevent it?",
+        "How are files allocated on disk in a file system?",
+        "Explain disk scheduling algorithms like SCAN and C-LOOK.",
+        "What is a context switch?",
+        "Draw a diagram of the process state lifecycle.",
+        "How do monitors and condition variables work?",
+        "What is segmentation versus paging?",
+    ],
+    "off_topic": [
+        "What is the capital of France?",
+        "Who won the football world cup?",
+        "Write me a poem about the ocean.",
+        "What is the cost of living in London?",
+        "Recommend a good movie to watch tonight.",
+        "How do I bake chocolate chip cookies?",
+        "Explain photosynthesis in plants.",
+        "What are the tax slabs this year?",
+        "Who is the president of the United States?",
+        "How do I build a React website with CSS?",
+        "What is the stock price of Apple?",
+        "Translate this sentence into Spanish.",
+        "Tell me about the history of the Roman empire.",
+        "What should I eat for dinner?",
+    ],
+    "greeting": [
+        "hi",
+        "hello",
+        "hey there",
+        "good morning",
+        "greetings",
+        "who are you?",
+        "what can you help me with?",
+        "help",
+        "thanks!",
+        "thank you so much",
+        "let's start",
+    ],
+}
+
+# Whole-word fallback when the embedding model is unavailable or undecided
+TECHNICAL_KEYWORDS = [
+    "process", "thread", "schedule", "scheduling", "deadlock", "memory", "paging", "kernel", "semaphore", "disk",
+    "fcfs", "sjf", "round robin", "os", "operating system", "linux", "windows", "cpu", "cache",
+    "virtual", "file system", "interrupt", "system call", "mutex", "hardware", "software", "code",
+    "programming", "computer", "server", "client", "network", "boot", "algorithm", "concurrency",
+    "synchronization", "banker", "page", "frame", "segmentation", "i/o", "io", "driver", "monitor",
+    "tlb", "thrashing", "context switch", "fork", "pipe", "inode",
+]
+GREETINGS = ["hi", "hello", "hey", "greetings", "good morning", "start", "help", "who are you", "thanks", "thank you"]
+
+_KEYWORD_RE = re.compile(r"\b(" + "|".join(re.escape(kw) for kw in TECHNICAL_KEYWORDS) + r")s?\b")
+
+_lock = threading.Lock()
+_centroids = None  # (embeddings object, labels, matrix)
+
+def _get_centroids():
+    global _centroids
+    embeddings = registry.get_embeddings()
+    if embeddings is None:
+        return None
+    if _centroids is not None and _centroids[0] is embeddings:
+        return _centroids
+    with _lock:
+        if _centroids is None or _centroids[0] is not embeddings:
+            labels = list(SEED_PHRASES)
+            rows = []
+            for label in labels:
+                vectors = np.array(embeddings.embed_documents(SEED_PHRASES[label]), dtype="float32")
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                centroid = vectors.mean(axis=0)
+                rows.append(centroid / np.linalg.norm(centroid))
+            _centroids = (embeddings, labels, np.stack(rows))
+    return _centroids
+
+def keyword_route(user_message):
+    text = user_message.lower().strip()
+    if _KEYWORD_RE.search(text):
+        return "os"
+    if any(text == g or text.startswith(g + " ") or text.startswith(g + "!") for g in GREETINGS):
+        return "greeting"
+    return "off_topic"
+
+def route(user_message):
+    """Returns (label, confidence, method) with label in {"os", "off_topic", "greeting"}."""
+    centroids = _get_centroids()
+    vector = retrieval.embed_query(user_message) if centroids else None
+    if vector is None:
+        return keyword_route(user_message), 0.0, "keywords"
+
+    _, labels, matrix = centroids
+    query = np.asarray(vector, dtype="float32")
+    query /= np.linalg.norm(query) or 1.0
+    scores = matrix @ query
+    order = np.argsort(scores)[::-1]
+    margin = float(scores[order[0]] - scores[order[1]])
+    if margin < ROUTER_MARGIN:
+        return keyword_route(user_message), margin, "keywords (low confidence)"
+    return labels[order[0]], margin, "embeddings"
+
+def warm():
+    """Precomputes the centroids (call after fork: it runs the embedding model)."""
+    return _get_centroids() is not None
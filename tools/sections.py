@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import bisect
+import numpy as np
+
+# Sections of a textbook and the coarse index over them, for two-stage
+# retrieval. pymupdf4llm renders headings as markdown (#, ##, ...); Sectioner
+# follows that heading tree page by page and cuts the text at headings up to
+# SECTION_DEPTH, so a chunk never straddles two sections and knows its
+# chapter/section path and pages. SectionIndex holds one row per section: its
+# heading path, pages, a short extractive summary, its chunk ids and the mean
+# of its chunk embeddings. A query picks the nearest sections here first and
+# only their chunks are searched (tools/retrieval.py). Built by
+# tools/ingest.py and saved next to the index as sections.json + sections.npy.
+
+FILENAME = "sections.json"
+VECTORS_FILENAME = "sections.npy"
+FORMAT_VERSION = 1
+SECTION_DEPTH = 2  # "#" and "##" headings open a section; deeper ones stay inside it
+SECTION_MIN_CHARS = 1500  # a shorter section runs on into the next heading
+SECTION_MAX_CHARS = 40000  # a longer one is cut and continues under the same headings
+SUMMARY_CHARS = 300
+
+HEADING = re.compile(r"^(#{1,6})\s+(.*\S)\s*$")
+
+def clean_heading(text):
+    return re.sub(r"[*_`]+", "", text).strip(" #")
+
+def summarize(section):
+    """Heading path plus the section's opening text, cut at a word boundary."""
+    body = " ".join(line for line in section["text"].splitlines() if not HEADING.match(line.strip()))
+    body = re.sub(r"[*_`|#]+", " ", body)
+    body = re.sub(r"\s+", " ", body).strip()
+    if len(body) > SUMMARY_CHARS:
+        body = body[:SUMMARY_CHARS].rsplit(" ", 1)[0] + "..."
+    return " > ".join(section["path"] + [body]) if section["path"] else body
+
+def page_at(section, offset):
+    """Page number of the character at `offset` in a section's text."""
+    index = bisect.bisect_right(section["offsets"], offset) - 1
+    return section["page_numbers"][max(index, 0)]
+
+class Sectioner:
+    """Cuts one PDF's markdown into sections as its pages arrive.
+
+    feed() takes pages in order and yields the sections they complete;
+    close() yields the last one. A section is a dict with its "id", "source",
+    heading "path" (outermost first), "pages" [first, last] and "text", plus
+    where each page starts in the text (for page_at()).
+    """
+
+    def __init__(self, source, prefix):
+        self.source = source
+        self.prefix = prefix
+        self.headings = []  # heading path at the current position
+        self.count = 0
+        self._start(titled=False)
+
+    def _start(self, titled):
+        self.path = list(self.headings)
+        self.titled = titled  # the section began at (or has seen) a heading of its own
+        self.parts, self.size = [], 0
+        self.offsets, self.page_numbers = [], []
+
+    def _flush(self, titled=False):
+        text = "".join(self.parts)
+        if text.strip():
+            yield {
+                "id": f"{self.prefix}-s{self.count}",
+                "source": self.source,
+                "path": self.path,
+                "pages": [self.page_numbers[0], self.page_numbers[-1]],
+                "text": text,
+                "offsets": self.offsets,
+                "page_numbers": self.page_numbers,
+            }
+            self.count += 1
+        self._start(titled)
+
+    def feed(self, page, markdown):
+        if not markdown.endswith("\n"):
+            markdown += "\n"
+        for line in markdown.splitlines(keepends=True):
+            match = HEADING.match(line.strip())
+            title = clean_heading(match.group(2)) if match else ""
+            if title and len(match.group(1)) <= SECTION_DEPTH:
+                if self.size >= SECTION_MIN_CHARS:
+                    yield from self._flush()
+                self.headings = self.headings[:len(match.group(1)) - 1] + [title]
+                if not self.titled:
+                    self.path, self.titled = list(self.headings), True
+            elif self.size >= SECTION_MAX_CHARS:
+                yield from self._flush(titled=True)
+            if not self.page_numbers or self.page_numbers[-1] != page:
+                self.offsets.append(self.size)
+                self.page_numbers.append(page)
+            self.parts.append(line)
+            self.size += len(line)
+
+    def close(self):
+        yield from self._flush()
+
+class SectionIndex:
+    def __init__(self):
+        self.sections = []  # metadata, one per row of the section matrix
+        self.rows = []  # unit-length section vectors (None until finish())
+        self._sums = {}  # section id -> summed chunk vectors, while ingesting
+        self._matrix = None
+
+    def __len__(self):
+        return len(self.sections)
+
+    def add(self, section, chunk_ids):
+        """Registers a section from Sectioner and the ids of the chunks cut from it."""
+        self.sections.append({
+            "id": section["id"],
+            "source": section["source"],
+            "path": section["path"],
+            "pages": section["pages"],
+            "summary": summarize(section),
+            "chunks": chunk_ids,
+        })
+        self.rows.append(None)
+        self._sums.setdefault(section["id"], None)
+
+    def add_vectors(self, section_ids, vectors):
+        """Adds embedded chunks to their sections' vectors."""
+        for section_id, vector in zip(section_ids, vectors):
+            if section_id in self._sums:
+                vector = np.asarray(vector, dtype="float32")
+                total = self._sums[section_id]
+                self._sums[section_id] = vector if total is None else total + vector
+
+    def finish(self):
+        """Turns the summed chunk vectors of new sections into unit-length rows."""
+        for i, section in enumerate(self.sections):
+            if self.rows[i] is None:
+                total = self._sums.get(section["id"])
+                if total is not None:
+                    self.rows[i] = total / (np.linalg.norm(total) or 1.0)
+        keep = [i for i, row in enumerate(self.rows) if row is not None]
+        self.sections = [self.sections[i] for i in keep]
+        self.rows = [self.rows[i] for i in keep]
+        self._sums = {}
+        self._matrix = None
+
+    def remove(self, sources):
+        """Drops every section of the given PDFs."""
+        keep = [i for i, section in enumerate(self.sections) if section["source"] not in sources]
+        self.sections = [self.sections[i] for i in keep]
+        self.rows = [self.rows[i] for i in keep]
+        self._matrix = None
+
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.vstack(self.rows).astype("float32") if self.rows else np.zeros((0, 0), "float32")
+        return self._matrix
+
+    def search(self, vector, k):
+        """Returns [(section, cosine similarity)] for the k sections nearest the query, best first."""
+        matrix = self.matrix()
+        if not len(matrix) or vector is None:
+            return []
+        query = np.asarray(vector, dtype="float32")
+        scores = matrix @ (query / (np.linalg.norm(query) or 1.0))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.sections[i], float(scores[i])) for i in top]
+
+    def save(self, directory):
+        self.finish()
+        path = os.path.join(directory, FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"version": FORMAT_VERSION, "sections": self.sections}, f)
+        vectors_path = os.path.join(directory, VECTORS_FILENAME)
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, self.matrix())
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory):
+        """Reads the section index from the index directory (None if absent or outdated)."""
+        path = os.path.join(directory, FILENAME)
+        vectors_path = os.path.join(directory, VECTORS_FILENAME)
+        if not os.path.exists(path) or not os.path.exists(vectors_path):
+            return None
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != FORMAT_VERSION:
+            return None
+        index = cls()
+        index.sections = data["sections"]
+        # Memory-mapped like index.faiss, so forked workers share the pages
+        index._matrix = np.load(vectors_path, mmap_mode="r")
+        index.rows = list(index._matrix)
+        return index
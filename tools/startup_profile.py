@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Boot profile of the app, each phase measured in a fresh interpreter so
+# nothing is already imported or cached:
+#   import: `python -X importtime -c "import app"`, summed per top-level
+#     package (self time, so nested imports are not counted twice);
+#   ready: spawn -> `import app` -> registry.warm() + router.warm(), i.e. what a
+#     gunicorn worker does before it serves its first request.
+# Both children run with MONGO_URI unset so the Mongo probe thread cannot
+# skew the numbers. `python app.py --profile-startup` prints the report;
+# bench/boot_budget.py turns it into a pass/fail check.
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Must only be imported behind the code paths that use them, never by `import app`
+HEAVY_MODULES = ("torch", "transformers", "sentence_transformers", "langchain_huggingface",
+                 "langchain_groq", "langchain_community", "faiss", "onnxruntime",
+                 "pymongo", "motor", "pymupdf", "pymupdf4llm")
+
+READY_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+imported = time.perf_counter()
+from tools import registry, router
+status = registry.warm()
+router.warm()
+print(json.dumps({"import_s": imported - start, "warm_s": time.perf_counter() - imported,
+                  "ready": status["ready"], "timings_s": status["timings_s"],
+                  "errors": status["errors"], "max_rss_mb": status["max_rss_mb"]}))
+"""
+
+def _child_env():
+    return {**os.environ, "MONGO_URI": "", "LOG_REQUESTS": "0", "PYTHONDONTWRITEBYTECODE": "1"}
+
+def _run(args):
+    result = subprocess.run([sys.executable, *args], cwd=BASE_DIR, env=_child_env(),
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        tail = "\n".join(result.stderr.strip().splitlines()[-10:])
+        raise RuntimeError(f"{' '.join(args[:3])} failed:\n{tail}")
+    return result
+
+def import_profile(module="app"):
+    """Per-package import cost of `import module`. Returns {"total_s", "packages": [(name, s)], "loaded"}."""
+    result = _run(["-X", "importtime", "-c", f"import {module}"])
+    packages = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, _, name = line[len("import time:"):].split("|")
+            package = name.strip().split(".")[0]
+            packages[package] = packages.get(package, 0) + int(self_us)
+        except ValueError:
+            continue
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "total_s": round(sum(packages.values()) / 1e6, 3),
+        "packages": [(name, round(us / 1e6, 4)) for name, us in ranked],
+        "loaded": sorted(packages),
+    }
+
+def ready_profile(module="app"):
+    """Spawns a process that imports `module` and warms the registry; times it from spawn to ready."""
+    start = time.perf_counter()
+    result = _run(["-c", READY_SCRIPT, module])
+    ready_s = time.perf_counter() - start
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report["time_to_ready_s"] = round(ready_s, 3)
+    report["interpreter_s"] = round(ready_s - report["import_s"] - report["warm_s"], 3)
+    report["import_s"] = round(report["import_s"], 3)
+    report["warm_s"] = round(report["warm_s"], 3)
+    return report
+
+def profile(module="app", ready=True):
+    imports = import_profile(module)
+    return {
+        "module": module,
+        "import": imports,
+        "eager_heavy": [name for name in HEAVY_MODULES if name in imports["loaded"]],
+        "ready": ready_profile(module) if ready else None,
+    }
+
+def report(result, top=15):
+    imports = result["import"]
+    print(f"import {result['module']}: {imports['total_s']}s across {len(imports['loaded'])} packages")
+    for name, seconds in imports["packages"][:top]:
+        print(f"  {name:<28} {seconds * 1000:>9.1f} ms")
+    if result["eager_heavy"]:
+        print(f"Heavy modules imported eagerly: {', '.join(result['eager_heavy'])}")
+    ready = result["ready"]
+    if ready:
+        print(f"\nTime to ready: {ready['time_to_ready_s']}s (interpreter {ready['interpreter_s']}s, "
+              f"import {ready['import_s']}s, warm {ready['warm_s']}s), ready={ready['ready']}, "
+              f"max RSS {ready['max_rss_mb']} MB")
+        for name, seconds in sorted(ready["timings_s"].items(), key=lambda item: item[1], reverse=True):
+            print(f"  {name:<28} {seconds:>9.3f} s")
+        for name, error in ready["errors"].items():
+            print(f"  {name} failed: {error}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report per-module import cost and time-to-ready of the app.")
+    parser.add_argument("--module", default="app", help="Module a worker imports (app or asgi)")
+    parser.add_argument("--top", type=int, default=15, help="Packages to list")
+    parser.add_argument("--no-ready", action="store_true", help="Only profile the import, skip warming")
+    parser.add_argument("--json", help="Also write the profile to this file")
+    args = parser.parse_args(argv)
+    result = profile(args.module, ready=not args.no_ready)
+    report(result, args.top)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+if __name__ == "__main__":
+    main()
@@ -17,11 +17,13 @@ query = "What are the tax slabs?"
 print(f"   Query: {query}")
 
 try:
-    response, thoughts = agent(query, [])
+    response, thoughts, citations = agent(query, [])
     print("\n--- RESPONSE ---")
     print(response)
     print("\n--- THOUGHTS ---")
     print(thoughts)
+    print("\n--- CITATIONS ---")
+    print(citations)
 except Exception as e:
     print(f"\nCRITICAL ERROR during execution: {e}")
     import traceback